@@ -1,13 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from imutils import contours
-from skimage import measure
-from PIL import Image
+from os.path import exists
+from os import makedirs
 import numpy as np
+import sqlite3
 import imutils
 import cv2
 
+from fundus import FundusImage, open_image
+from image_index import get_index
+from tracing import traced
+
 
 # Image output dimensions
 output_dim = 512
+# Disc localization confidence: contrast of the blob with a ring around it
+# (gray levels) that counts as fully confident, and ring width (fraction of
+# the blob radius)
+CONTRAST_REF = 40
+RING_WIDTH = 1.0
+# Cropped regions of images (filename -> region)
+crop_regions = {}
+# Write-behind of crop files and regions (filename -> Future of its crop)
+writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='crop-writer')
+pending_writes = {}
+# Latest metrics of images waiting for the writer (filename -> fields)
+pending_metrics = {}
+metrics_lock = Lock()
 
 
 def point_check(pt):
@@ -17,17 +37,26 @@ def point_check(pt):
     return tuple(newpt)
 
 
-def cropONH(imageName):
-    img_path = imageName
-    image = Image.open(img_path)
-    im_w, im_h = image.size
+def to_gray(image):
+    ''' Get gray image of a FundusImage or a decoded RGB array '''
+    if isinstance(image, FundusImage):
+        return image.gray
+    return cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+
+
+@traced()
+def find_bright_blob(gray, token=None):
+    ''' Find the largest blob of the brightest region of a gray image
+        The threshold is lowered until a blob is found. Returns the blob
+        contour and the blurred gray image.
+    '''
+    median = cv2.medianBlur(gray, 5)
     starting_threshold = 255
 
     while True:
-        # load the image, convert it to grayscale, and blur it
-        image = cv2.imread(img_path)
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        median = cv2.medianBlur(gray, 5)
+        # stop if the job has been cancelled
+        if token is not None:
+            token.check()
         # threshold the image to reveal light regions in the blurred image
         thresh = cv2.threshold(median,
                                starting_threshold,
@@ -39,27 +68,13 @@ def cropONH(imageName):
         thresh = cv2.dilate(thresh, None, iterations=4)
 
         # perform a connected component analysis on the thresholded
-        # image, then initialize a mask to store only the "large"
-        # components
-        labels = measure.label(thresh, background=0)
+        # image, then initialize a mask to store only the largest
+        # component (label 0 is the background)
+        n, labels, stats, _ = cv2.connectedComponentsWithStats(thresh)
         mask = np.zeros(thresh.shape, dtype="uint8")
-
-        largest_blob = 0
-        # loop over the unique components
-        for label in np.unique(labels):
-            # if this is the background label, ignore it
-            if label == 0:
-                continue
-            # otherwise, construct the label mask and count the
-            # number of pixels
-            labelMask = np.zeros(thresh.shape, dtype="uint8")
-            labelMask[labels == label] = 255
-            numPixels = cv2.countNonZero(labelMask)
-            # if the number of pixels in the component is sufficiently
-            # large, then add it to our mask of "large blobs"
-            if numPixels > largest_blob:
-                largest_blob = numPixels
-                mask = labelMask
+        if n > 1:
+            largest = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
+            mask[labels == largest] = 255
 
         # find the contours in the mask, then sort them from left to right
         cnts = cv2.findContours(mask.copy(),
@@ -68,63 +83,188 @@ def cropONH(imageName):
         cnts = imutils.grab_contours(cnts)
 
         # If there is nothing found for the image
-        if cnts == []:
+        if len(cnts) == 0:
             starting_threshold -= 10
             continue
 
-        cnts = contours.sort_contours(cnts)[0]
-        # loop over the contours
-        for (i, c) in enumerate(cnts):
-            (x, y, w, h) = cv2.boundingRect(c)
-
-            center = (round(x + (w/2)), round(y + (h/2)))
-
-            cv2.putText(image, "O", center,
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 0, 255), 2)
-
-            box_radius = output_dim//2
-
-            tl_pt = [center[0]-box_radius, center[1]-box_radius]
-            br_pt = [center[0]+box_radius, center[1]+box_radius]
-
-            # Check if TL point is out of bounds
-            if tl_pt[0] < 0:
-                neg = tl_pt[0] * -1
-                tl_pt[0] = 0
-                br_pt[0] += neg
-
-            if tl_pt[1] < 0:
-                neg = tl_pt[1] * -1
-                tl_pt[1] = 0
-                br_pt[1] += neg
-
-            # Check if BR point is out of bounds
-            if br_pt[0] > im_w:
-                pos = im_w-br_pt[0]
-                br_pt[0] = im_w
-                tl_pt[0] -= pos
-            if br_pt[1] > im_h:
-                pos = im_h-br_pt[1]
-                br_pt[1] = im_h
-                tl_pt[1] -= pos
-            cv2.rectangle(image, tuple(tl_pt), tuple(br_pt), (255, 0, 0), 3)
-            break
-        image = cv2.resize(image, (800, 800))
-        break
+        # use the first contour (from left to right)
+        return contours.sort_contours(cnts)[0][0], median
+
+
+@traced(image_arg=0)
+def cropONH(imageName, token=None, image=None):
+    ''' Find ONH region (x1, y1, x2, y2) of an image file
+        A FundusImage or a decoded RGB array (e.g. a shared buffer) can be
+        passed instead of the shared FundusImage of the file, it is not
+        modified.
+    '''
+    # load the image (once) and convert it to grayscale
+    if image is None:
+        image = open_image(imageName)
+    gray = to_gray(image)
+    im_h, im_w = gray.shape
+    contour, _ = find_bright_blob(gray, token)
+
+    (x, y, w, h) = cv2.boundingRect(contour)
+
+    center = (round(x + (w/2)), round(y + (h/2)))
+
+    box_radius = output_dim//2
+
+    tl_pt = [center[0]-box_radius, center[1]-box_radius]
+    br_pt = [center[0]+box_radius, center[1]+box_radius]
+
+    # Check if TL point is out of bounds
+    if tl_pt[0] < 0:
+        neg = tl_pt[0] * -1
+        tl_pt[0] = 0
+        br_pt[0] += neg
+
+    if tl_pt[1] < 0:
+        neg = tl_pt[1] * -1
+        tl_pt[1] = 0
+        br_pt[1] += neg
+
+    # Check if BR point is out of bounds
+    if br_pt[0] > im_w:
+        pos = im_w-br_pt[0]
+        br_pt[0] = im_w
+        tl_pt[0] -= pos
+    if br_pt[1] > im_h:
+        pos = im_h-br_pt[1]
+        br_pt[1] = im_h
+        tl_pt[1] -= pos
     return (tl_pt[0], tl_pt[1], br_pt[0], br_pt[1])
 
 
-def get_cropONH(file):
-    region = cropONH(file)
+@traced()
+def locate_disc(image, token=None):
+    ''' Locate optic disc center (x, y) of an image with a confidence in
+        [0, 1] (cheap alternative to the DiscSeg U-Net)
+        The brightest blob is scored by its compactness and by its
+        contrast with a ring around it. Compactness is the circularity of
+        the blob convex hull (4 pi area / perimeter^2, 1 for a circle)
+        times its solidity (blob area / hull area), as vessels crossing
+        the disc make the blob outline itself jagged. image is a
+        FundusImage or a decoded RGB array.
+    '''
+    gray = to_gray(image)
+    contour, median = find_bright_blob(gray, token)
+    hull = cv2.convexHull(contour)
+    area, hull_area = cv2.contourArea(contour), cv2.contourArea(hull)
+    m = cv2.moments(contour)
+    if area == 0 or m['m00'] == 0:
+        x, y, w, h = cv2.boundingRect(contour)
+        return (x + w / 2, y + h / 2), 0.0
+    cx, cy = m['m10'] / m['m00'], m['m01'] / m['m00']
+    circularity = 4 * np.pi * hull_area / cv2.arcLength(hull, True) ** 2
+    compactness = min(circularity, 1.0) * area / hull_area
+
+    # Blob and ring masks in a window around the blob only
+    outer = np.sqrt(area / np.pi) * (1 + RING_WIDTH)
+    im_h, im_w = gray.shape
+    x1, y1 = max(int(cx - outer), 0), max(int(cy - outer), 0)
+    x2, y2 = min(int(cx + outer) + 1, im_w), min(int(cy + outer) + 1, im_h)
+    window = median[y1:y2, x1:x2]
+    blob = np.zeros(window.shape, dtype="uint8")
+    cv2.drawContours(blob, [contour], -1, 255, -1, offset=(-x1, -y1))
+    ring = np.zeros(window.shape, dtype="uint8")
+    cv2.circle(ring, (round(cx - x1), round(cy - y1)), round(outer), 255, -1)
+    ring[blob > 0] = 0
+    if not ring.any():
+        return (cx, cy), 0.0
+    contrast = window[blob > 0].mean() - window[ring > 0].mean()
+    return (cx, cy), compactness * float(np.clip(contrast / CONTRAST_REF,
+                                                 0, 1))
+
+
+def has_cropONH(file, save=True):
+    ''' Check if image has been cropped before (region and crop file) '''
+    load_crop_region(file)
+    return file in crop_regions and (not save or file in pending_writes
+                                     or exists(get_crop_path(file)))
+
+
+@traced(image_arg=0)
+def get_cropONH(file, token=None, save=True, view='bgr'):
+    ''' Crop ONH of an image
+        Returns (hasCrop, region, crop), the crop is a view of the decoded
+        image (no copy). Regions are recorded in the image index, and the
+        crop file is written in background if save is set (see
+        flush_crops).
+    '''
     try:
-        original = Image.open(file)
-        crop_img = original.crop(region)
-        crop_img = np.array(crop_img)
-        cv2.imwrite(get_crop_path(file),
-                    cv2.cvtColor(crop_img, cv2.COLOR_RGB2BGR))
-        return True, region
+        image = open_image(file)
+        # Reuse region if image has been cropped before
+        load_crop_region(file)
+        region = crop_regions.get(file)
+        if region is None:
+            region = crop_regions[file] = cropONH(file, token, image)
+            writer.submit(save_crop_region, file, region)
+        if save and not has_cropONH(file):
+            future = writer.submit(write_crop, file, image.roi(region, 'bgr'))
+            pending_writes[file] = future
+            future.add_done_callback(lambda _: pending_writes.pop(file, None))
+        return True, region, image.roi(region, view)
     except FileNotFoundError:
-        return False, None
+        return False, None, None
+
+
+def write_crop(file, crop):
+    ''' Write crop file of an image (writer thread) '''
+    path = get_crop_path(file)
+    makedirs(path.rsplit('/', 1)[0], exist_ok=True)
+    if not cv2.imwrite(path, crop):
+        print(f'ERROR: Could not write {path}')
+
+
+def flush_crops():
+    ''' Wait for crop files and regions being written '''
+    writer.submit(lambda: None).result()
+
+
+def get_crop_region(file):
+    ''' Get region of an image cropped before (None if not cropped) '''
+    load_crop_region(file)
+    return crop_regions.get(file)
+
+
+def load_crop_region(file):
+    ''' Load region of an image from the image index '''
+    if file not in crop_regions:
+        record = get_index().get(file)
+        if record is not None and record['crop'] is not None:
+            crop_regions[file] = record['crop']
+
+
+def save_crop_region(file, region):
+    ''' Record region of an image in the image index (writer thread) '''
+    try:
+        get_index().update(file, crop=region)
+    except (OSError, sqlite3.Error) as error:
+        print(f'ERROR: Could not update image index: {error}')
+
+
+def save_metrics(file, fields):
+    ''' Record metrics of an image in the image index (write-behind)
+        Updates queued before the writer gets to them are merged, so only
+        the latest fields of an image are written.
+    '''
+    with metrics_lock:
+        queued = file in pending_metrics
+        pending_metrics[file] = dict(pending_metrics.get(file, {}), **fields)
+    if not queued:
+        writer.submit(write_metrics, file)
+
+
+def write_metrics(file):
+    ''' Write pending metrics of an image (writer thread) '''
+    with metrics_lock:
+        fields = pending_metrics.pop(file)
+    try:
+        get_index().update(file, **fields)
+    except (OSError, sqlite3.Error) as error:
+        print(f'ERROR: Could not update image index: {error}')
 
 
 def get_crop_path(file):
@@ -137,4 +277,5 @@ def get_crop_path(file):
 if __name__ == '__main__':
     file = 'glaucoma-cases/V0001.jpg'
     print(get_crop_path(file))
-    save_cropONH(file)
+    print(get_cropONH(file)[:2])
+    flush_crops()
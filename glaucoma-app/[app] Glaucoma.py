@@ -1,12 +1,30 @@
 from PyQt5 import QtCore, QtGui, QtWidgets
 from qtpy import uic
 from cv2 import imread
-from ONH_Detection import get_cropONH, get_crop_path
-from threading import Timer
+from ONH_Detection import get_cropONH, has_cropONH, flush_crops
+from ONH_Detection import get_crop_region, save_metrics
+from fundus import open_image
+from evaluation import list_images
+from image_index import get_index
+from project import save_project, load_project, ProjectError, PROJECT_EXT
+from session import Session
+from pyramid import ImagePyramid, sample_region
+from detection_rate_model import normalize_sample_data as normalize_data
+import startup
 from gui_utils import edit_contrast, edit_image_of, grayscale_color
-from gui_utils import qImage_to_cvImage, cvImage_to_qImage, blur_qImage
-from gui_utils import colorize_mask, get_boundaries_info
-from shapes import Circle, Ellipse
+from gui_utils import cvImage_to_qImage, blur_qImage
+from gui_utils import colorize_mask, get_boundaries_info, fit_mask_ellipses
+from jobs import JobManager, PRIORITY_LOW
+import tracing
+from tracing import span, traced
+from inference import request_mask, is_running as inference_running
+from os.path import exists
+from shapes import Circle, Ellipse, ShapeStore, ellipse_axes, isnt_widths
+from shapes import KIND_NONE, KIND_CIRCLE, KIND_ELLIPSE, KIND_HANDLES
+from shapes import MAX_HANDLES, LAYER_SHAPES
+from math import sqrt, degrees
+import numpy as np
+import cv2
 # --------------------------------------------------------------------------- #
 #                                    Colors                                   #
 # --------------------------------------------------------------------------- #
@@ -31,9 +49,12 @@ T_MANUAL = 'Manual #'
 T_AUTOMATIC = 'Automatic #'
 T_INFO_EMPTY = '- - - - - - - -'
 T_BTN_EMPTY = '- - - - -'
+T_MODEL_LOADING = 'loading...'
+T_MODEL_READY = 'ready'
+T_MODEL_ERROR = 'load error'
 # Flags
 MASK_DISABLED, MASK_MANUAL, MASK_AUTOMATIC = 0, 1, 2
-ZOOM_DISABLED, ZOOM_OUT, ZOOM_IN = 0, 1, 2
+ZOOM_DISABLED, ZOOM_OUT, ZOOM_IN, ZOOM_FREE = 0, 1, 2, 3
 EDIT_HUE, EDIT_SAT, EDIT_BRI = 0, 1, 2
 # Shapes Parameters
 OUTLINE_WIDTH = 2
@@ -43,9 +64,26 @@ VIS_THRESHOLD = 6
 POINT_SIZE = 10
 GRAB_AREA = 8
 DEFAULT_RADII = (100, 60)
+# Prefetch (number of neighboring images before/after opened image)
+PREFETCH_NEIGHBORS = 1
+# Background jobs (crop and segmentation of the opened image and of its
+# neighbors)
+MAX_BACKGROUND = 2 * (1 + 2 * PREFETCH_NEIGHBORS)
+# Write cropped images (crop/*_mod.jpg) besides the images (the viewer
+# samples zoomed-in views from the image pyramid, it does not need them)
+SAVE_CROPS = False
+# Zoom factor of one mouse wheel step and maximum zoom (screen pixels per
+# image pixel)
+ZOOM_STEP = 1.25
+MAX_ZOOM = 8
+# Default values of hue, brightness, saturation, contrast, disc/cup alpha
+DEFAULT_SLIDERS = (-255, 0, 0, 0, 90, 100)
 # Constants
 BLUR_KSIZE = (40, 40)
 CDR_THRES = 0.65
+# Refresh interval of the trace stats panel (ms)
+TRACE_REFRESH = 1000
+TRACE_COLUMNS = ('Span', 'Count', 'Mean ms', 'p50 ms', 'p95 ms', 'Last ms')
 
 
 class Redraw(QtCore.QObject):
@@ -72,57 +110,75 @@ class Redraw(QtCore.QObject):
         win.info_update_all()
 
 
-def cropOHN_thread():
-    ''' Thread: Crop ONH '''
-    # Get ImageViewer reference
-    img = win.qImage
-    # Check if ImageViewer has not cropped image
-    if not img.hasCrop:
-        # Update hasCrop flag and get cropped region
-        img.hasCrop, img.region = get_cropONH(img.filename)
-        # Hide progress bar (loading)
-        win.mw_end_wait_for()
-        # Check if hasCrop is True after get_cropONH
-        if img.hasCrop:
-            # Load cropped QImage
-            image = QtGui.QImage(get_crop_path(img.filename))
-            # Set zoomed-in QPixmap and zoomed-in size
-            img.zoomed_in = QtGui.QPixmap.fromImage(image)
-            img.zoomInSize = img.zoomed_in.size().width()
-            # Enable mouse tracking
-            img.setMouseTracking(True)
-    # Check if ImageViewer has cropped image
-    if img.hasCrop:
-        # Set ImageViewer zoom to zoomed-in and update QPixmap
-        img.isZoomed = True
-        img.pixmap = img.zoomed_in
-        # Respawn shapes if not already spawned
-        img.respawn()
-
-
-def segmentation_thread():
-    ''' Thread: Image Segmentation (mask creation) '''
-    # Get ImageViewer reference
-    qimg = win.qImage
-    # Load MNetMask function
-    from mnet_segmentation import MNetMask
-    # Try to create segmented mask and get directory
-    output = MNetMask(qimg.filename.split('/')[-1])
-    # Check if segmentation output is a string
-    if isinstance(output, str):
-        # Set hasMask
-        qimg.hasMask = True
-        # Read mask zoomed-out
-        qimg.mask_out = imread(output)
-        # Activate automatic layer info (disc/cup as defined)
-        qimg.redraw.layer.emit()
+def crop_job(filename, token):
+    ''' Job: Crop ONH (runs on JobManager thread pool) '''
+    # Get cropped region (crop file is written in background if saved)
+    hasCrop, region, _ = get_cropONH(filename, token, SAVE_CROPS)
+    return hasCrop, region
+
+
+def segmentation_job(filename, token):
+    ''' Job: Image Segmentation (runs on JobManager thread pool) '''
+    name = filename.split('/')[-1]
+    # Use the inference server if it is running (no TF import), segment
+    # in-process if it does not answer in time
+    reply = request_mask(name)
+    if reply is not None:
+        output = reply['output'] if reply['ok'] else False
     else:
-        # Reset hasMask
-        qimg.hasMask = False
-    # Hide progress bar (loading)
-    win.mw_end_wait_for()
-    # Redraw ImageViewer
-    qimg.redraw.run.emit()
+        # Load MNetMask function
+        from mnet_segmentation import MNetMask
+        # Try to create segmented mask and get directory (in-process, the
+        # server has been asked already)
+        output = MNetMask(name, token, server=False)
+    # Check if segmentation output is a string
+    if not isinstance(output, str):
+        return None
+    # Record mask location of the image
+    get_index().update(filename, mask=output)
+    # Read mask zoomed-out and fit disc/cup ellipses
+    mask = imread(output)
+    return mask, fit_mask_ellipses(mask)
+
+
+def get_mask_path(filename):
+    ''' Get segmented mask filename of an image '''
+    # Split filename
+    lst = filename.split('/')[-2:]
+    # Insert masks folder
+    lst.insert(1, 'masks')
+    # Create mask filename
+    return '/'.join(lst)[:-3] + 'png'
+
+
+def get_neighbor_files(filename, count=PREFETCH_NEIGHBORS):
+    ''' Get images before/after an image in the same folder '''
+    folder, name = filename.rsplit('/', 1)
+    files = [f.rsplit('/', 1)[1] for f in list_images(folder)]
+    if name not in files:
+        return []
+    idx = files.index(name)
+    neighbors = files[idx+1:idx+1+count] + files[max(idx-count, 0):idx]
+    return [f'{folder}/{f}' for f in neighbors]
+
+
+def prefetch(filename):
+    ''' Crop and segment an image (and its neighbors) in background
+        Results are saved in the crop and mask caches, so zooming and
+        adding automatic layers do not wait for them later.
+    '''
+    for file in [filename] + get_neighbor_files(filename):
+        jobs = []
+        if not has_cropONH(file, SAVE_CROPS):
+            jobs.append(('crop', crop_job))
+        if not exists(get_mask_path(file)):
+            jobs.append(('segmentation', segmentation_job))
+        for name, fn in jobs:
+            # Stop when the background queue is full (nearest images are
+            # queued first)
+            if win.jobs.submit(name, fn, file, image=file,
+                               priority=PRIORITY_LOW) is None:
+                return
 
 
 class ImageViewer(QtWidgets.QLabel):
@@ -143,12 +199,10 @@ class ImageViewer(QtWidgets.QLabel):
         self.init_pen()
         # Save parent reference (for background color changes)
         self.area = area
-        # Create default QPixmap (The only image that is drawn to screen)
-        self.pixmap = QtGui.QPixmap()
-        # Create zoomed-in and out for quick switching
-        self.zoomed_in, self.zoomed_out = QtGui.QPixmap(), QtGui.QPixmap()
-        # Create hasGrab flag and grabObj reference
-        self.hasGrab, self.grabObj = False, None
+        # Create hasGrab flag and grabObj (and its shape) reference
+        self.hasGrab, self.grabObj, self.grabShape = False, None, None
+        # Mouse position of view panning (None if not panning)
+        self.panFrom = None
         # Reset all parameters
         self.reset_all()
 
@@ -157,21 +211,31 @@ class ImageViewer(QtWidgets.QLabel):
         self.isZoomed, self.loading = False, False
         self.hasImage, self.hasMask, self.hasCrop = False, False, False
         self.filename, self.region = None, None
-        self.zoomInSize, self.zoomOutSize = None, None
-        self.mask_out, self.mask_in = None, None
-        self.created_mask_in = False
+        # Image pyramid and shown region (x1, y1, x2, y2, image coordinates,
+        # fitted to the viewer)
+        self.pyramid, self.view_rect = None, None
+        # Shown image and mask QPixmaps of the view (key, QPixmap)
+        self.view_cache, self.mask_cache = None, None
+        self.mask_out = None
+        # Disc/cup ellipses fitted to the mask (image coordinates)
+        self.fitted = None
+        # Mask referenced by an opened project (loaded with its layer)
+        self.mask_file = None
         # Disable mouse tracking
         self.setMouseTracking(False)
 
     def check_if_mask_exists(self):
         ''' Check if image has already segmented mask '''
+        # Use mask referenced by the project
+        if self.mask_file is not None and exists(self.mask_file):
+            return True, self.mask_file
+        # Look up mask recorded in the image index
+        record = get_index().get(self.filename)
+        if record is not None and record['mask'] and exists(record['mask']):
+            return True, record['mask']
         try:
-            # Split filename
-            lst = self.filename.split('/')[-2:]
-            # Insert masks folder
-            lst.insert(1, 'masks')
             # Create mask filename
-            filename = '/'.join(lst)[:-3] + 'png'
+            filename = get_mask_path(self.filename)
             # Try to open the file if exists
             open(filename, 'r')
             # if open was successfuly, return True and the filename
@@ -189,8 +253,14 @@ class ImageViewer(QtWidgets.QLabel):
             # Set hasMask and activate layer disc/cup
             self.hasMask = True
             win.layers_activate_masks()
-            # Read segmented mask
-            self.mask_out = imread(filename)
+            # Read segmented mask and fit disc/cup ellipses (or use the
+            # session cache)
+            cached = win.session.cache.get((self.filename, 'mask'))
+            if cached is None:
+                mask = imread(filename)
+                cached = mask, fit_mask_ellipses(mask)
+                win.session.cache.put((self.filename, 'mask'), cached)
+            self.mask_out, self.fitted = cached
             # Update mask info
             win.info_update_all()
             # Redraw ImageViewer
@@ -202,31 +272,51 @@ class ImageViewer(QtWidgets.QLabel):
             self.loading, self.hasMask = True, False
             # Redraw ImageViewer
             self.redraw.run.emit()
-            # Run MNetSegmentation in another thread
-            Timer(0.01, segmentation_thread).start()
-
-    def toggle_zoom(self):
-        ''' Set zoom level of ImageViewer '''
-        # Check if ImageViewer level is zoomed-in
-        if self.isZoomed:
-            # Reset isZoomed
+            # Run MNetSegmentation in background
+            win.jobs.submit('segmentation', segmentation_job, self.filename,
+                            image=self.filename,
+                            callback=self.segmentation_done)
+
+    def segmentation_done(self, result):
+        ''' Segmentation job result (GUI thread) '''
+        # Check if segmentation has succeeded
+        if result is not None:
+            # Set hasMask, mask zoomed-out and fitted ellipses
+            self.hasMask = True
+            self.mask_out, self.fitted = result
+            win.session.cache.put((self.filename, 'mask'), result)
+            # Activate automatic layer info (disc/cup as defined)
+            self.redraw.layer.emit()
+        else:
+            # Reset hasMask
+            self.hasMask = False
+        # Hide progress bar (loading)
+        win.mw_end_wait_for()
+        # Redraw ImageViewer
+        self.redraw.run.emit()
+
+    def set_zoom(self, zoomed):
+        ''' Show cropped region (zoomed-in) or whole image (zoomed-out) '''
+        if not zoomed:
+            # Reset isZoomed and fit whole image
             self.isZoomed = False
-            # Select ImageViewer Pixmap to zoomed_out
-            self.pixmap = self.zoomed_out
+            self.fit_view()
             # Refresh ImageViewer background
             self.refresh()
         else:
-            # Check if you have not created cropped image
-            if not self.hasCrop:
+            # Check if the cropped region is not known yet
+            if not self.hasCrop and not self.load_crop_region():
                 # Wait for ONH_Detection and set loading
                 win.mw_wait_for('Detecting Fundus location in the image')
                 self.loading = True
-                # Start cropOHN thread
-                Timer(0.001, cropOHN_thread).start()
+                # Run ONH cropping in background
+                win.jobs.submit('crop', crop_job, self.filename,
+                                image=self.filename,
+                                callback=self.crop_done)
             else:
-                # Set isZoomed and select ImageViewer Pixmap to zoomed_in
+                # Set isZoomed and fit cropped region
                 self.isZoomed = True
-                self.pixmap = self.zoomed_in
+                self.fit_view(self.region)
                 # Refresh ImageViewer background
                 self.refresh()
                 # Redraw ImageViewer
@@ -234,6 +324,35 @@ class ImageViewer(QtWidgets.QLabel):
         # Set focus to force repainting
         self.setFocus(True)
 
+    def crop_done(self, result):
+        ''' Crop job result (GUI thread) '''
+        # Hide progress bar (loading)
+        win.mw_end_wait_for()
+        # Check if ImageViewer has not cropped region
+        if result is not None and not self.hasCrop and result[0]:
+            self.set_region(result[1])
+        # Check if ImageViewer has cropped region
+        if self.hasCrop:
+            # Set ImageViewer zoom to zoomed-in and fit cropped region
+            self.isZoomed = True
+            self.fit_view(self.region)
+            # Respawn shapes if not already spawned
+            self.respawn()
+
+    def load_crop_region(self):
+        ''' Use cropped region of the image index (if cropped before) '''
+        region = get_crop_region(self.filename)
+        if region is None:
+            return False
+        self.set_region(region)
+        return True
+
+    def set_region(self, region):
+        ''' Set cropped region (shapes are relative to its corner) '''
+        self.hasCrop, self.region = True, tuple(region)
+        # Enable mouse tracking
+        self.setMouseTracking(True)
+
     def get_image_file(self):
         # Open FileDialog to get an image
         qfd = QtWidgets.QFileDialog
@@ -249,88 +368,124 @@ class ImageViewer(QtWidgets.QLabel):
                 win.show_error('Image Load Error',
                                '<p>You cannot load <b>cropped image</b>.</p>')
             else:
-                # Set hasChanged
+                # Set hasChanged and show image (added to session)
                 win.isChanged = True
-                # Set hasImage and save filename and create a QImage
-                self.hasImage, self.filename = True, filename
-                qimage = QtGui.QImage(filename)
-                # Enable Image Enhancement, Zoom and Layers blocks
-                win.imageEnhancement_setEnabled(True)
-                win.zoom_setMode(ZOOM_OUT)
-                win.layers_setEnabled(True)
-                win.create_add_menu()
-                # Set zoomed_out and ImageViewer QPixmap
-                self.zoomed_out = QtGui.QPixmap.fromImage(qimage)
-                self.pixmap = self.zoomed_out
-                # Get zoomOutSize
-                self.zoomOutSize = self.zoomed_out.size().width()
-                # Refresh ImageViewer background
-                self.refresh()
-                # Enhance ImageViewer default QPixmap
-                win.enhance_image()
-
-    def forward_transformation(self, shape):
-        ''' Project shape onto screen '''
-        # Check if isZoommed
-        if self.isZoomed:
-            # Calculate scale factor
-            factor = self.imageSize/self.zoomInSize
-            # Transform the shape (scale and move)
-            shape.scale(factor)
-            shape.move(self.xdiff, self.ydiff)
-        else:
-            # Calculate scale factor
-            factor = self.imageSize/self.zoomOutSize
-            # Calculate region difference for zoomed-out image
-            rxdiff = round(self.region[0] * factor)
-            rydiff = round(self.region[1] * factor)
-            # Transform the shape (scale and move)
-            shape.scale(factor)
-            shape.move(self.xdiff + rxdiff,
-                       self.ydiff + rydiff)
-        # Return Transformed shape
-        return shape
+                win.switch_image(filename)
+
+    def open_file(self, filename):
+        ''' Show an image file (zoomed-out) '''
+        # Set hasImage and save filename and create a QImage
+        self.hasImage, self.filename = True, filename
+        # Drop jobs of the previous image
+        win.jobs.set_image(filename)
+        # Enable Image Enhancement, Zoom and Layers blocks
+        win.imageEnhancement_setEnabled(True)
+        win.zoom_setMode(ZOOM_OUT)
+        win.layers_setEnabled(True)
+        win.create_add_menu()
+        win.setWindowTitle(f'{win.title} - {filename.split("/")[-1]}')
+        # Get image pyramid (session cache, or built from decoded image that
+        # is shared with cropping and segmentation) and fit whole image
+        self.pyramid = win.session.cache.get((filename, 'pyramid'))
+        if self.pyramid is None:
+            self.pyramid = ImagePyramid(open_image(filename).bgr)
+            win.session.cache.put((filename, 'pyramid'), self.pyramid)
+        self.fit_view()
+        # Refresh ImageViewer background
+        self.refresh()
+        # Enhance ImageViewer default QPixmap
+        win.enhance_image()
+        # Start cropping and segmentation in background
+        prefetch(filename)
+
+    def fit_view(self, rect=None):
+        ''' Show region rect (x1, y1, x2, y2) fitted to the viewer (whole
+            image if rect is None)
+        '''
+        if rect is None:
+            rect = (0, 0) + self.pyramid.size
+        self.view_rect = tuple(float(v) for v in rect)
+
+    def view_geometry(self):
+        ''' Get view scale (screen pixels per image pixel) and origin (image
+            point at top-left of the viewer)
+        '''
+        width, height = self.width(), self.height()
+        x1, y1, x2, y2 = self.view_rect
+        scale = min(width / (x2 - x1), height / (y2 - y1))
+        ox = (x1 + x2) / 2 - width / scale / 2
+        oy = (y1 + y2) / 2 - height / scale / 2
+        return scale, ox, oy
+
+    def zoom_view(self, factor, mx, my):
+        ''' Zoom view by factor keeping image point at mouse(x, y) '''
+        scale, ox, oy = self.view_geometry()
+        # Image point at mouse(x, y)
+        px, py = ox + mx / scale, oy + my / scale
+        w, h = self.pyramid.size
+        scale = min(scale * factor, MAX_ZOOM)
+        # Zooming out stops at the whole image
+        if scale <= min(self.width() / w, self.height() / h):
+            self.set_zoom(False)
+            win.zoom_setMode(ZOOM_OUT)
+            return
+        ox, oy = px - mx / scale, py - my / scale
+        self.view_rect = (ox, oy, ox + self.width() / scale,
+                          oy + self.height() / scale)
+        win.zoom_setMode(ZOOM_FREE)
+
+    def pan_view(self, dx, dy):
+        ''' Move view by mouse(dx, dy) keeping its center on the image '''
+        scale = self.view_geometry()[0]
+        x1, y1, x2, y2 = self.view_rect
+        w, h = self.pyramid.size
+        cx = min(max((x1 + x2) / 2 - dx / scale, 0), w)
+        cy = min(max((y1 + y2) / 2 - dy / scale, 0), h)
+        rw, rh = (x2 - x1) / 2, (y2 - y1) / 2
+        self.view_rect = (cx - rw, cy - rh, cx + rw, cy + rh)
+        win.zoom_setMode(ZOOM_FREE)
+
+    def visible_view(self):
+        ''' Get visible image region, its size and position on screen
+            (None if no part of the image is visible)
+        '''
+        scale, ox, oy = self.view_geometry()
+        w, h = self.pyramid.size
+        x1, y1 = max(ox, 0), max(oy, 0)
+        x2 = min(ox + self.width() / scale, w)
+        y2 = min(oy + self.height() / scale, h)
+        if x2 <= x1 or y2 <= y1:
+            return None
+        px, py = round((x1 - ox) * scale), round((y1 - oy) * scale)
+        size = (max(round((x2 - ox) * scale) - px, 1),
+                max(round((y2 - oy) * scale) - py, 1))
+        return (x1, y1, x2, y2), size, QtCore.QPoint(px, py)
+
+    def screen_transform(self):
+        ''' Get affine transformation (factor, xdiff, ydiff) onto screen '''
+        # No transformation if the region is not defined yet
+        if self.region is None:
+            return 1, 0, 0
+        scale, ox, oy = self.view_geometry()
+        # Move by region position relative to view origin
+        return (scale, round((self.region[0] - ox) * scale),
+                round((self.region[1] - oy) * scale))
 
     def inverse_tranformation(self, mx, my):
         ''' Project point from screen to original size '''
-        # Check if isZoomed
-        if self.isZoomed:
-            # Calculate factor
-            factor = self.zoomInSize / self.imageSize
-            # Calculate tx, ty (final transformed point)
-            tx, ty = mx - self.xdiff, my - self.ydiff
-        else:
-            # Calculate factor
-            factor = self.zoomOutSize / self.imageSize
-            # Calculate region differences
-            rxdiff, rydiff = self.region[0] / factor, self.region[1] / factor
-            # Calculate tx, ty (final transformed point)
-            tx, ty = mx - (self.xdiff + rxdiff), my - (self.ydiff + rydiff)
-        # Return scaled tranformed point (last transformation step)
-        return round(tx * factor), round(ty * factor)
+        scale, ox, oy = self.view_geometry()
+        # Image point at mouse(x, y) relative to the region position
+        return (round(ox + mx / scale - self.region[0]),
+                round(oy + my / scale - self.region[1]))
 
     def get_layer_points(self):
-        ''' Get points of current selected layer projected onto screen '''
-        # Create empty lists for centers and radii
-        centers, radii = [], []
+        ''' Get handles of current selected layer projected onto screen '''
         # Make sure there is a layer that is selected
-        if win.current != -1:
-            # Loop over disc/cup of current layer
-            for dsc_cup, shape in enumerate(win.shapes[win.current]):
-                # Check if shape is a circle
-                if isinstance(shape, Circle):
-                    # Get transformed shape using a copy
-                    transCircle = self.forward_transformation(shape.copy())
-                    # Add circle center point to centers
-                    centers.append((dsc_cup, transCircle.c))
-                    # Add circle radius point to radii
-                    radii.append((dsc_cup, transCircle.r))
-                # Check if shape is an ellipse
-                elif isinstance(shape, Ellipse):
-                    # TODO: Not implemented yet
-                    pass
-        # Return centers and radii points
-        return centers, radii
+        if win.current == -1:
+            return None
+        # Project handles of all layers at once, then select current layer
+        handles = win.shapes.transform(*self.screen_transform())
+        return handles[win.current]
 
     def get_visibility_flag(self, dsc_cup):
         ''' Get visibility flag of disc/cup layer '''
@@ -342,61 +497,46 @@ class ImageViewer(QtWidgets.QLabel):
             # Return True if cup_alpha slider value is bigger than threshold
             return win.qS_cup_alpha.value() > VIS_THRESHOLD
 
+    def get_handle_at(self, mx, my):
+        ''' Get (disc/cup, handle) of the visible point at mouse(x, y) '''
+        # Get layer points
+        handles = self.get_layer_points()
+        if handles is None:
+            return None
+        # Check which handles are in mouse(x, y) range
+        near = np.all(np.abs(handles - (mx, my)) <= GRAB_AREA, axis=2)
+        # Ignore unused handles of each shape kind
+        kinds = win.shapes.layer_kinds(win.current)
+        near &= np.arange(MAX_HANDLES) < KIND_HANDLES[kinds][:, None]
+        # Ignore points that are not visible to be selected
+        for dsc_cup in range(LAYER_SHAPES):
+            if not self.get_visibility_flag(dsc_cup):
+                near[dsc_cup] = False
+        # Centers come first, then radius/axis points
+        hits = np.argwhere(near.T)
+        if len(hits) == 0:
+            return None
+        handle, dsc_cup = hits[0]
+        return dsc_cup, handle
+
     def setGrabObject(self, mx, my):
         ''' Grab object if mouse(x, y) is in range '''
-        # Get layer points
-        centers, radii = self.get_layer_points()
-        # Loop over center points
-        for dsc_cup, center in centers:
-            # Check if center is in mouse(x, y) range
-            if center.isIn(mx, my, GRAB_AREA):
-                # Check if points are visible to be selected
-                if self.get_visibility_flag(dsc_cup):
-                    # Set hasGrab
-                    self.hasGrab = True
-                    # Set grabObj reference
-                    self.grabObj = win.shapes[win.current][dsc_cup].c
-                    # Exit function
-                    return
-        # Loop over radius points
-        for dsc_cup, radius in radii:
-            # Check if center is in mouse(x, y) range
-            if radius.isIn(mx, my, GRAB_AREA):
-                # Check if points are visible to be selected
-                if self.get_visibility_flag(dsc_cup):
-                    # Set hasGrab
-                    self.hasGrab = True
-                    # Set grabObj reference
-                    self.grabObj = win.shapes[win.current][dsc_cup].r
-                    # Exit function
-                    return
+        hit = self.get_handle_at(mx, my)
+        if hit is not None:
+            dsc_cup, handle = hit
+            # Set hasGrab and grabObj reference (a view over the store)
+            self.hasGrab = True
+            self.grabShape = win.shapes[win.current][dsc_cup]
+            self.grabObj = self.grabShape.handles()[handle]
 
     def setHoverCursor(self, mx, my):
         ''' Change mouse to pointing hand if mouse(x, y) is in range '''
-        # Get layer points
-        centers, radii = self.get_layer_points()
-        # Loop over center points
-        for dsc_cup, center in centers:
-            # Check if center is in mouse(x, y) range
-            if center.isIn(mx, my, GRAB_AREA):
-                # Check if points are visible to be selected
-                if self.get_visibility_flag(dsc_cup):
-                    # Set mouse cursor to pointing hand
-                    self.setCursor(QtGui.QCursor(QtCore.Qt.PointingHandCursor))
-                    # Exit function
-                    return
-        # Loop over radius points
-        for dsc_cup, radius in radii:
-            # Check if center is in mouse(x, y) range
-            if radius.isIn(mx, my, GRAB_AREA):
-                # Check if points are visible to be selected
-                if self.get_visibility_flag(dsc_cup):
-                    # Set mouse cursor to pointing hand
-                    self.setCursor(QtGui.QCursor(QtCore.Qt.PointingHandCursor))
-                    # Exit function
-                    return
-        # Set mouse cursor to arrow
-        self.setCursor(QtGui.QCursor(QtCore.Qt.ArrowCursor))
+        if self.get_handle_at(mx, my) is not None:
+            # Set mouse cursor to pointing hand
+            self.setCursor(QtGui.QCursor(QtCore.Qt.PointingHandCursor))
+        else:
+            # Set mouse cursor to arrow
+            self.setCursor(QtGui.QCursor(QtCore.Qt.ArrowCursor))
 
     def mousePressEvent(self, event):
         ''' ImageViewer MousePressEvent '''
@@ -407,46 +547,66 @@ class ImageViewer(QtWidgets.QLabel):
         else:
             # Set grabObj if mouse(x, y) over a point
             self.setGrabObject(event.x(), event.y())
+            # Otherwise start panning the view
+            if not self.hasGrab and not self.loading:
+                self.panFrom = event.pos()
+                self.setCursor(QtGui.QCursor(QtCore.Qt.ClosedHandCursor))
 
     def mouseReleaseEvent(self, event):
         ''' ImageViewer mouseReleaseEvent '''
-        # Reset hasGrab
+        # Reset hasGrab and panning
         self.hasGrab = False
+        if self.panFrom is not None:
+            self.panFrom = None
+            self.setCursor(QtGui.QCursor(QtCore.Qt.ArrowCursor))
+
+    def wheelEvent(self, event):
+        ''' ImageViewer wheelEvent (zoom around mouse position) '''
+        if self.hasImage and not self.loading:
+            steps = event.angleDelta().y() / 120
+            self.zoom_view(ZOOM_STEP ** steps, event.x(), event.y())
+            self.refresh()
+            self.repaint()
 
     def mouseMoveEvent(self, event):
         ''' ImageViewer mouseMoveEvent '''
         # Get mouse(x, y)
         mx, my = event.x(), event.y()
+        # Check if panning the view
+        if self.panFrom is not None:
+            delta = event.pos() - self.panFrom
+            self.panFrom = event.pos()
+            self.pan_view(delta.x(), delta.y())
+            self.repaint()
         # Check if not hasGrab
-        if not self.hasGrab:
+        elif not self.hasGrab:
             # Set hover cursor if mouse(x, y) over a point
             self.setHoverCursor(mx, my)
         else:
             # Set grabObj position by inverse transformation of mouse(x, y)
             self.grabObj.x, self.grabObj.y = self.inverse_tranformation(mx, my)
+            # Keep ellipse axes perpendicular
+            if isinstance(self.grabShape, Ellipse):
+                self.grabShape.orthogonalize(self.grabObj)
             # Redraw ImageViewer
             self.repaint()
             # Update info of current layer
             win.info_update_all()
 
     def paintEvent(self, event):
+        with span('paint', self.filename):
+            self.paint(event)
+
+    def paint(self, event):
         painter = QtGui.QPainter(self)
         painter.setRenderHint(QtGui.QPainter.Antialiasing)
 
-        if self.loading or self.hasImage:
-            labelSize = self.size()
-            scaledPix = self.pixmap.scaled(labelSize,
-                                           QtCore.Qt.KeepAspectRatio,
-                                           QtCore.Qt.SmoothTransformation)
-            imageSize = scaledPix.size()
-
-            x1, y1 = labelSize.width(), labelSize.height()
-            x2, y2 = imageSize.width(), imageSize.height()
-
-            self.xdiff, self.ydiff = (x1 - x2) // 2, (y1 - y2) // 2
-            self.imageSize = x2
-
-            point = QtCore.QPoint(self.xdiff, self.ydiff)
+        if (self.loading or self.hasImage) and self.pyramid is not None:
+            view = self.visible_view()
+            if view is None:
+                return
+            rect, size, point = view
+            scaledPix = self.view_pixmap(rect, size)
 
             if self.loading:
                 self.setLoading(painter, point, scaledPix)
@@ -457,40 +617,40 @@ class ImageViewer(QtWidgets.QLabel):
                     if layer:
                         self.draw_shapes(painter)
                     else:
-                        self.show_mask(painter, point)
+                        self.show_mask(painter, rect, size, point)
         else:
             painter.setBrush(QtGui.QColor(COL_FRAME))
             painter.drawText(event.rect(),
                              QtCore.Qt.AlignCenter,
                              self.text())
 
-    def show_mask(self, painter, point):
+    @traced()
+    def view_pixmap(self, rect, size):
+        ''' Get enhanced QPixmap of the visible region (sampled from the
+            image pyramid, kept until the view or the enhancement changes)
+        '''
+        key = rect, size
+        if self.view_cache is None or self.view_cache[0] != key:
+            cv2i = win.enhance_view(self.pyramid.sample(rect, size))
+            self.view_cache = key, QtGui.QPixmap(cvImage_to_qImage(cv2i))
+        return self.view_cache[1]
+
+    @traced()
+    def show_mask(self, painter, rect, size, point):
         if self.hasMask:
-            labelSize = self.size()
             disc_alpha = win.qS_disc_alpha.value()
             cup_alpha = win.qS_cup_alpha.value()
-
-            if self.isZoomed:
-                if self.hasCrop is True and self.created_mask_in is False:
-                    self.created_mask_in = True
-                    x, y, xf, yf = self.region
-                    w, h = xf - x, yf - y
-                    self.mask_in = self.mask_out[y:y+h, x:x+w].copy()
-
-                qi = colorize_mask(self.mask_in, None,
+            # Colorize visible region of the mask only
+            key = (rect, size, disc_alpha, cup_alpha,
+                   win.disc_color, win.cup_color)
+            if self.mask_cache is None or self.mask_cache[0] != key:
+                mask = sample_region(self.mask_out, rect, size,
+                                     cv2.INTER_NEAREST)
+                qi = colorize_mask(mask, None,
                                    disc_alpha, cup_alpha,
                                    win.disc_color, win.cup_color)
-            else:
-                scale = min(labelSize.width(), labelSize.height())
-                qi = colorize_mask(self.mask_out, scale,
-                                   disc_alpha, cup_alpha,
-                                   win.disc_color, win.cup_color)
-
-            pixmap = QtGui.QPixmap(qi)
-            scaledPix = pixmap.scaled(labelSize,
-                                      QtCore.Qt.KeepAspectRatio,
-                                      QtCore.Qt.SmoothTransformation)
-            painter.drawPixmap(point, scaledPix)
+                self.mask_cache = key, QtGui.QPixmap(qi)
+            painter.drawPixmap(point, self.mask_cache[1])
 
     def setLoading(self, painter, point, pixmap):
         msg = T_LOADING
@@ -508,6 +668,7 @@ class ImageViewer(QtWidgets.QLabel):
         painter.fillPath(painterPath, QtGui.QColor('#FFFFFF'))
         painter.end()
 
+    @traced()
     def draw_shapes(self, painter):
         para = [[win.qCB_disc_outline.isChecked(),
                  win.qS_disc_alpha.value(),
@@ -519,41 +680,50 @@ class ImageViewer(QtWidgets.QLabel):
         para[0][2].setAlpha(para[0][1])
         para[1][2].setAlpha(para[1][1])
 
-        centers, radii = [], []
-
         if win.current != -1:
-            for i, shape in enumerate(win.shapes[win.current]):
-                if isinstance(shape, Circle):
-                    transCircle = shape.copy()
-                    if self.isZoomed:
-                        transCircle.scale(self.imageSize / self.zoomInSize)
-                        transCircle.move(self.xdiff, self.ydiff)
-                    elif self.region is not None:
-                        factor = self.imageSize / self.zoomOutSize
-                        xxdiff = int(self.region[0] * factor)
-                        yydiff = int(self.region[1] * factor)
-                        transCircle.scale(factor)
-                        transCircle.move(self.xdiff + xxdiff,
-                                         self.ydiff + yydiff)
-                    centers.append((transCircle.c.value(), para[i][1]))
-                    radii.append((transCircle.r.value(), para[i][1]))
+            # Project handles of current layer onto screen
+            handles = self.get_layer_points()
+            kinds = win.shapes.layer_kinds(win.current)
+
+            for i, kind in enumerate(kinds):
+                if kind == KIND_CIRCLE:
                     self.draw_circle(painter,
-                                     transCircle,
+                                     handles[i],
                                      para[i][0],
                                      para[i][1],
                                      para[i][2])
+                elif kind == KIND_ELLIPSE:
+                    self.draw_ellipse(painter,
+                                      handles[i],
+                                      para[i][0],
+                                      para[i][1],
+                                      para[i][2])
+
+            for i, kind in enumerate(kinds):
+                if kind != KIND_NONE:
+                    self.draw_crosshair(painter, handles[i, 0], para[i][1])
+
+            for i, kind in enumerate(kinds):
+                for point in handles[i, 1:KIND_HANDLES[kind]]:
+                    self.draw_point(painter, point, para[i][1])
+
+    def draw_circle(self, painter, handles, cb, sld, col):
+        (cx, cy), (rx, ry) = handles[:2].tolist()
+        dia = round(2 * sqrt((cx - rx) ** 2 + (cy - ry) ** 2))
+        rad = dia // 2
+        pen = self.qOutlinePen if sld > VIS_THRESHOLD else self.qNoPen
 
-            for center in centers:
-                self.draw_crosshair(painter, center[0], center[1])
+        if cb:
+            self.qOutlinePen.setWidth(OUTLINE_WIDTH)
+            painter.setPen(pen)
+        else:
+            painter.setPen(self.qNoPen)
 
-            for radius in radii:
-                self.draw_point(painter, radius[0], radius[1])
+        painter.setBrush(col)
+        painter.drawEllipse(cx-rad, cy-rad, dia, dia)
 
-    def draw_circle(self, painter, circle, cb, sld, col):
-        dia = circle.dia()
-        rad = dia // 2
-        (cx, cy) = circle.center()
-        (rx, ry) = circle.radius()
+    def draw_ellipse(self, painter, handles, cb, sld, col):
+        (cx, cy), a, b, theta = ellipse_axes(handles)
         pen = self.qOutlinePen if sld > VIS_THRESHOLD else self.qNoPen
 
         if cb:
@@ -563,11 +733,15 @@ class ImageViewer(QtWidgets.QLabel):
             painter.setPen(self.qNoPen)
 
         painter.setBrush(col)
-        painter.drawEllipse(cx-rad, cy-rad, dia, dia)
+        painter.save()
+        painter.translate(cx, cy)
+        painter.rotate(degrees(theta))
+        painter.drawEllipse(QtCore.QPointF(0, 0), a, b)
+        painter.restore()
 
     def draw_crosshair(self, painter, point, sld):
         if sld > VIS_THRESHOLD:
-            cx, cy = point
+            cx, cy = int(point[0]), int(point[1])
             cross = CROSSHAIR_LENGTH // 2
             self.qOutlinePen.setWidth(CROSSHAIR_WIDTH)
             painter.setPen(self.qOutlinePen)
@@ -576,7 +750,7 @@ class ImageViewer(QtWidgets.QLabel):
 
     def draw_point(self, painter, point, sld):
         if sld > VIS_THRESHOLD:
-            cx, cy = point
+            cx, cy = int(point[0]), int(point[1])
             rad = POINT_SIZE // 2
             self.qOutlinePen.setWidth(1)
             painter.setPen(self.qOutlinePen)
@@ -594,7 +768,8 @@ class ImageViewer(QtWidgets.QLabel):
 
     def respawn(self):
         if win.current != -1 and self.hasCrop:
-            for i, shape in enumerate(win.shapes[win.current]):
+            layer = win.shapes[win.current]
+            for i, shape in enumerate(layer):
                 if isinstance(shape, Circle):
                     if not shape.used:
                         shape.used = True
@@ -602,6 +777,16 @@ class ImageViewer(QtWidgets.QLabel):
                         (rx, ry) = (256 + DEFAULT_RADII[i], 256)
                         (shape.c.x, shape.c.y) = cx, cy
                         (shape.r.x, shape.r.y) = rx, ry
+                elif isinstance(shape, Ellipse):
+                    if not shape.used:
+                        shape.used = True
+                        if layer.pop_fitted(i):
+                            # Fitted ellipses are in image coordinates
+                            shape.move(-self.region[0], -self.region[1])
+                        else:
+                            (shape.c.x, shape.c.y) = 256, 256
+                            (shape.i.x, shape.i.y) = 256 + DEFAULT_RADII[i], 256
+                            (shape.j.x, shape.j.y) = 256, 256 + DEFAULT_RADII[i]
         win.info_update_all()
         self.redraw.run.emit()
 
@@ -615,6 +800,46 @@ class ImageViewer(QtWidgets.QLabel):
             self.area.setStyleSheet(f'background-color: {COL_FRAME};')
 
 
+class TraceStats(QtWidgets.QDialog):
+    ''' Rolling stats of recorded spans (refreshed while shown) '''
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.setWindowTitle('Trace Stats')
+        self.resize(560, 420)
+        self.table = QtWidgets.QTableWidget(0, len(TRACE_COLUMNS), self)
+        self.table.setHorizontalHeaderLabels(TRACE_COLUMNS)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.verticalHeader().hide()
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.table)
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        self.refresh()
+        self.timer.start(TRACE_REFRESH)
+        super().showEvent(event)
+
+    def hideEvent(self, event):
+        self.timer.stop()
+        super().hideEvent(event)
+
+    def refresh(self):
+        # Slowest spans (mean) first
+        rows = sorted(tracing.stats().items(),
+                      key=lambda item: -item[1]['mean_ms'])
+        self.table.setRowCount(len(rows))
+        for row, (name, stat) in enumerate(rows):
+            values = (name, str(stat['count'])) + tuple(
+                f'{stat[k]:.2f}' for k in ('mean_ms', 'p50_ms', 'p95_ms',
+                                           'last_ms'))
+            for col, value in enumerate(values):
+                self.table.setItem(row, col,
+                                   QtWidgets.QTableWidgetItem(value))
+
+
 class MainWindow(QtWidgets.QMainWindow):
     def __init__(self, ui_file, parent=None):
         super(MainWindow, self).__init__(parent)
@@ -627,6 +852,8 @@ class MainWindow(QtWidgets.QMainWindow):
         self.menu_set_dark_mode(self.theme)
         self.connect_signals()
         self.create_main_variables()
+        self.create_session_menu()
+        self.create_trace_menu()
 
         self.qImage = ImageViewer(area=self.qV, replace=self.qImage)
         self.qV.setWidget(self.qImage)
@@ -650,9 +877,49 @@ class MainWindow(QtWidgets.QMainWindow):
         self.statusBar().addPermanentWidget(self.progressBarLabel, 1)
         self.statusBar().addPermanentWidget(self.progressBar, 1)
 
+        # Models status (shown in status bar)
+        self.models_status = {'CDR': T_MODEL_LOADING, 'MNet': T_MODEL_LOADING}
+        self.modelsLabel = QtWidgets.QLabel()
+        self.statusBar().addPermanentWidget(self.modelsLabel)
+        self.models_update_status()
+
+        # Background jobs (cropping, segmentation and models loading)
+        self.jobs = JobManager(workers=3, max_background=MAX_BACKGROUND)
+
         self.showMaximized()
 
-        Timer(0.1, load_models).start()
+        # Load models after the window has been shown
+        QtCore.QTimer.singleShot(0, self.load_models)
+
+    def load_models(self):
+        ''' Load and warm models in background (no TF import on startup) '''
+        self.jobs.submit('cdr model', cdr_model_job,
+                         callback=self.cdr_model_loaded)
+        self.jobs.submit('mnet warmup', mnet_warmup_job,
+                         callback=self.mnet_warmed_up)
+
+    def models_update_status(self):
+        ''' Show models status in status bar '''
+        self.modelsLabel.setText('  |  '.join(f'{name}: {status}' for
+                                              name, status in
+                                              self.models_status.items()))
+
+    def cdr_model_loaded(self, result):
+        ''' CDR model job result (GUI thread) '''
+        global cdr_model
+        cdr_model = result
+        loaded = result is not None and result.model is not None
+        self.models_status['CDR'] = T_MODEL_READY if loaded else T_MODEL_ERROR
+        self.models_update_status()
+        startup.mark('CDR model ready')
+        # Update info of current layer using loaded model
+        self.info_update_all()
+
+    def mnet_warmed_up(self, result):
+        ''' MNet warmup job result (GUI thread) '''
+        self.models_status['MNet'] = T_MODEL_READY if result else T_MODEL_ERROR
+        self.models_update_status()
+        startup.mark('MNet models ready')
 
     def mw_wait_for(self, msg):
         self.progressBarLabel.setText(msg)
@@ -667,7 +934,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.progressBar.hide()
         self.qImage.loading = False
 
-    def create_main_variables(self):
+    def create_image_variables(self):
         # set default mask colors
         self.disc_color = COL_DISC_DEFAULT
         self.cup_color = COL_CUP_DEFAULT
@@ -685,10 +952,16 @@ class MainWindow(QtWidgets.QMainWindow):
         self.qBG_layers.buttonToggled.connect(self.layer_changed)
         # variables
         self.layers = [0, 0]
-        self.shapes = []
+        self.shapes = ShapeStore()
         self.mask_layers = [False, False]
         self.current = -1
+
+    def create_main_variables(self):
+        self.create_image_variables()
         self.isChanged = False
+        self.project_file = None
+        # Images of the session (with their states and cached pixmaps)
+        self.session = Session()
 
     def connect_signals(self):
         # ------------------------------------------------------------------- #
@@ -744,6 +1017,8 @@ class MainWindow(QtWidgets.QMainWindow):
         act1.setIcon(QtGui.QIcon("resources/menu_automatic.png"))
         act2 = menu.addAction("Manual Mask")
         act2.setIcon(QtGui.QIcon("resources/menu_manual.png"))
+        act3 = menu.addAction("Fitted Mask")
+        act3.setIcon(QtGui.QIcon("resources/menu_ellipse.png"))
         self.qPB_add.setMenu(menu)
 
     def remove_add_menu(self):
@@ -757,6 +1032,9 @@ class MainWindow(QtWidgets.QMainWindow):
         elif action.text() == "Automatic Mask":
             self.add_automatic_mask()
             self.isChanged = True
+        elif action.text() == "Fitted Mask":
+            self.add_fitted_mask()
+            self.isChanged = True
 
     def load_theme_flag(self):
         try:
@@ -780,6 +1058,24 @@ class MainWindow(QtWidgets.QMainWindow):
         if ok:
             self.layers_add(False, text)
 
+    def add_fitted_mask(self):
+        fitted = self.qImage.fitted
+        if fitted is None or None in fitted:
+            self.show_error('Fitted Mask Error',
+                            '<p>Add an <b>automatic mask</b> first.</p>')
+            return
+        ok, text = self.ask_for_layer_name()
+        if ok:
+            self.layers_add(True, text)
+            # Seed disc/cup with copies of the fitted ellipses
+            for i, shape in enumerate(fitted):
+                self.shapes[self.current].set_fitted(i, shape.copy())
+                self.set_layer_child(i, True)
+            # Shapes are placed on the cropped image by respawn
+            if self.zoom_mode == ZOOM_OUT:
+                self.qPB_zoom_in.click()
+            self.qImage.respawn()
+
     def ask_for_layer_name(self):
         qin = QtWidgets.QInputDialog
         text, ok = qin.getText(self,
@@ -838,7 +1134,7 @@ class MainWindow(QtWidgets.QMainWindow):
             COL_FRAME = '#EAEAEA'
 
     def showEvent(self, event):
-        self.mw_wait_for('Loading Deep NN models')
+        startup.mark('window shown')
 
     def info_update_all(self):
         if all(self.mask_layers):
@@ -847,28 +1143,22 @@ class MainWindow(QtWidgets.QMainWindow):
                 shapes = self.shapes[self.current]
                 disc, cup = shapes[0], shapes[1]
 
-                qimg = self.qImage
-                rx, ry = qimg.region[0], qimg.region[1]
-
-                (dx, dy), dd = disc.c.value(), disc.dia()
-                (cx, cy), cd = cup.c.value(), cup.dia()
-                dr, cr = dd / 2, cd / 2
-                dx, dy, cx, cy = dx-rx, ry-dy, cx-rx, ry-cy
+                (dx, dy, dw, dh), da = disc.bounds(), disc.area()
+                (cx, cy, cw, ch), ca = cup.bounds(), cup.area()
+                dd, cd = max(dw, dh), max(cw, ch)
                 norm = dd
 
-                n = round(dx + dr - cx - cr)
-                i = round(dy + dr - cy - cr)
-                s = round(cy - cr - dy + dr)
-                t = round(cx - cr - dx + dr)
+                i, s, n, t = (round(float(rim)) for rim in
+                              isnt_widths(disc.to_ellipse(),
+                                          cup.to_ellipse()))
 
-                cdr = cd/dd
+                cdr = ch / dh
 
-                cx, cy = cx - dx + dr, cy - dy + dr
-                cx, cy = cx / norm, 1 - (cy / norm)
-                dx, dy = 0.5, 0.5
-                dd, cd = dd / norm, cd / norm
-                cw, ch, dw, dh = cd, cd, dd, dd
-                da, ca = 0.785398, 0.785398 * cdr * cdr
+                cx, cy = cx - dx + dw / 2, cy - dy + dh / 2
+                cx, cy = cx / norm, cy / norm
+                dx, dy = dw / 2 / norm, dh / 2 / norm
+                dw, dh, cw, ch = dw / norm, dh / norm, cw / norm, ch / norm
+                da, ca = da / (norm * norm), ca / (norm * norm)
 
             else:
                 img = self.qImage.mask_out
@@ -910,34 +1200,53 @@ class MainWindow(QtWidgets.QMainWindow):
                 self.set_isnt((i >= s, s >= n, n >= t))
                 self.set_cdr(cdr)
 
+                rate = None
                 if cdr_model is not None:
                     prediction = cdr_model.predict([cx, cy, cw, ch, ca,
                                                     dx, dy, dw, dh, da])
                     if prediction[0][0] != -1:
-                        self.set_dtr(float(prediction[0][0]))
+                        rate = float(prediction[0][0])
+                        self.set_dtr(rate)
                     else:
                         self.set_dtr('Model Error!')
+                elif self.models_status['CDR'] == T_MODEL_LOADING:
+                    self.set_dtr('Loading...')
                 else:
                     self.set_dtr('Load Error!')
+
+                # Record metrics of automatic layer in the image index
+                if not layer:
+                    self.index_update_metrics(cdr, (i, s, n, t), rate)
         else:
             self.info_reset()
 
+    def index_update_metrics(self, cdr, isnt, rate):
+        ''' Record automatic layer metrics of current image (written by
+            the crop writer thread, see save_metrics)
+        '''
+        fields = {'cdr': cdr, 'isnt': isnt}
+        if self.qImage.fitted is not None:
+            fields['disc'], fields['cup'] = self.qImage.fitted
+        if rate is not None:
+            fields['detection_rate'] = rate
+        save_metrics(self.qImage.filename, fields)
+
     def enhance_image(self):
-        qimg = self.qImage
+        # Shown view is enhanced again on next paint
+        self.qImage.view_cache = None
 
+    def enhance_view(self, cv2i):
+        ''' Enhance visible region of the image (image enhancement sliders) '''
         sHue = (self.qS_hue.value() + 255) // 2
         sSat = self.qS_saturation.value()
         sBri = self.qS_brightness.value()
         sCon = self.qS_contrast.value()
 
-        qpix = qimg.zoomed_in if qimg.isZoomed else qimg.zoomed_out
-
-        cv2i = qImage_to_cvImage(qpix)
         cv2i = edit_contrast(cv2i, sCon)
         cv2i = edit_image_of(cv2i, EDIT_HUE, sHue)
         cv2i = edit_image_of(cv2i, EDIT_SAT, sSat)
         cv2i = edit_image_of(cv2i, EDIT_BRI, sBri)
-        qimg.pixmap = QtGui.QPixmap(cvImage_to_qImage(cv2i))
+        return cv2i
 
     def show_error(self, title, info, more=''):
         qm = QtWidgets.QMessageBox
@@ -1074,15 +1383,12 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def btn_zoom_in(self):
         self.zoom_setMode(ZOOM_IN)
-        self.qImage.toggle_zoom()
-        if self.qImage.zoomed_out is not None:
-            self.enhance_image()
+        self.qImage.set_zoom(True)
 
     def btn_zoom_out(self):
         self.zoom_setMode(ZOOM_OUT)
-        self.qImage.toggle_zoom()
-        if self.qImage.zoomed_in is not None:
-            self.enhance_image()
+        self.qImage.set_zoom(False)
+        self.qImage.repaint()
 
     def cb_disc_outline(self):
         self.qImage.repaint()
@@ -1206,6 +1512,10 @@ class MainWindow(QtWidgets.QMainWindow):
             self.qL_zoom.setEnabled(True)
             self.qPB_zoom_in.setEnabled(False)
             self.qPB_zoom_out.setEnabled(True)
+        elif mode == ZOOM_FREE:
+            self.qL_zoom.setEnabled(True)
+            self.qPB_zoom_in.setEnabled(True)
+            self.qPB_zoom_out.setEnabled(True)
 
     def imageEnhancement_setEnabled(self, flag):
         self.imageEnhancement_enabled = flag
@@ -1228,17 +1538,45 @@ class MainWindow(QtWidgets.QMainWindow):
         self.qPB_add.setEnabled(flag)
 
     def layers_add(self, flag, name=''):
+        # Manual layers are added last, automatic after automatic layers
+        self.current = sum(self.layers) if flag else self.layers[1]
+        item_0 = self.create_layer_item(flag, name)
+        self.qTW_layers.insertTopLevelItem(self.current, item_0)
+        self.shapes.insert(self.current, [None, None])
+        button = self.create_layer_button(item_0)
+
+        self.qPB_remove.setEnabled(True)
+        self.info_setEnabled(True)
+
+        # Automatic mask is loaded by layer_changed
+        button.click()
+        layer = self.get_layer_type(win.current)
+        if layer is False and self.qImage.hasMask:
+            self.layers_activate_masks()
+            self.info_update_all()
+
+    def layers_restore(self, layers, store):
+        ''' Add saved layers ((manual, name) in tree order) and their
+            shapes at once (no layer is selected)
+        '''
+        items = [self.create_layer_item(flag, name) for flag, name in layers]
+        # One insertion of all items (much faster than one per item)
+        self.qTW_layers.addTopLevelItems(items)
+        for item in items:
+            self.create_layer_button(item)
+        self.shapes, self.current = store, -1
+        for idx in range(len(store)):
+            for i, kind in enumerate(store.layer_kinds(idx)):
+                if kind != KIND_NONE:
+                    self.set_layer_child(i, True, idx)
+        if items:
+            self.qPB_remove.setEnabled(True)
+            self.info_setEnabled(True)
+
+    def create_layer_item(self, flag, name):
         item_0 = QtWidgets.QTreeWidgetItem()
         QtWidgets.QTreeWidgetItem(item_0)
         QtWidgets.QTreeWidgetItem(item_0)
-        if flag:
-            self.current = sum(self.layers)
-            self.qTW_layers.insertTopLevelItem(self.current, item_0)
-        else:
-            self.current = self.layers[1]
-            self.qTW_layers.insertTopLevelItem(self.current, item_0)
-
-        self.shapes.insert(self.current, [None, None])
 
         item_0.child(0).setBackground(1, QtGui.QColor(COL_BG_UNDEF))
         item_0.child(1).setBackground(1, QtGui.QColor(COL_BG_UNDEF))
@@ -1251,24 +1589,15 @@ class MainWindow(QtWidgets.QMainWindow):
         item_0.child(0).setText(1, T_UNDEFINED)
         item_0.child(1).setText(0, "Cup")
         item_0.child(1).setText(1, T_UNDEFINED)
+        return item_0
 
+    def create_layer_button(self, item_0):
+        # Item must be in the tree before its widget is set
         button = QtWidgets.QRadioButton()
         self.qBG_layers.addButton(button)
         self.qTW_layers.setItemWidget(item_0, 1, button)
-
-        button.click()
         item_0.setExpanded(True)
-        self.qPB_remove.setEnabled(True)
-        self.info_setEnabled(True)
-
-        layer = self.get_layer_type(win.current)
-        qimg = self.qImage
-        if layer is False:
-            if qimg.hasMask is False:
-                qimg.load_automatic_layer()
-            else:
-                self.layers_activate_masks()
-                self.info_update_all()
+        return button
 
     def generate_layer_text(self, flag):
         if flag:
@@ -1336,20 +1665,13 @@ class MainWindow(QtWidgets.QMainWindow):
         text = self.qTW_layers.topLevelItem(idx).text(0)[0]
         return text == T_MANUAL[0]
 
-    def strike_out_text(self, item):
-        f = item.font()
-        f.setStrikeOut(True)
-        item.setFont(f)
-
     def create_disc_mask_menu(self):
         menu = QtWidgets.QMenu(self.qPB_disc,
                                triggered=self.add_disc_mask_triggered)
         act1 = menu.addAction("Circle")
         act1.setIcon(QtGui.QIcon("resources/menu_circle.png"))
         act2 = menu.addAction("Ellipse")
-        act2.setEnabled(False)
         act2.setIcon(QtGui.QIcon("resources/menu_ellipse.png"))
-        self.strike_out_text(act2)
         self.qPB_disc.setMenu(menu)
 
     def create_cup_mask_menu(self):
@@ -1358,9 +1680,7 @@ class MainWindow(QtWidgets.QMainWindow):
         act1 = menu.addAction("Circle")
         act1.setIcon(QtGui.QIcon("resources/menu_circle.png"))
         act2 = menu.addAction("Ellipse")
-        act2.setEnabled(False)
         act2.setIcon(QtGui.QIcon("resources/menu_ellipse.png"))
-        self.strike_out_text(act2)
         self.qPB_cup.setMenu(menu)
 
     def mask_add_menu_trig(self, action, i):
@@ -1430,6 +1750,13 @@ class MainWindow(QtWidgets.QMainWindow):
         if rbtn.isChecked():
             self.update_radio_buttons()
             idx = self.current
+            # Load automatic mask when an automatic layer is shown
+            qimg = self.qImage
+            if self.get_layer_type(idx) is False:
+                if qimg.hasMask:
+                    self.layers_activate_masks()
+                elif not qimg.loading:
+                    qimg.load_automatic_layer()
             self.mask_update_buttons_text(idx)
             self.qImage.repaint()
             self.info_update_all()
@@ -1464,8 +1791,8 @@ class MainWindow(QtWidgets.QMainWindow):
             self.qL_dtr_val.setText(dtr)
             self.qL_dtr_val.setStyleSheet(f'color: {COL_FAIL}')
 
-    def set_layer_child(self, num, flag):
-        idx = self.current
+    def set_layer_child(self, num, flag, idx=None):
+        idx = self.current if idx is None else idx
         if idx != -1:
             para = (COL_FG_DEF, COL_BG_DEF, T_DEFINED) if flag else \
                    (COL_FG_UNDEF, COL_BG_UNDEF, T_UNDEFINED)
@@ -1474,7 +1801,8 @@ class MainWindow(QtWidgets.QMainWindow):
             item.child(num).setBackground(1, QtGui.QColor(para[1]))
             item.child(num).setText(1, para[2])
             item.setSelected(False)
-            self.mask_update_buttons_text(idx)
+            if idx == self.current:
+                self.mask_update_buttons_text(idx)
 
     def reset_frames_style(self):
         for i in (self.qF1, self.qF2, self.qF3, self.qF4, self.qV):
@@ -1507,19 +1835,243 @@ class MainWindow(QtWidgets.QMainWindow):
             if ans == qm.Yes or ans == qm.No:
                 if ans == qm.Yes:
                     self.menu_save()
-                self.qImage.reset_all()
-                self.qImage.refresh()
-                self.qTW_layers.clear()
-                self.reset_all_sliders()
-                self.qPB_remove.setEnabled(False)
-                self.create_main_variables()
-                self.isChanged = False
+                self.reset_project()
+
+    def reset_project(self):
+        self.jobs.set_image(None)
+        self.qImage.reset_all()
+        self.qImage.refresh()
+        self.qTW_layers.clear()
+        self.reset_all_sliders()
+        self.qPB_remove.setEnabled(False)
+        self.create_main_variables()
+        self.setWindowTitle(self.title)
+        self.isChanged = False
 
     def menu_open(self):
-        print('Menubar: Open')
+        if self.isChanged is True:
+            qm = QtWidgets.QMessageBox
+            ans = qm.question(self,
+                              'Open Project Confirmation',
+                              '<p>Do you want to save current project'
+                              ' before you open another project?</p>',
+                              qm.Yes | qm.No | qm.Cancel)
+            if ans == qm.Cancel:
+                return
+            if ans == qm.Yes:
+                self.menu_save()
+
+        qfd = QtWidgets.QFileDialog
+        filename, _ = qfd.getOpenFileName(self,
+                                          "Open Project",
+                                          "glaucoma-cases/",
+                                          f"Project Files (*{PROJECT_EXT})")
+        if filename == '':
+            return
+        try:
+            info, store = load_project(filename)
+        except (OSError, ValueError, KeyError, ProjectError) as error:
+            self.show_error('Project Load Error',
+                            '<p>The project could not be opened.</p>',
+                            str(error))
+            return
+        if not info.get('image') or not exists(info['image']):
+            self.show_error('Project Load Error',
+                            '<p>The image of the project was not found.</p>',
+                            str(info.get('image')))
+            return
+
+        self.reset_project()
+        self.project_file = filename
+        self.session.add(info['image'])
+        self.qImage.open_file(info['image'])
+        self.restore_state(info, store)
+        self.isChanged = False
+
+    def image_state(self):
+        ''' Get state (project info) of the shown image '''
+        qimg = self.qImage
+        layers = []
+        for i in range(sum(self.layers)):
+            text = self.qTW_layers.topLevelItem(i).text(0)
+            name = text.split(': ', 1)[1] if ': ' in text else ''
+            layers.append((text[0] == T_MANUAL[0], name))
+        mask = qimg.check_if_mask_exists()[1] if qimg.hasMask else None
+        return {'image': qimg.filename,
+                'region': qimg.region,
+                'mask': mask,
+                'layers': layers,
+                'current': max(self.current, 0),
+                'zoomed': qimg.isZoomed,
+                # Zoomed/panned view (None if fitted to region or image)
+                'view': (qimg.view_rect if self.zoom_mode == ZOOM_FREE
+                         else None),
+                'colors': (self.disc_color, self.cup_color),
+                'sliders': [slider.value()
+                            for slider in self.project_sliders()]}
+
+    def restore_state(self, info, store):
+        ''' Restore state of the shown image (after open_file) '''
+        qimg = self.qImage
+        qimg.mask_file = info.get('mask')
+        # Shapes are relative to the saved region
+        if info.get('region') is not None:
+            qimg.set_region(info['region'])
+        self.disc_color, self.cup_color = info['colors']
+        self.set_sliders(info['sliders'])
+
+        # Add layers with the saved shapes
+        self.layers_restore(info['layers'], store)
+
+        # Select saved layer (loads automatic mask if it is automatic)
+        if len(store):
+            item = self.qTW_layers.topLevelItem(info['current'])
+            self.qTW_layers.itemWidget(item, 1).click()
+        # Zoom in on the saved crop region (shapes are already placed)
+        if info['zoomed'] and info.get('region') is not None:
+            self.qPB_zoom_in.click()
+        if info.get('view') is not None:
+            qimg.view_rect = tuple(info['view'])
+            self.zoom_setMode(ZOOM_FREE)
+            qimg.repaint()
+
+    def set_sliders(self, values):
+        ''' Set project sliders, enhancing the image once '''
+        for slider, value in zip(self.project_sliders(), values):
+            slider.blockSignals(True)
+            slider.setValue(value)
+            slider.blockSignals(False)
+        if self.qImage.hasImage:
+            self.enhance_image()
+        self.qImage.repaint()
+
+    def switch_image(self, filename):
+        ''' Show an image of the session (added if new)
+            State of the shown image is kept in the session, and the state
+            of the other image is restored.
+        '''
+        qimg = self.qImage
+        if qimg.hasImage:
+            if filename == qimg.filename:
+                return
+            self.session.save_state(qimg.filename, self.image_state(),
+                                    self.shapes)
+        state = self.session.add(filename)
+        # Reset image view (layers, masks and blocks)
+        qimg.reset_all()
+        self.qTW_layers.clear()
+        self.qPB_remove.setEnabled(False)
+        self.create_image_variables()
+        qimg.open_file(filename)
+        if state is None:
+            self.set_sliders(DEFAULT_SLIDERS)
+        else:
+            self.restore_state(*state)
+
+    def create_session_menu(self):
+        ''' Images menu (add/next/previous image and session images) '''
+        self.title = self.windowTitle()
+        menu = self.qImages_menu = self.menubar.addMenu('Images')
+        for text, key, slot in (
+                ('Add Image...', 'Ctrl+I',
+                 lambda: self.qImage.get_image_file()),
+                ('Next Image', 'Ctrl+PgDown', lambda: self.step_image(1)),
+                ('Previous Image', 'Ctrl+PgUp', lambda: self.step_image(-1))):
+            action = menu.addAction(text)
+            action.setShortcut(QtGui.QKeySequence(key))
+            action.triggered.connect(slot)
+        menu.addSeparator()
+        # Actions of session images (rebuilt when the menu is shown)
+        self.session_actions = []
+        menu.aboutToShow.connect(self.update_session_menu)
+
+    def update_session_menu(self):
+        for action in self.session_actions:
+            self.qImages_menu.removeAction(action)
+        self.session_actions = []
+        for filename in self.session.files:
+            action = self.qImages_menu.addAction(filename.split('/')[-1])
+            action.setCheckable(True)
+            action.setChecked(filename == self.qImage.filename)
+            action.triggered.connect(
+                lambda _, filename=filename: self.switch_image(filename))
+            self.session_actions.append(action)
+
+    def create_trace_menu(self):
+        ''' Trace menu (record spans, stats panel and Chrome trace export) '''
+        menu = self.menubar.addMenu('Trace')
+        record = menu.addAction('Record Spans')
+        record.setCheckable(True)
+        record.setChecked(tracing.ENABLED)
+        record.toggled.connect(tracing.set_enabled)
+        menu.addAction('Stats...').triggered.connect(self.show_trace_stats)
+        menu.addAction('Export Chrome Trace...').triggered.connect(
+            self.export_trace)
+        menu.addAction('Clear').triggered.connect(tracing.clear)
+        self.trace_stats = None
+
+    def show_trace_stats(self):
+        if self.trace_stats is None:
+            self.trace_stats = TraceStats(self)
+        self.trace_stats.show()
+        self.trace_stats.raise_()
+
+    def export_trace(self):
+        qfd = QtWidgets.QFileDialog
+        filename, _ = qfd.getSaveFileName(self, 'Export Chrome Trace',
+                                          'trace.json',
+                                          'Chrome Trace (*.json)')
+        if filename == '':
+            return
+        try:
+            count = tracing.export_chrome(filename)
+        except OSError as error:
+            self.show_error('Trace Export Error',
+                            '<p>The trace could not be saved.</p>',
+                            str(error))
+            return
+        self.statusBar().showMessage(f'Saved {count} spans to {filename}')
+
+    def step_image(self, step):
+        ''' Show next (step=1) or previous (step=-1) image of the session '''
+        if len(self.session) > 1:
+            self.switch_image(self.session.neighbor(self.qImage.filename,
+                                                    step))
 
     def menu_save(self):
-        print('TODO: Save Project')
+        qimg = self.qImage
+        if not qimg.hasImage:
+            self.show_error('Project Save Error',
+                            '<p>Open an <b>image</b> first.</p>')
+            return False
+        filename = self.project_file
+        if filename is None:
+            qfd = QtWidgets.QFileDialog
+            filename, _ = qfd.getSaveFileName(self,
+                                              "Save Project",
+                                              "glaucoma-cases/",
+                                              "Project Files "
+                                              f"(*{PROJECT_EXT})")
+            if filename == '':
+                return False
+            if not filename.endswith(PROJECT_EXT):
+                filename += PROJECT_EXT
+
+        try:
+            save_project(filename, self.image_state(), self.shapes)
+        except OSError as error:
+            self.show_error('Project Save Error',
+                            '<p>The project could not be saved.</p>',
+                            str(error))
+            return False
+        self.project_file = filename
+        self.isChanged = False
+        return True
+
+    def project_sliders(self):
+        ''' Sliders saved in projects (enhancement and mask alpha) '''
+        return (self.qS_hue, self.qS_brightness, self.qS_saturation,
+                self.qS_contrast, self.qS_disc_alpha, self.qS_cup_alpha)
 
     def menu_exit(self):
         if self.isChanged is True:
@@ -1533,11 +2085,15 @@ class MainWindow(QtWidgets.QMainWindow):
             if ans == qm.Yes or ans == qm.No:
                 if ans == qm.Yes:
                     self.menu_save()
+                self.jobs.shutdown()
+                flush_crops()
                 sys.exit(app.exit())
                 return False
             else:
                 return True
         else:
+            self.jobs.shutdown()
+            flush_crops()
             sys.exit(app.exit())
             return False
 
@@ -1573,16 +2129,25 @@ class MainWindow(QtWidgets.QMainWindow):
         print('TODO: GitHub Link')
 
 
-def load_models():
-    ''' Load CDR model class '''
-    from detection_rate_model import DetectionRateModel, normalize_sample_data
-    # Create global variable for CDR model
-    global cdr_model, normalize_data
+def cdr_model_job(token):
+    ''' Job: Load CDR model class '''
+    from detection_rate_model import DetectionRateModel
     CDR_MODEL = 'models/detection_rate_model.h5'
-    cdr_model = DetectionRateModel(CDR_MODEL)
-    normalize_data = normalize_sample_data
-    # Hide progress bar (loading)
-    win.mw_end_wait_for()
+    return DetectionRateModel(CDR_MODEL)
+
+
+def mnet_warmup_job(token):
+    ''' Job: Build MNet models and run them once (slow TF setup) '''
+    # Models are owned by the inference server if it is running
+    if inference_running():
+        return True
+    import mnet_segmentation
+    mnet_segmentation.warmup()
+    return True
+
+
+# CDR model (loaded in background by cdr_model_job)
+cdr_model = None
 
 
 if __name__ == "__main__":
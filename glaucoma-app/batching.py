@@ -0,0 +1,116 @@
+from concurrent.futures import Future
+from threading import Condition, Lock, Thread
+from collections import deque
+from time import monotonic
+
+import numpy as np
+
+
+# Number of recent latencies kept for percentiles
+LATENCY_SAMPLES = 1000
+
+
+class BatchMetrics:
+    ''' Queue depth, batch fill ratio and latency of a BatchScheduler '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.queue_depth, self.max_queue_depth = 0, 0
+        self.batches, self.items, self.capacity = 0, 0, 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def record_queue(self, depth):
+        ''' Record number of waiting requests '''
+        with self.lock:
+            self.queue_depth = depth
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def record_batch(self, size, max_batch):
+        ''' Record size of a batch (and the maximum batch size) '''
+        with self.lock:
+            self.batches += 1
+            self.items += size
+            self.capacity += max_batch
+
+    def record_latency(self, seconds):
+        ''' Record time from request submission to its result '''
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def summary(self):
+        ''' Get metrics as a dictionary (latencies in milliseconds) '''
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            p50, p99 = (np.percentile(latencies, (50, 99)) if len(latencies)
+                        else (0.0, 0.0))
+            return {'queue_depth': self.queue_depth,
+                    'max_queue_depth': self.max_queue_depth,
+                    'batches': self.batches,
+                    'items': self.items,
+                    'fill_ratio': self.items / max(self.capacity, 1),
+                    'latency_p50_ms': float(p50),
+                    'latency_p99_ms': float(p99)}
+
+
+class BatchScheduler:
+    ''' Collect concurrent requests into batches for one function
+        fn is called with a list of items and returns a list of results
+        (same order). A batch runs when it has max_batch items or when
+        its oldest request has waited max_wait seconds, so max_wait
+        trades latency for throughput. Both knobs can be changed while
+        the scheduler is running.
+    '''
+
+    def __init__(self, fn, max_batch=8, max_wait=0.01, name='batch'):
+        self.fn, self.max_batch, self.max_wait = fn, max_batch, max_wait
+        self.pending, self.cond = deque(), Condition()
+        self.metrics = BatchMetrics()
+        Thread(target=self._loop, name=name, daemon=True).start()
+
+    def submit(self, item):
+        ''' Submit an item and get a Future of its result '''
+        future = Future()
+        with self.cond:
+            self.pending.append((item, future, monotonic()))
+            self.metrics.record_queue(len(self.pending))
+            self.cond.notify()
+        return future
+
+    def __call__(self, item):
+        ''' Submit an item and wait for its result '''
+        return self.submit(item).result()
+
+    def _next_batch(self):
+        ''' Wait for a full batch or for the oldest request timeout '''
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+            deadline = self.pending[0][2] + self.max_wait
+            while len(self.pending) < self.max_batch:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            size = min(len(self.pending), self.max_batch)
+            batch = [self.pending.popleft() for _ in range(size)]
+            self.metrics.record_queue(len(self.pending))
+            self.metrics.record_batch(size, self.max_batch)
+        return batch
+
+    def _loop(self):
+        ''' Run batches and split results back to their futures '''
+        while True:
+            batch = self._next_batch()
+            try:
+                results = self.fn([item for item, _, _ in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f'Batch of {len(batch)} items got '
+                                       f'{len(results)} results')
+            except Exception as error:
+                for _, future, _ in batch:
+                    future.set_exception(error)
+                continue
+            now = monotonic()
+            for (_, future, submitted), result in zip(batch, results):
+                self.metrics.record_latency(now - submitted)
+                future.set_result(result)
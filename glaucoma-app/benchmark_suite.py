@@ -0,0 +1,301 @@
+from contextlib import contextmanager
+from tempfile import TemporaryDirectory
+from datetime import datetime
+from time import perf_counter
+from os import path, environ, cpu_count
+import platform
+import argparse
+import json
+import sys
+
+# Reproducible CPU runs (before TensorFlow is imported)
+environ.setdefault('CUDA_VISIBLE_DEVICES', '-1')
+
+import numpy as np
+import cv2
+
+
+# Report format version (compare refuses newer reports)
+VERSION = 1
+# Timed runs of each image (after one warmup run)
+REPEATS = 5
+SYNTHETIC_SIZE = (1200, 1600)
+SYNTHETIC_SEED = 0
+# Compare mode: a stage regresses if its median is slower by more than
+# TOLERANCE (ratio) and by more than MIN_DELTA_MS (timer noise)
+TOLERANCE = 0.10
+MIN_DELTA_MS = 0.5
+
+# Stages in pipeline order
+STAGES = ('decode', 'cropONH', 'DiscSeg', 'BW_img', 'disc_crop', 'polar',
+          'M-Net', 'inverse polar', 'save', 'get_boundaries_info',
+          'colorize_mask', 'enhance_image', 'DetectionRateModel')
+
+# Image enhancement of the benchmark (contrast, hue, saturation,
+# brightness slider values)
+ENHANCE = (40, 160, 30, 20)
+DISC_COLOR, CUP_COLOR = '#00ff00', '#0000ff'
+CDR_MODEL = 'models/detection_rate_model.h5'
+
+
+class StageTimer:
+    ''' Collect durations (seconds) of named stages '''
+
+    def __init__(self):
+        self.times = {}
+        self.enabled = True
+
+    @contextmanager
+    def __call__(self, stage):
+        t0 = perf_counter()
+        yield
+        if self.enabled:
+            self.times.setdefault(stage, []).append(perf_counter() - t0)
+
+    def summary(self):
+        ''' Get median, mean and min (ms) and count of each stage '''
+        return {stage: {'median_ms': float(np.median(t) * 1000),
+                        'mean_ms': float(np.mean(t) * 1000),
+                        'min_ms': float(np.min(t) * 1000),
+                        'count': len(t)}
+                for stage, t in sorted(self.times.items(),
+                                       key=lambda item:
+                                       STAGES.index(item[0]))}
+
+
+def synthetic_fundus(rng, size=SYNTHETIC_SIZE):
+    ''' Draw a fundus-like RGB image (retina, bright disc with a cup and
+        vessels) from a random generator
+    '''
+    h, w = size
+    img = np.zeros((h, w, 3), np.uint8)
+    r = int(min(h, w) * 0.45)
+    cv2.circle(img, (w // 2, h // 2), r, (170, 75, 35), -1)
+    # Disc on either side of the retina center
+    side = rng.choice((-1, 1))
+    dx = w // 2 + side * int(r * rng.uniform(0.3, 0.5))
+    dy = h // 2 + int(r * rng.uniform(-0.1, 0.1))
+    dr = int(r * rng.uniform(0.12, 0.16))
+    for k in range(8):
+        angle = 2 * np.pi * k / 8 + rng.uniform(-0.3, 0.3)
+        end = (int(dx + np.cos(angle) * r), int(dy + np.sin(angle) * r))
+        cv2.line(img, (dx, dy), end, (110, 30, 20), 6)
+    cv2.circle(img, (dx, dy), dr, (245, 205, 140), -1)
+    cv2.circle(img, (dx, dy), int(dr * rng.uniform(0.4, 0.7)),
+               (255, 240, 200), -1)
+    img = cv2.GaussianBlur(img, (0, 0), 3)
+    noise = rng.normal(0, 4, img.shape)
+    return np.clip(img + noise, 0, 255).astype(np.uint8)
+
+
+def load_inputs(folder=None, synthetic=0, limit=None):
+    ''' Get (name, encoded JPEG) of bundled images of a folder, or of
+        synthetic images (decoding is timed, reading files is not)
+    '''
+    if synthetic:
+        rng = np.random.RandomState(SYNTHETIC_SEED)
+        inputs = []
+        for k in range(synthetic):
+            bgr = cv2.cvtColor(synthetic_fundus(rng), cv2.COLOR_RGB2BGR)
+            inputs.append((f'synthetic_{k}', cv2.imencode('.jpg', bgr)[1]))
+        return inputs
+    from evaluation import list_images
+    return [(path.basename(file), np.fromfile(file, np.uint8))
+            for file in list_images(folder, limit)]
+
+
+def placeholder_output(size):
+    ''' M-Net-like probability map (disc and cup bands near the center)
+        used when models are not loaded
+    '''
+    prob = np.zeros((size, size, 2), np.float32)
+    prob[:int(size * 0.3), :, 0] = 1
+    prob[:int(size * 0.15), :, 1] = 1
+    return prob
+
+
+def run_image(data, timer, models, folder, profile=None):
+    ''' Run the detection pipeline on one encoded image, timing each stage
+        models is (DiscSeg, M-Net, DetectionRateModel) or None.
+    '''
+    import mnet_segmentation as mnet_seg
+    from mnet.mnet_utils import disc_crop
+    from ONH_Detection import cropONH, locate_disc
+    from gui_utils import get_boundaries_info, colorize_mask
+    from gui_utils import edit_contrast, edit_image_of
+    from detection_rate_model import normalize_sample_data
+    from PIL import Image
+
+    disc_size, cdr_size = mnet_seg.profile_sizes(profile)
+    with timer('decode'):
+        rgb = cv2.cvtColor(cv2.imdecode(data, cv2.IMREAD_COLOR),
+                           cv2.COLOR_BGR2RGB)
+    with timer('cropONH'):
+        cropONH(None, image=rgb)
+    if models:
+        disc_model, cdr_model, rate_model = models
+        with timer('DiscSeg'):
+            disc_map = disc_model.predict(
+                mnet_seg.disc_input(rgb, disc_size)[None])[0]
+        with timer('BW_img'):
+            C_x, C_y = mnet_seg.disc_center(rgb, disc_map)
+    else:
+        (x, y), _ = locate_disc(rgb)
+        C_x, C_y = int(y), int(x)
+    with timer('disc_crop'):
+        region, err_xy, crop_xy = disc_crop(rgb, mnet_seg.DiscROI_size,
+                                            C_x, C_y)
+    with timer('polar'):
+        temp_img = mnet_seg.polar_image(region, cdr_size)
+    if models:
+        with timer('M-Net'):
+            prob_10 = mnet_seg.fused_output(cdr_model.predict(temp_img[None]))
+    else:
+        prob_10 = placeholder_output(cdr_size)
+    with timer('inverse polar'):
+        mask = mnet_seg.mask_output(rgb, prob_10, err_xy, crop_xy)
+    with timer('save'):
+        Image.fromarray(mask).save(path.join(folder, 'mask.png'))
+
+    # Viewer stages use the mask as read back by the app (BGR)
+    mask = cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR)
+    with timer('get_boundaries_info'):
+        ((cx, cy, cw, ch), ca), ((dx, dy, dw, dh), da) = \
+            get_boundaries_info(mask)
+    with timer('colorize_mask'):
+        colorize_mask(mask, None, 128, 128, DISC_COLOR, CUP_COLOR)
+    with timer('enhance_image'):
+        contrast, hue, saturation, brightness = ENHANCE
+        bgr = edit_contrast(cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR), contrast)
+        bgr = edit_image_of(bgr, 0, hue)
+        bgr = edit_image_of(bgr, 1, saturation)
+        bgr = edit_image_of(bgr, 2, brightness)
+    if models:
+        data = normalize_sample_data({
+            'disc': {'x': dx, 'y': dy, 'w': dw, 'h': dh, 'a': da},
+            'cup': {'x': cx, 'y': cy, 'w': cw, 'h': ch, 'a': ca}})
+        case = [data[part][k] for part in ('cup', 'disc')
+                for k in ('x', 'y', 'w', 'h', 'a')]
+        with timer('DetectionRateModel'):
+            rate_model.predict(case)
+
+
+def load_benchmark_models(backend=None):
+    ''' Load DiscSeg, M-Net and the detection rate model '''
+    import mnet_segmentation as mnet_seg
+    from detection_rate_model import DetectionRateModel
+    disc_model, cdr_model = mnet_seg.load_models(backend)
+    return disc_model, cdr_model, DetectionRateModel(CDR_MODEL)
+
+
+def environment():
+    ''' Describe the machine and library versions of a run '''
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpus': cpu_count(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'opencv_threads': cv2.getNumThreads()}
+
+
+def run_suite(folder='glaucoma-cases', synthetic=0, limit=None,
+              repeats=REPEATS, models=True, backend=None, profile=None):
+    ''' Run the pipeline on every input (one warmup run and repeats timed
+        runs) and get the report
+    '''
+    inputs = load_inputs(folder, synthetic, limit)
+    loaded = load_benchmark_models(backend) if models else None
+    timer = StageTimer()
+    with TemporaryDirectory() as tmp:
+        for _, data in inputs:
+            for run in range(repeats + 1):
+                timer.enabled = run > 0
+                run_image(data, timer, loaded, tmp, profile)
+    return {'version': VERSION,
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'environment': environment(),
+            'config': {'images': 'synthetic' if synthetic else folder,
+                       'inputs': [name for name, _ in inputs],
+                       'repeats': repeats, 'models': models,
+                       'backend': backend, 'profile': profile},
+            'stages': timer.summary()}
+
+
+def print_report(report):
+    print(f'{"Stage":<22}{"Median ms":>11}{"Mean ms":>10}{"Min ms":>9}')
+    for stage, t in report['stages'].items():
+        print(f'{stage:<22}{t["median_ms"]:11.2f}{t["mean_ms"]:10.2f}'
+              f'{t["min_ms"]:9.2f}')
+
+
+def compare(report, baseline, tolerance=TOLERANCE):
+    ''' Compare stage medians of a report with a baseline report
+        Returns the stages that regressed.
+    '''
+    if baseline['version'] > VERSION:
+        raise ValueError('Baseline report needs a newer benchmark suite')
+    if baseline['config'] != report['config']:
+        print('WARNING: Reports have different configurations')
+    regressions = []
+    print(f'{"Stage":<22}{"Base ms":>10}{"New ms":>10}{"Ratio":>8}')
+    for stage in STAGES:
+        old = baseline['stages'].get(stage)
+        new = report['stages'].get(stage)
+        if old is None or new is None:
+            continue
+        old, new = old['median_ms'], new['median_ms']
+        ratio = new / old if old else float('inf')
+        slower = (ratio > 1 + tolerance and new - old > MIN_DELTA_MS)
+        if slower:
+            regressions.append(stage)
+        print(f'{stage:<22}{old:10.2f}{new:10.2f}{ratio:8.2f}'
+              f'{"  REGRESSION" if slower else ""}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Time each stage of the detection pipeline (JSON '
+                    'report) and compare runs to catch regressions')
+    parser.add_argument('--images', default='glaucoma-cases',
+                        help='folder of bundled fundus images')
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='use this many synthetic images instead')
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--no-models', action='store_true',
+                        help='skip model stages (placeholder outputs)')
+    parser.add_argument('--backend', default=None,
+                        choices=('keras', 'tflite'))
+    parser.add_argument('--profile', default=None,
+                        choices=('fast', 'balanced', 'accurate'))
+    parser.add_argument('--output', default=None,
+                        help='write the JSON report to a file')
+    parser.add_argument('--compare', default=None,
+                        help='baseline JSON report (or two reports: '
+                             'baseline,new to compare without running)')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    files = args.compare.split(',') if args.compare else []
+    if len(files) == 2:
+        with open(files[1]) as f:
+            report = json.load(f)
+    else:
+        report = run_suite(args.images, args.synthetic, args.limit,
+                           args.repeats, not args.no_models, args.backend,
+                           args.profile)
+        print_report(report)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+    if files:
+        with open(files[0]) as f:
+            baseline = json.load(f)
+        print()
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print(f'ERROR: {len(regressions)} stages regressed: '
+                  f'{", ".join(regressions)}')
+            sys.exit(1)
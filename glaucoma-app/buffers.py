@@ -0,0 +1,156 @@
+from multiprocessing.shared_memory import SharedMemory
+from collections import namedtuple
+from threading import Condition
+
+import numpy as np
+
+
+# Buffer sizes are rounded up to this block size so they can be reused
+BLOCK_SIZE = 1 << 20
+# Default memory ceiling of a pool (bytes)
+POOL_BYTES = 512 << 20
+
+# Picklable reference to a pool buffer (what is sent between processes)
+# The generation of the pool counts its unlinked buffers.
+BufferHandle = namedtuple('BufferHandle',
+                          ('name', 'shape', 'dtype', 'generation'))
+
+# Shared memory attached by this process (name -> SharedMemory), and the
+# newest pool generation it has seen
+attached = {}
+generation = 0
+
+
+def view(handle):
+    ''' Get array of a buffer handle (any process, no copy)
+        Shared memory is attached once per process and kept attached, as
+        pool buffers are recycled under the same names. When the pool has
+        unlinked buffers since (newer generation), all segments are
+        detached so stale ones are not kept mapped. Worker processes
+        share the resource tracker of the pool owner, so attaching does
+        not need to unregister the memory (see inference.py).
+    '''
+    global generation
+    if handle.generation > generation:
+        detach()
+        generation = handle.generation
+    shm = attached.get(handle.name)
+    if shm is None:
+        shm = attached[handle.name] = SharedMemory(name=handle.name)
+    return np.ndarray(handle.shape, handle.dtype, shm.buf)
+
+
+def detach():
+    ''' Close shared memory attached by this process (segments still
+        used by arrays stay attached)
+    '''
+    for name, shm in list(attached.items()):
+        try:
+            shm.close()
+        except BufferError:
+            continue
+        del attached[name]
+
+
+def block_size(nbytes):
+    ''' Round size up to whole blocks '''
+    return max(1, -(-nbytes // BLOCK_SIZE)) * BLOCK_SIZE
+
+
+class BufferPool:
+    ''' Shared memory buffers of decoded images, ROIs and masks
+        Buffers are owned by the process that created the pool: it
+        allocates them, passes their handles to worker processes, and
+        releases them when they are no longer used. Released buffers are
+        recycled for requests of the same block size, and the total size
+        of all buffers never exceeds max_bytes (free buffers of other
+        sizes are unlinked to make room).
+    '''
+
+    def __init__(self, max_bytes=POOL_BYTES):
+        self.max_bytes, self.total = max_bytes, 0
+        # Number of buffers unlinked so far (see view)
+        self.generation = 0
+        # All buffers by name, and free buffers by size
+        self.buffers, self.free = {}, {}
+        self.cond = Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def try_allocate(self, shape, dtype=np.uint8):
+        ''' Get handle of a buffer (None if the pool is full) '''
+        shape, dtype = tuple(int(n) for n in shape), np.dtype(dtype).str
+        size = block_size(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        if size > self.max_bytes:
+            raise MemoryError(f'Buffer of {size} bytes exceeds pool '
+                              f'ceiling ({self.max_bytes} bytes)')
+        with self.cond:
+            if self.free.get(size):
+                shm = self.free[size].pop()
+            else:
+                # Unlink free buffers of other sizes until there is room
+                while self.total + size > self.max_bytes and self._evict():
+                    pass
+                if self.total + size > self.max_bytes:
+                    return None
+                shm = SharedMemory(create=True, size=size)
+                self.buffers[shm.name] = shm
+                self.total += size
+        return BufferHandle(shm.name, shape, dtype, self.generation)
+
+    def allocate(self, shape, dtype=np.uint8, timeout=None):
+        ''' Get handle of a buffer, waiting for a release if the pool is
+            full (None on timeout)
+        '''
+        with self.cond:
+            handle = self.try_allocate(shape, dtype)
+            if handle is None:
+                self.cond.wait_for(lambda: self._has_room(shape, dtype),
+                                   timeout)
+                handle = self.try_allocate(shape, dtype)
+        return handle
+
+    def view(self, handle):
+        ''' Get array of a buffer of this pool (no copy) '''
+        return np.ndarray(handle.shape, handle.dtype,
+                          self.buffers[handle.name].buf)
+
+    def release(self, handle):
+        ''' Give a buffer back to the pool (its arrays become invalid) '''
+        with self.cond:
+            shm = self.buffers[handle.name]
+            self.free.setdefault(shm.size, []).append(shm)
+            self.cond.notify_all()
+
+    def close(self):
+        ''' Unlink all buffers '''
+        with self.cond:
+            for shm in self.buffers.values():
+                shm.close()
+                shm.unlink()
+            self.generation += len(self.buffers)
+            self.buffers.clear()
+            self.free.clear()
+            self.total = 0
+
+    def _has_room(self, shape, dtype):
+        size = block_size(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        free = sum(len(shms) * n for n, shms in self.free.items())
+        return self.total - free + size <= self.max_bytes
+
+    def _evict(self):
+        ''' Unlink one free buffer (False if there is none) '''
+        for size, shms in self.free.items():
+            if shms:
+                shm = shms.pop()
+                del self.buffers[shm.name]
+                self.total -= shm.size
+                self.generation += 1
+                shm.close()
+                shm.unlink()
+                return True
+        return False
@@ -1,4 +1,3 @@
-from keras.models import load_model
 import numpy as np
 
 
@@ -34,6 +33,8 @@ class DetectionRateModel:
         try:
             # See if file exists
             open(model_filename, 'r')
+            # Import keras only when the model is created (slow import)
+            from keras.models import load_model
             # Load CDR model
             self.model = load_model(model_filename)
         except FileNotFoundError:
@@ -0,0 +1,203 @@
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from os import path, listdir
+import argparse
+import csv
+
+import numpy as np
+import cv2
+
+
+# Mask thresholds: the app saves 255 background, 128 disc, 1 cup (REFUGE
+# ground truth uses 0 for cup, which is also below CUP_BELOW)
+DISC_BELOW = 192
+CUP_BELOW = 64
+# Images segmented per predict call (predictions made by the harness)
+EVAL_BATCH = 8
+# Columns of the per-image table (and order of the summary)
+METRICS = ('disc_dice', 'cup_dice', 'disc_iou', 'cup_iou', 'cdr_pred',
+           'cdr_true', 'cdr_error', 'isnt_agree', 'isnt_match')
+
+
+def list_images(folder, limit=None, ext='.jpg'):
+    ''' Get images (or masks, ext='.png') of a folder (sorted, crop files
+        excluded)
+    '''
+    files = sorted(f for f in listdir(folder)
+                   if f.lower().endswith(ext) and not f.endswith('_mod.jpg'))
+    return [path.join(folder, f) for f in files[:limit]]
+
+
+def read_mask(filename):
+    ''' Read a mask (grayscale, None if missing) '''
+    return cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+
+
+def mask_planes(mask):
+    ''' Get disc and cup planes (2, H, W) of a mask (disc includes cup) '''
+    return np.stack((mask < DISC_BELOW, mask < CUP_BELOW))
+
+
+def plane_boxes(planes):
+    ''' Get bounding boxes (top, bottom, left, right) of planes (P, H, W)
+        Empty planes get NaN boxes.
+    '''
+    rows, cols = planes.any(axis=2), planes.any(axis=1)
+    h, w = planes.shape[1:]
+    # First and last row/column of each plane
+    boxes = np.stack((rows.argmax(axis=1), h - 1 - rows[:, ::-1].argmax(axis=1),
+                      cols.argmax(axis=1), w - 1 - cols[:, ::-1].argmax(axis=1)),
+                     axis=1).astype(np.float64)
+    boxes[~rows.any(axis=1)] = np.nan
+    return boxes
+
+
+def cdr_isnt(boxes):
+    ''' Get vertical CDR and ISNT rules (i >= s, s >= n, n >= t) from disc
+        and cup boxes, with the rim convention of shapes.isnt_widths
+    '''
+    (dt, db, dl, dr), (ct, cb, cl, cr) = boxes
+    cdr = (cb - ct + 1) / (db - dt + 1)
+    i, s, n, t = ct - dt, db - cb, dr - cr, cl - dl
+    return cdr, np.array((i >= s, s >= n, n >= t))
+
+
+def score_masks(pred, truth):
+    ''' Score a predicted mask against its ground truth
+        Dice/IoU of disc and cup are reduced together over (2, H, W)
+        planes. Dice and IoU are 1 if both planes are empty.
+    '''
+    p, t = mask_planes(pred), mask_planes(truth)
+    inter = np.logical_and(p, t).sum(axis=(1, 2))
+    sums = p.sum(axis=(1, 2)) + t.sum(axis=(1, 2))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dice = np.where(sums == 0, 1.0, 2 * inter / sums)
+        iou = np.where(sums == 0, 1.0, inter / (sums - inter))
+    cdr_pred, isnt_pred = cdr_isnt(plane_boxes(p))
+    cdr_true, isnt_true = cdr_isnt(plane_boxes(t))
+    return {'disc_dice': dice[0], 'cup_dice': dice[1],
+            'disc_iou': iou[0], 'cup_iou': iou[1],
+            'cdr_pred': cdr_pred, 'cdr_true': cdr_true,
+            'cdr_error': abs(cdr_pred - cdr_true),
+            # Rules that agree, and the ISNT result (2 of 3 rules)
+            'isnt_agree': np.mean(isnt_pred == isnt_true),
+            'isnt_match': float((isnt_pred.sum() >= 2)
+                                == (isnt_true.sum() >= 2))}
+
+
+def score_files(pred_file, truth_file):
+    ''' Score mask files (None if one of them cannot be read) '''
+    pred, truth = read_mask(pred_file), read_mask(truth_file)
+    if pred is None or truth is None or pred.shape != truth.shape:
+        return None
+    return score_masks(pred, truth)
+
+
+def mask_name(file):
+    ''' Get mask name of an image or mask file (name.png) '''
+    return path.splitext(path.basename(file))[0] + '.png'
+
+
+def evaluate_masks(pred_dir, truth_dir, workers=None):
+    ''' Score saved masks of a folder against ground truth masks (in
+        parallel), returns (name, scores) of each ground truth mask
+    '''
+    names = [path.basename(f) for f in list_images(truth_dir, ext='.png')]
+    with ProcessPoolExecutor(workers) as pool:
+        scores = pool.map(score_files,
+                          [path.join(pred_dir, name) for name in names],
+                          [path.join(truth_dir, name) for name in names],
+                          chunksize=8)
+        return list(zip(names, scores))
+
+
+def evaluate_model(image_dir, truth_dir, workers=None, batch=EVAL_BATCH,
+                   backend=None, profile=None, tta=None, limit=None):
+    ''' Segment images in batches of batch with segment_batch and score
+        their masks against ground truth masks while the next batch is
+        segmented
+        Returns (name, scores) of each image and segmentation s/image.
+    '''
+    import mnet_segmentation as mnet_seg
+    from fundus import open_image
+
+    files = list_images(image_dir, limit)
+    mnet_seg.warmup(backend, profile)
+    results, elapsed = [], 0.0
+    with ProcessPoolExecutor(workers) as pool:
+        for start in range(0, len(files), batch):
+            chunk = files[start:start + batch]
+            images = [open_image(file).rgb for file in chunk]
+            t0 = perf_counter()
+            masks = mnet_seg.segment_batch(images, None, backend, profile,
+                                           tta)
+            elapsed += perf_counter() - t0
+            for file, mask in zip(chunk, masks):
+                truth = read_mask(path.join(truth_dir, mask_name(file)))
+                results.append((mask_name(file),
+                                None if mask is None or truth is None
+                                else pool.submit(score_masks, mask, truth)))
+        results = [(name, None if future is None else future.result())
+                   for name, future in results]
+    return results, elapsed / max(len(files), 1)
+
+
+def write_table(results, filename):
+    ''' Write per-image scores (CSV, empty cells for failed images) '''
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(('image',) + METRICS)
+        for name, scores in results:
+            writer.writerow((name,) + tuple(
+                '' if scores is None else f'{scores[m]:.4f}'
+                for m in METRICS))
+
+
+def summary(results, seconds=None):
+    ''' Print mean, standard deviation and median of each metric '''
+    scores = [s for _, s in results if s is not None]
+    print(f'{len(scores)} of {len(results)} images scored'
+          + ('' if seconds is None else f', {seconds:.3f} s/image'))
+    if not scores:
+        return
+    table = np.array([[s[m] for m in METRICS] for s in scores])
+    print(f'{"Metric":<12}{"Mean":>9}{"Std":>9}{"Median":>9}')
+    for m, mean, std, median in zip(METRICS, np.nanmean(table, axis=0),
+                                    np.nanstd(table, axis=0),
+                                    np.nanmedian(table, axis=0)):
+        print(f'{m:<12}{mean:9.4f}{std:9.4f}{median:9.4f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Score segmentation masks against ground truth masks '
+                    '(Dice/IoU of disc and cup, vertical CDR error, ISNT '
+                    'agreement)')
+    parser.add_argument('truth', help='folder of ground truth masks '
+                                      '(name.png)')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--masks', help='folder of predicted masks')
+    source.add_argument('--images', help='folder of images to segment')
+    parser.add_argument('--table', default=None,
+                        help='write per-image scores to a CSV file')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--batch', type=int, default=EVAL_BATCH)
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--backend', default=None,
+                        choices=('keras', 'tflite'))
+    parser.add_argument('--profile', default=None,
+                        choices=('fast', 'balanced', 'accurate'))
+    parser.add_argument('--tta', action='store_true', default=None)
+    args = parser.parse_args()
+
+    if args.masks:
+        results, seconds = evaluate_masks(args.masks, args.truth,
+                                          args.workers), None
+    else:
+        results, seconds = evaluate_model(args.images, args.truth,
+                                          args.workers, args.batch,
+                                          args.backend, args.profile,
+                                          args.tta, args.limit)
+    if args.table:
+        write_table(results, args.table)
+    summary(results, seconds)
@@ -0,0 +1,88 @@
+from collections import OrderedDict
+from threading import Lock
+
+from PIL import Image
+import cv2
+
+
+# Number of decoded images kept by open_image (current image and its
+# prefetched neighbors)
+CACHE_IMAGES = 3
+
+# Decoded images by filename (least recently used first)
+images = OrderedDict()
+images_lock = Lock()
+
+
+class FundusImage:
+    ''' Fundus image file decoded once and shared by all its consumers
+        The file is decoded (BGR, as cv2) on first use, RGB and gray views
+        are converted on first use and cached. ROIs are numpy views of
+        these arrays (no copy), so consumers must not modify them.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._views = {}
+        self._lock = Lock()
+
+    def __str__(self):
+        return f'FundusImage({self.filename})'
+
+    @property
+    def size(self):
+        ''' Image (width, height), read from file header if not decoded '''
+        if 'bgr' in self._views:
+            h, w = self._views['bgr'].shape[:2]
+            return w, h
+        with Image.open(self.filename) as img:
+            return img.size
+
+    @property
+    def bgr(self):
+        return self._view('bgr')
+
+    @property
+    def rgb(self):
+        return self._view('rgb')
+
+    @property
+    def gray(self):
+        return self._view('gray')
+
+    def roi(self, region, view='rgb'):
+        ''' Get region (x1, y1, x2, y2) of a view (no copy) '''
+        x1, y1, x2, y2 = region
+        return self._view(view)[y1:y2, x1:x2]
+
+    def _view(self, view):
+        ''' Get a view (decode or convert it once) '''
+        with self._lock:
+            if view not in self._views:
+                if 'bgr' not in self._views:
+                    self._store('bgr', cv2.imread(self.filename))
+                if view == 'rgb':
+                    self._store(view, cv2.cvtColor(self._views['bgr'],
+                                                   cv2.COLOR_BGR2RGB))
+                elif view == 'gray':
+                    self._store(view, cv2.cvtColor(self._views['bgr'],
+                                                   cv2.COLOR_BGR2GRAY))
+            return self._views[view]
+
+    def _store(self, view, array):
+        if array is None:
+            raise FileNotFoundError(self.filename)
+        # Views are shared, make them read-only
+        array.flags.writeable = False
+        self._views[view] = array
+
+
+def open_image(filename):
+    ''' Get FundusImage of a file (shared by all callers) '''
+    with images_lock:
+        image = images.pop(filename, None) or FundusImage(filename)
+        images[filename] = image
+        # Forget least recently used images
+        while len(images) > CACHE_IMAGES:
+            images.popitem(last=False)
+    return image
@@ -1,4 +1,6 @@
 from PyQt5.QtGui import QImage as qi
+from shapes import Ellipse, moments_ellipse
+from tracing import traced
 import numpy as np
 import cv2
 
@@ -44,6 +46,7 @@ def get_boundary_info(img, c1, c2):
     return cv2.boundingRect(contours[-1]), cv2.contourArea(contours[-1])
 
 
+@traced()
 def get_boundaries_info(img):
     ''' Get boundaries of of mask '''
     # Convert image to grayscale
@@ -53,6 +56,36 @@ def get_boundaries_info(img):
             get_boundary_info(pix, 128, 255))
 
 
+def fit_mask_region(pix, thresh):
+    ''' Fit an ellipse to the region of a grayscale mask below thresh '''
+    # Binary region and its bounding box (ROI)
+    binary = cv2.inRange(pix, 0, thresh)
+    x, y, w, h = cv2.boundingRect(binary)
+    if w == 0 or h == 0:
+        return None
+    # Moments of the ROI only
+    m = cv2.moments(binary[y:y+h, x:x+w], True)
+    if m['m00'] < 3:
+        return None
+    cx, cy = m['m10'] / m['m00'], m['m01'] / m['m00']
+    mu20, mu11, mu02 = (m[k] / m['m00'] for k in ('mu20', 'mu11', 'mu02'))
+    handles = moments_ellipse(cx, cy, mu20, mu11, mu02)
+    # Move handles from ROI to image coordinates
+    return Ellipse(*(handles + (x, y)).ravel())
+
+
+@traced()
+def fit_mask_ellipses(img):
+    ''' Fit disc/cup ellipses to a segmented mask (image coordinates)
+        Mask values are 255 for background, 128 for disc and 1 for cup.
+    '''
+    # Convert image to grayscale
+    pix = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    # Disc region includes the cup
+    return fit_mask_region(pix, 191), fit_mask_region(pix, 63)
+
+
+@traced()
 def colorize_mask(cv2i, scale, disc_alpha, cup_alpha, disc_color, cup_color):
     ''' Colorize mask using color and alpha and scale if passed '''
     # Get color channels of each mask layer
@@ -75,6 +108,7 @@ def colorize_mask(cv2i, scale, disc_alpha, cup_alpha, disc_color, cup_color):
     return cvImage_to_qImageA(pix)
 
 
+@traced()
 def edit_contrast(cv2i, value=0):
     ''' Edit contrast of CV2 image '''
     # Map value between [-127, 127] instead of [-255, 255]
@@ -88,6 +122,7 @@ def edit_contrast(cv2i, value=0):
     return cv2i
 
 
+@traced()
 def edit_image_of(cv2i, key, value=0):
     ''' Edit HSV channels '''
     # Make sure value is not zero (zero = no change)
@@ -102,6 +137,7 @@ def edit_image_of(cv2i, key, value=0):
         return cv2i
 
 
+@traced()
 def cvImage_to_qImage(cv2i):
     ''' Convert CV2Image to QImage '''
     # Get channels
@@ -114,6 +150,7 @@ def cvImage_to_qImage(cv2i):
               qi.Format_RGB888).rgbSwapped()
 
 
+@traced()
 def cvImage_to_qImageA(cv2i):
     ''' Convert CV2Image to QImage with alpha channel '''
     # Convert RGB to RGBA (with alpha)
@@ -140,6 +177,7 @@ def qImage_to_cvImage(qpix):
     return np.frombuffer(byte_str, dtype=np.uint8).reshape((w, h, 4))
 
 
+@traced()
 def blur_qImage(qpix, ksize):
     ''' Blur QImage '''
     # Convert QImage to CV2Image without alpha channel
@@ -0,0 +1,191 @@
+from threading import Lock
+from os import path, stat, environ, makedirs
+from time import time
+import hashlib
+import sqlite3
+import sys
+
+import numpy as np
+
+
+# Index database (in the user data folder, GLAUCOMA_INDEX to override)
+INDEX_PATH = environ.get('GLAUCOMA_INDEX') or path.join(
+    environ.get('APPDATA') or environ.get('XDG_DATA_HOME')
+    or path.join(path.expanduser('~'), '.local', 'share'),
+    'glaucoma-app', 'image_index.db')
+# Number of hashes in one lookup query
+QUERY_CHUNK = 500
+
+# Columns of each record field (records are keyed by image hash)
+COLUMNS = {
+    'path': ('path',),
+    'crop': ('crop_x1', 'crop_y1', 'crop_x2', 'crop_y2'),
+    'mask': ('mask',),
+    # Ellipse handles (center and two axis points, image coordinates)
+    'disc': ('disc_cx', 'disc_cy', 'disc_px', 'disc_py', 'disc_qx', 'disc_qy'),
+    'cup': ('cup_cx', 'cup_cy', 'cup_px', 'cup_py', 'cup_qx', 'cup_qy'),
+    'cdr': ('cdr',),
+    'isnt': ('isnt_i', 'isnt_s', 'isnt_n', 'isnt_t'),
+    'detection_rate': ('detection_rate',),
+    'updated': ('updated',),
+}
+TYPES = {'path': 'TEXT', 'mask': 'TEXT', 'crop': 'INTEGER'}
+
+# Hashes of files (filename -> (mtime, size, hash))
+hashes = {}
+# Index of the app (see get_index)
+index, index_lock = None, Lock()
+
+
+def image_hash(filename):
+    ''' Get content hash of an image file (cached until it changes) '''
+    st = stat(filename)
+    cached = hashes.get(filename)
+    if cached is not None and cached[:2] == (st.st_mtime, st.st_size):
+        return cached[2]
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    hashes[filename] = (st.st_mtime, st.st_size, digest.hexdigest())
+    return hashes[filename][2]
+
+
+def encode(field, value):
+    ''' Get column values of a record field '''
+    if value is None:
+        return (None,) * len(COLUMNS[field])
+    if field in ('disc', 'cup'):
+        # Circle/Ellipse or their handles
+        if hasattr(value, 'to_ellipse'):
+            value = value.to_ellipse()
+        return tuple(float(v) for v in np.ravel(value))
+    if field in ('crop', 'isnt'):
+        cast = int if field == 'crop' else float
+        return tuple(cast(v) for v in value)
+    return (float(value) if field in ('cdr', 'detection_rate') else value,)
+
+
+def decode(row):
+    ''' Get record (field -> value) of a row (hash, columns...) '''
+    record, i = {'hash': row[0]}, 1
+    for field, columns in COLUMNS.items():
+        values = row[i:i + len(columns)]
+        i += len(columns)
+        if len(columns) == 1:
+            record[field] = values[0]
+        elif values[0] is None:
+            record[field] = None
+        elif field in ('disc', 'cup'):
+            record[field] = np.array(values).reshape(3, 2)
+        else:
+            record[field] = tuple(values)
+    return record
+
+
+class ImageIndex:
+    ''' Per-image metadata (crop region, mask location, disc/cup geometry,
+        CDR, ISNT and detection rate) in a SQLite database
+        Records are keyed by the hash of the image content, so renamed or
+        copied images keep their record, and changed images get a new
+        one. Fields that are not passed to update keep their value.
+    '''
+
+    def __init__(self, filename=INDEX_PATH):
+        self.filename = filename
+        makedirs(path.dirname(path.abspath(filename)), exist_ok=True)
+        # Shared by the GUI and job threads (serialized by the lock)
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = Lock()
+        columns = ', '.join(f'{c} {TYPES.get(f, "REAL")}'
+                            for f, cs in COLUMNS.items() for c in cs)
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS images '
+                            f'(hash TEXT PRIMARY KEY, {columns})')
+        self.select = ('SELECT hash, ' +
+                       ', '.join(c for cs in COLUMNS.values() for c in cs) +
+                       ' FROM images')
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def get(self, filename):
+        ''' Get record of an image (None if not indexed or not found) '''
+        return self.get_many([filename]).get(filename)
+
+    def get_many(self, filenames):
+        ''' Get records of images (filename -> record, indexed only) '''
+        keys = {}
+        for filename in filenames:
+            try:
+                keys[image_hash(filename)] = filename
+            except OSError:
+                pass
+        records, hashes = {}, list(keys)
+        with self.lock:
+            for i in range(0, len(hashes), QUERY_CHUNK):
+                chunk = hashes[i:i + QUERY_CHUNK]
+                marks = ', '.join('?' * len(chunk))
+                for row in self.db.execute(f'{self.select} WHERE hash IN '
+                                           f'({marks})', chunk):
+                    records[keys[row[0]]] = decode(row)
+        return records
+
+    def query(self, where='', params=()):
+        ''' Get records matching an SQL condition on the columns
+            e.g. query('cdr >= ? AND mask IS NOT NULL', (0.65,))
+        '''
+        sql = f'{self.select} WHERE {where}' if where else self.select
+        with self.lock:
+            return [decode(row) for row in self.db.execute(sql, params)]
+
+    def update(self, filename, **fields):
+        ''' Insert/update fields of an image record '''
+        self.update_many([(filename, fields)])
+
+    def update_many(self, records):
+        ''' Insert/update fields of many images in one transaction
+            records is an iterable of (filename, {field: value}).
+        '''
+        # Group rows by their fields (one statement per group)
+        groups, now = {}, time()
+        for filename, fields in records:
+            fields = dict(fields, path=path.abspath(filename), updated=now)
+            names = tuple(sorted(fields))
+            row = [image_hash(filename)]
+            for field in names:
+                row.extend(encode(field, fields[field]))
+            groups.setdefault(names, []).append(row)
+        with self.lock, self.db:
+            for names, rows in groups.items():
+                columns = [c for field in names for c in COLUMNS[field]]
+                self.db.executemany(
+                    f'INSERT INTO images (hash, {", ".join(columns)}) '
+                    f'VALUES ({", ".join("?" * (len(columns) + 1))}) '
+                    'ON CONFLICT(hash) DO UPDATE SET ' +
+                    ', '.join(f'{c}=excluded.{c}' for c in columns), rows)
+
+
+def get_index():
+    ''' Get image index of the app (opened on first use) '''
+    global index
+    with index_lock:
+        if index is None:
+            index = ImageIndex()
+    return index
+
+
+if __name__ == '__main__':
+    # Cohort report: python image_index.py [SQL condition]
+    where = ' '.join(sys.argv[1:])
+    print(f'{"Image":<24}{"CDR":>7}{"I":>7}{"S":>7}{"N":>7}{"T":>7}'
+          f'{"Rate":>7}')
+    for record in get_index().query(where):
+        isnt = record['isnt'] or (float('nan'),) * 4
+        cdr, rate = (float('nan') if record[f] is None else record[f]
+                     for f in ('cdr', 'detection_rate'))
+        print(f'{path.basename(record["path"] or "?"):<24}{cdr:7.3f}'
+              + ''.join(f'{v:7.1f}' for v in isnt) + f'{rate:7.3f}')
@@ -0,0 +1,228 @@
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+import socketserver
+import argparse
+import socket
+import struct
+import json
+import os
+
+import numpy as np
+
+
+# Inference server socket (Unix socket on localhost)
+SOCKET_PATH = os.environ.get('GLAUCOMA_INFERENCE_SOCKET',
+                             '/tmp/glaucoma-inference.sock')
+# Message header (big-endian message length)
+HEADER = struct.Struct('!I')
+# Seconds to wait for the server to accept and answer a ping, and for a
+# segmentation reply (clients segment in-process when they expire)
+CONNECT_TIMEOUT = 2.0
+REQUEST_TIMEOUT = 60.0
+
+
+def send_message(sock, message):
+    ''' Send a JSON message (length-prefixed) '''
+    data = json.dumps(message).encode()
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def recv_exactly(sock, size):
+    ''' Receive exactly size bytes (None if connection is closed) '''
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def recv_message(sock):
+    ''' Receive a JSON message (None if connection is closed) '''
+    header = recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    data = recv_exactly(sock, HEADER.unpack(header)[0])
+    return None if data is None else json.loads(data)
+
+
+def attach_shared_memory(name):
+    ''' Attach to shared memory created by another process
+        The creator owns (and unlinks) the memory, so this process must
+        not track it, otherwise it is unlinked when this process exits.
+    '''
+    shm = SharedMemory(name=name)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def connect(socket_path=SOCKET_PATH, timeout=CONNECT_TIMEOUT):
+    ''' Connect to the inference server (None if it is not running)
+        timeout applies to the connection and to each later socket call.
+    '''
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def is_running(socket_path=SOCKET_PATH):
+    ''' Check if the inference server is running '''
+    sock = connect(socket_path)
+    if sock is None:
+        return False
+    with sock:
+        try:
+            send_message(sock, {'op': 'ping'})
+            reply = recv_message(sock)
+        except OSError:
+            return False
+    return reply is not None and reply['ok']
+
+
+def request_mask(name, image=None, socket_path=SOCKET_PATH,
+                 timeout=REQUEST_TIMEOUT):
+    ''' Ask the inference server to segment an image
+        The image is read by the server from the test data path using its
+        name, or passed as an RGB array through shared memory. Returns the
+        reply ({'ok', 'output'}) or None if the server is not running or
+        does not answer within timeout seconds.
+    '''
+    sock = connect(socket_path)
+    if sock is None:
+        return None
+    # Segmentation takes longer than the connection
+    sock.settimeout(timeout)
+    message, shm = {'op': 'segment', 'name': name}, None
+    with sock:
+        try:
+            if image is not None:
+                # Copy image to shared memory instead of sending it
+                shm = SharedMemory(create=True, size=image.nbytes)
+                np.ndarray(image.shape, image.dtype, shm.buf)[:] = image
+                message.update(shm=shm.name, shape=list(image.shape),
+                               dtype=str(image.dtype))
+            send_message(sock, message)
+            return recv_message(sock)
+        except OSError as error:
+            print(f'ERROR: Inference server did not segment {name}: {error}')
+            return None
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+
+class RequestHandler(socketserver.BaseRequestHandler):
+    ''' Handle messages of one client connection '''
+
+    def handle(self):
+        while True:
+            message = recv_message(self.request)
+            if message is None:
+                return
+            send_message(self.request, self.server.handle_message(message))
+
+
+class InferenceServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+    ''' Local inference server owning the DiscSeg and M-Net models
+        Each connection is handled by its own thread, and concurrent
+        requests are batched by the mnet_segmentation schedulers.
+    '''
+    daemon_threads = True
+
+    def __init__(self, socket_path=SOCKET_PATH):
+        # Remove socket left by a server that has not exited cleanly
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, RequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+    def handle_message(self, message):
+        ''' Get reply of a message (connection thread) '''
+        import mnet_segmentation as mnet_seg
+        op = message.get('op')
+        if op == 'ping':
+            return {'ok': True}
+        elif op == 'metrics':
+            return {'ok': True, 'metrics': mnet_seg.batching_metrics()}
+        elif op == 'segment':
+            name = message['name']
+            try:
+                if 'shm' in message:
+                    # Copy image out of the client shared memory
+                    shm = attach_shared_memory(message['shm'])
+                    image = np.ndarray(message['shape'], message['dtype'],
+                                       shm.buf).copy()
+                    shm.close()
+                else:
+                    image = mnet_seg.load_image(name)
+                mask = mnet_seg.segment_image(image)
+                return {'ok': True, 'output': mnet_seg.save_mask(mask, name)}
+            except Exception as error:
+                print(f'ERROR: Segmentation of {name} failed: {error}')
+                return {'ok': False, 'output': None, 'error': str(error)}
+        return {'ok': False, 'error': f'Unknown operation: {op}'}
+
+
+def get_metrics(socket_path=SOCKET_PATH):
+    ''' Get batching metrics of the server (None if it is not running) '''
+    sock = connect(socket_path)
+    if sock is None:
+        return None
+    with sock:
+        try:
+            send_message(sock, {'op': 'metrics'})
+            reply = recv_message(sock)
+        except OSError:
+            return None
+    return None if reply is None else reply['metrics']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Glaucoma inference server')
+    parser.add_argument('--socket', default=SOCKET_PATH)
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='maximum requests per predict call')
+    parser.add_argument('--batch-wait-ms', type=float, default=None,
+                        help='maximum wait of a request for its batch')
+    parser.add_argument('--backend', default=None,
+                        choices=('keras', 'tflite'),
+                        help='float32 Keras or int8 TFLite models')
+    parser.add_argument('--profile', default=None,
+                        choices=('fast', 'balanced', 'accurate'),
+                        help='input sizes of the models (speed profile)')
+    parser.add_argument('--tta', action='store_true',
+                        help='average M-Net over flipped and rotated inputs')
+    args = parser.parse_args()
+
+    from mnet_segmentation import warmup, configure_batching
+    from mnet_segmentation import set_backend, set_profile, set_tta
+    if args.backend is not None:
+        set_backend(args.backend)
+    if args.profile is not None:
+        set_profile(args.profile)
+    if args.tta:
+        set_tta(True)
+    # Load models before accepting requests
+    warmup()
+    configure_batching(args.batch_size, None if args.batch_wait_ms is None
+                       else args.batch_wait_ms / 1000)
+    with InferenceServer(args.socket) as server:
+        print(f'Inference server is listening on {args.socket}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,161 @@
+from PyQt5 import QtCore
+from itertools import count
+from threading import Event
+
+
+# Job priorities (higher priority jobs start first)
+PRIORITY_LOW, PRIORITY_HIGH = 0, 10
+# Time to wait for running jobs on shutdown (milliseconds)
+SHUTDOWN_TIMEOUT = 2000
+
+
+class JobCancelled(Exception):
+    ''' Raised by CancelToken.check when the job has been cancelled '''
+
+
+class CancelToken:
+    ''' Cancellation flag shared between a job and its function
+        Job functions call check() between stages to stop early.
+    '''
+
+    def __init__(self):
+        self._event = Event()
+
+    def cancel(self):
+        ''' Request cancellation '''
+        self._event.set()
+
+    def cancelled(self):
+        ''' Check if cancellation has been requested '''
+        return self._event.is_set()
+
+    def check(self):
+        ''' Raise JobCancelled if cancellation has been requested '''
+        if self._event.is_set():
+            raise JobCancelled()
+
+
+class Job(QtCore.QRunnable):
+    ''' A function call running on the JobManager thread pool
+        The function is called as fn(*args, token=CancelToken).
+    '''
+
+    def __init__(self, manager, job_id, name, image, fn, args, priority):
+        super().__init__()
+        # The manager keeps the reference until the result is delivered
+        self.setAutoDelete(False)
+        self.manager = manager
+        self.id, self.name, self.image = job_id, name, image
+        self.fn, self.args, self.priority = fn, args, priority
+        self.token = CancelToken()
+        self.callbacks = []
+        self.result, self.error = None, None
+
+    def run(self):
+        try:
+            # Do not start cancelled jobs
+            self.token.check()
+            self.result = self.fn(*self.args, token=self.token)
+        except JobCancelled:
+            self.token.cancel()
+        except Exception as error:
+            self.error = error
+        # Deliver result on the GUI thread (queued signal)
+        self.manager.done.emit(self)
+
+
+class JobManager(QtCore.QObject):
+    ''' Run background jobs (cropping, segmentation, ...) of images
+        Jobs are identified by (image, name), so the same job is never
+        queued twice. Results are delivered to callbacks on the GUI thread,
+        and results of cancelled jobs or of images that are no longer
+        shown are dropped. Low priority (background) jobs are bounded.
+    '''
+    # Emitted by jobs when they finish (connected to _deliver)
+    done = QtCore.pyqtSignal(object)
+
+    def __init__(self, workers=2, max_background=4):
+        super().__init__()
+        # Thread pool of the manager (not the global one)
+        self.pool = QtCore.QThreadPool()
+        self.pool.setMaxThreadCount(workers)
+        self.max_background = max_background
+        # Current image, jobs by (image, name) and job ids
+        self.image, self.jobs, self.ids = None, {}, count(1)
+        self.done.connect(self._deliver)
+
+    def set_image(self, image):
+        ''' Set current image
+            Foreground jobs of other images are cancelled, background jobs
+            keep running (they fill caches) but their callbacks are dropped.
+        '''
+        self.image = image
+        for job in list(self.jobs.values()):
+            if job.image is not None and job.image != image:
+                job.callbacks.clear()
+                if job.priority > PRIORITY_LOW:
+                    self.cancel_job(job)
+
+    def background_count(self):
+        ''' Get number of unfinished background jobs '''
+        return sum(job.priority <= PRIORITY_LOW for job in self.jobs.values())
+
+    def submit(self, name, fn, *args, image=None, priority=PRIORITY_HIGH,
+               callback=None):
+        ''' Submit a job (or join the unfinished job with the same key)
+            Returns the job, or None if the background queue is full.
+        '''
+        job = self.jobs.get((image, name))
+        if job is not None:
+            # Promote a queued background job to foreground
+            if priority > job.priority:
+                if self.pool.tryTake(job):
+                    self.pool.start(job, priority)
+                job.priority = priority
+        else:
+            # Bound number of background jobs
+            if priority <= PRIORITY_LOW and \
+               self.background_count() >= self.max_background:
+                return None
+            job = Job(self, next(self.ids), name, image, fn, args, priority)
+            self.jobs[(image, name)] = job
+            self.pool.start(job, priority)
+        if callback is not None:
+            job.callbacks.append(callback)
+        return job
+
+    def cancel_job(self, job):
+        ''' Cancel a job (removed from the queue if not started yet)
+            The job is forgotten right away, so a later submit of the same
+            key starts a new job instead of joining the cancelled one.
+        '''
+        job.token.cancel()
+        job.callbacks.clear()
+        self.pool.tryTake(job)
+        if self.jobs.get((job.image, job.name)) is job:
+            del self.jobs[(job.image, job.name)]
+
+    def cancel(self, image=None):
+        ''' Cancel all jobs (of an image if passed) '''
+        for job in list(self.jobs.values()):
+            if image is None or job.image == image:
+                self.cancel_job(job)
+
+    def shutdown(self):
+        ''' Cancel all jobs and wait for running jobs to stop '''
+        self.cancel()
+        self.pool.clear()
+        self.pool.waitForDone(SHUTDOWN_TIMEOUT)
+
+    def _deliver(self, job):
+        ''' Call job callbacks with its result (GUI thread) '''
+        # Forget finished job
+        if self.jobs.get((job.image, job.name)) is job:
+            del self.jobs[(job.image, job.name)]
+        # Drop stale results
+        if job.token.cancelled():
+            return
+        if job.error is not None:
+            print(f"ERROR: Job '{job.name}' #{job.id} failed: {job.error}")
+        for callback in job.callbacks:
+            callback(job.result)
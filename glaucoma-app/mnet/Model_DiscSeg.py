@@ -64,3 +64,24 @@ def DeepModel(size_set=640):
     # out10 = Conv2D(1, (1, 1), activation='sigmoid', name='side_10')(out10)
 
     return Model(inputs=[img_input], outputs=[out10])
+
+
+def InferenceModel(model):
+    ''' Inference graph of a trained DeepModel (shares its weights)
+        Outputs the fused map only. Side outputs are computed before they
+        are upsampled (1x1 convolution and sigmoid commute with nearest
+        upsampling), so the wide decoder maps are never upsampled.
+    '''
+    conv6 = model.get_layer('block6_conv2').output
+    conv7 = model.get_layer('block7_conv2').output
+    conv8 = model.get_layer('block8_conv2').output
+    conv9 = model.get_layer('block9_conv2').output
+
+    out6 = UpSampling2D(size=(8, 8))(model.get_layer('side_6')(conv6))
+    out7 = UpSampling2D(size=(4, 4))(model.get_layer('side_7')(conv7))
+    out8 = UpSampling2D(size=(2, 2))(model.get_layer('side_8')(conv8))
+    out9 = model.get_layer('side_9')(conv9)
+
+    out10 = average([out6, out7, out8, out9])
+
+    return Model(inputs=model.inputs, outputs=[out10])
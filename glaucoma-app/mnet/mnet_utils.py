@@ -18,6 +18,10 @@ def pro_process(temp_img, input_size):
 
 
 def train_loader(data_list, data_path, mask_path, input_size):
+    ''' Python generator of training pairs (batches of 1)
+        Kept as the baseline of the train_data benchmark; train with
+        train_data.train_dataset.
+    '''
     while 1:
         for lineIdx, temp_txt in enumerate(data_list):
             train_img = np.asarray(image.load_img(os.path.join(data_path, temp_txt),
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+from time import perf_counter
+import argparse
+import os
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+from mnet.mnet_utils import files_with_ext, train_loader
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+# Side outputs of the training graphs (M-Net: 4 side maps and the fused
+# map, all trained on the same mask)
+SIDE_OUTPUTS = 5
+# Samples read by the throughput benchmark (after one warmup batch)
+BENCHMARK_SAMPLES = 200
+
+
+def polar_transform(img):
+    ''' Polar image around the center (rows are radii, columns are angles)
+        Same transform as the M-Net inputs of mnet_segmentation.polar_crop.
+    '''
+    size = img.shape[0]
+    flat = cv2.linearPolar(img, (size / 2, size / 2), size / 2,
+                           cv2.WARP_FILL_OUTLIERS)
+    # rotate(-90) of mnet_segmentation (clockwise)
+    return np.rot90(flat, -1).copy()
+
+
+def load_pair(image_file, mask_file, input_size, polar):
+    ''' Decode and resize an image and its mask (mask scaled to [0, 1]) '''
+    size = (input_size, input_size)
+    img = tf.image.decode_image(tf.io.read_file(image_file), channels=3,
+                                expand_animations=False)
+    mask = tf.image.decode_image(tf.io.read_file(mask_file), channels=3,
+                                 expand_animations=False)
+    # Nearest neighbour, as image.load_img of train_loader (keeps uint8)
+    nearest = tf.image.ResizeMethod.NEAREST_NEIGHBOR
+    img = tf.cast(tf.image.resize(img, size, nearest), tf.float32)
+    mask = tf.cast(tf.image.resize(mask, size, nearest), tf.float32) / 255.0
+    if polar:
+        img, mask = [tf.numpy_function(polar_transform, [x], tf.float32)
+                     for x in (img, mask)]
+        img.set_shape(size + (3,))
+        mask.set_shape(size + (3,))
+    return img, mask
+
+
+def train_dataset(data_list, data_path, mask_path, input_size, batch_size=1,
+                  shuffle=True, cache=None, polar=False,
+                  side_outputs=SIDE_OUTPUTS, repeat=True):
+    ''' Training pipeline of (images, masks of each output) batches
+        Replaces train_loader: images and masks (same filenames) are
+        decoded in parallel, resized (and polar transformed) once if cache
+        is set (a file prefix, '' to cache in memory), then shuffled every
+        epoch, batched and prefetched while the model trains. The mask
+        tensor is shared by all outputs instead of being copied.
+    '''
+    images = [os.path.join(data_path, f) for f in data_list]
+    masks = [os.path.join(mask_path, f) for f in data_list]
+    dataset = tf.data.Dataset.from_tensor_slices((images, masks))
+    dataset = dataset.map(
+        lambda img, mask: load_pair(img, mask, input_size, polar),
+        num_parallel_calls=AUTOTUNE)
+    if cache is not None:
+        dataset = dataset.cache(cache)
+    if shuffle:
+        dataset = dataset.shuffle(len(data_list),
+                                  reshuffle_each_iteration=True)
+    if repeat:
+        # Endless as train_loader (steps_per_epoch is set by fit)
+        dataset = dataset.repeat()
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(lambda img, mask: (img, (mask,) * side_outputs),
+                          num_parallel_calls=AUTOTUNE)
+    return dataset.prefetch(AUTOTUNE)
+
+
+def throughput(batches, samples):
+    ''' Samples per second of an iterator of (images, masks) batches '''
+    next(batches)
+    count, t0 = 0, perf_counter()
+    while count < samples:
+        images, _ = next(batches)
+        count += len(images[0]) if isinstance(images, list) else len(images)
+    return count / (perf_counter() - t0)
+
+
+def benchmark(data_path, mask_path, input_size, batch_size=1,
+              samples=BENCHMARK_SAMPLES, cache=None, polar=False):
+    ''' Compare samples/sec of train_loader and train_dataset
+        (train_loader does not polar transform its samples)
+    '''
+    data_list = files_with_ext(data_path, '.jpg')
+    results = [('train_loader', 1,
+                throughput(train_loader(data_list, data_path, mask_path,
+                                        input_size), samples))]
+    for batch in sorted({1, batch_size}):
+        dataset = train_dataset(data_list, data_path, mask_path, input_size,
+                                batch, cache=cache, polar=polar)
+        results.append(('train_dataset', batch,
+                        throughput(iter(dataset), samples)))
+
+    print(f'{"Pipeline":<15}{"Batch":>6}{"samples/s":>11}')
+    for name, batch, rate in results:
+        print(f'{name:<15}{batch:6d}{rate:11.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare throughput of the tf.data training pipeline '
+                    'with train_loader')
+    parser.add_argument('images', help='folder of training images (.jpg)')
+    parser.add_argument('masks', help='folder of masks (same filenames)')
+    parser.add_argument('--size', type=int, default=400,
+                        help='input size of the model')
+    parser.add_argument('--batch', type=int, default=8)
+    parser.add_argument('--samples', type=int, default=BENCHMARK_SAMPLES)
+    parser.add_argument('--cache', default=None,
+                        help="cache file prefix ('' caches in memory)")
+    parser.add_argument('--polar', action='store_true',
+                        help='polar transform images and masks (M-Net)')
+    args = parser.parse_args()
+    benchmark(args.images, args.masks, args.size, args.batch, args.samples,
+              args.cache, args.polar)
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 
-from os import path
+from os import path, environ
 from sys import modules
+from threading import Lock
 
 import cv2
 import numpy as np
@@ -9,87 +10,457 @@ from PIL import Image
 from pkg_resources import resource_filename
 from skimage.measure import label, regionprops
 from skimage.transform import rotate, resize
-from tensorflow.python.keras.preprocessing import image
 
 import mnet.Model_DiscSeg
 import mnet.Model_MNet
 import mnet.mnet_utils
+from batching import BatchScheduler
+from fundus import open_image
+from ONH_Detection import locate_disc
+from tracing import span, traced
 
 DiscROI_size = 600
 Disc_size = 640
 CDRSeg_size = 400
 
+# Input sizes (DiscSeg, M-Net) of speed profiles ('accurate' is the size
+# the models were trained at, and the default profile)
+PROFILES = {'fast': (320, 256),
+            'balanced': (480, 320),
+            'accurate': (Disc_size, CDRSeg_size)}
+PROFILE = environ.get('GLAUCOMA_MNET_PROFILE', 'accurate')
+# Inputs of both (fully convolutional) models must be multiples of their
+# total stride (4 poolings)
+MODEL_STRIDE = 16
+
+# Disc localization: the classical detector (ONH_Detection.locate_disc) is
+# used when its confidence reaches this threshold, the DiscSeg U-Net
+# otherwise (None: always DiscSeg)
+CLASSICAL_CONFIDENCE = 0.7
+# Log localization path of each image
+LOG_LOCALIZATION = bool(environ.get('GLAUCOMA_LOG_LOCALIZATION'))
+
+# Test-time augmentation of M-Net (default can be set by environment):
+# angular shifts (fractions of a turn) of the polar image, each also
+# flipped along the angle. All augmented inputs of an image run in the
+# same predict call and their maps are averaged.
+TTA = bool(environ.get('GLAUCOMA_MNET_TTA'))
+TTA_SHIFTS = (0.0, 0.125, -0.125)
+TTA_FLIP = True
+
+# Micro-batching of concurrent requests (batch size and wait in seconds)
+BATCH_SIZE = 8
+BATCH_WAIT = 0.01
+
 parent_dir = path.dirname(resource_filename(modules[__name__].__name__, '__init__.py'))
 
 test_data_path = path.join(parent_dir, 'glaucoma-cases')
 data_save_path = mnet.mnet_utils.mk_dir(path.join(parent_dir,
                                                   'glaucoma-cases'))
 
-DiscSeg_model = mnet.Model_DiscSeg.DeepModel(size_set=Disc_size)
-DiscSeg_model.load_weights(path.join(parent_dir,
-                                     'mnet/deep_model',
-                                     'Model_DiscSeg_ORIGA.h5'))
+# Model backends: float32 Keras models, or int8 TFLite models exported by
+# quantize.py (default backend can be set by environment)
+BACKENDS = ('keras', 'tflite')
+BACKEND = environ.get('GLAUCOMA_MNET_BACKEND', 'keras')
+# Trained weights of each model (int8 models are saved next to them)
+WEIGHTS = {'DiscSeg': 'Model_DiscSeg_ORIGA.h5',
+           'M-Net': 'Model_MNet_REFUGE.h5'}
+
+# Models and their schedulers by backend, built on first use (see
+# load_models)
+models, schedulers = {}, {}
+models_lock = Lock()
+# Number of images localized by each path
+localizations = {'classical': 0, 'unet': 0}
+localizations_lock = Lock()
+
+
+def model_path(name, backend='keras'):
+    ''' Get file of a model (weights, or int8 model of the tflite backend) '''
+    filename = path.join(parent_dir, 'mnet/deep_model', WEIGHTS[name])
+    if backend == 'tflite':
+        filename = filename[:-3] + '_int8.tflite'
+    return filename
+
+
+def set_backend(backend):
+    ''' Set default backend of the segmentation functions '''
+    global BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown backend {backend} (one of {BACKENDS})')
+    BACKEND = backend
+
+
+def profile_sizes(profile=None):
+    ''' Get input sizes (DiscSeg, M-Net) of a speed profile '''
+    profile = profile or PROFILE
+    if profile not in PROFILES:
+        raise ValueError(f'Unknown profile {profile} '
+                         f'(one of {tuple(PROFILES)})')
+    sizes = PROFILES[profile]
+    for size in sizes:
+        if size < MODEL_STRIDE or size % MODEL_STRIDE:
+            raise ValueError(f'Input size {size} of profile {profile} is '
+                             f'not a multiple of {MODEL_STRIDE}')
+    return sizes
+
+
+def set_profile(profile):
+    ''' Set default speed profile of the segmentation functions '''
+    global PROFILE
+    profile_sizes(profile)
+    PROFILE = profile
+
+
+def set_tta(enabled):
+    ''' Set default test-time augmentation of the segmentation functions '''
+    global TTA
+    TTA = bool(enabled)
+
+
+def build_models(disc_size=None, cdr_size=None):
+    ''' Build DiscSeg and M-Net inference graphs with trained weights
+        Graphs built without sizes accept any input size (see PROFILES).
+    '''
+    DiscSeg_model = mnet.Model_DiscSeg.DeepModel(size_set=disc_size)
+    DiscSeg_model.load_weights(model_path('DiscSeg'))
+
+    CDRSeg_model = mnet.Model_MNet.DeepModel(size_set=cdr_size)
+    CDRSeg_model.load_weights(model_path('M-Net'))
+    # Inference graphs output the fused maps only
+    return (mnet.Model_DiscSeg.InferenceModel(DiscSeg_model),
+            mnet.Model_MNet.InferenceModel(CDRSeg_model))
+
+
+def load_models(backend=None):
+    ''' Build DiscSeg and M-Net models of a backend (once) '''
+    backend = backend or BACKEND
+    with models_lock:
+        if backend not in models:
+            if backend == 'tflite':
+                from quantize import TFLiteModel
+                models[backend] = (TFLiteModel(model_path('DiscSeg', backend)),
+                                   TFLiteModel(model_path('M-Net', backend)))
+            else:
+                models[backend] = build_models()
+    return models[backend]
+
+
+def fused_output(outputs):
+    ''' Get fused map of M-Net outputs (training graphs also output the
+        side maps)
+    '''
+    return outputs[-1] if isinstance(outputs, list) else outputs
+
+
+def load_schedulers(backend=None, profile=None):
+    ''' Create micro-batching schedulers in front of both models (once per
+        backend and profile, inputs of a batch have the same size)
+    '''
+    key = backend or BACKEND, profile or PROFILE
+    disc_model, cdr_model = load_models(key[0])
+
+    def predict_disc(imgs):
+        with span('DiscSeg predict'):
+            return disc_model.predict(np.stack(imgs))
+
+    def predict_cdr(imgs):
+        with span('M-Net predict'):
+            return fused_output(cdr_model.predict(np.stack(imgs)))
+
+    with models_lock:
+        if key not in schedulers:
+            schedulers[key] = (
+                BatchScheduler(predict_disc, BATCH_SIZE, BATCH_WAIT,
+                               'DiscSeg'),
+                BatchScheduler(predict_cdr, BATCH_SIZE, BATCH_WAIT, 'M-Net'))
+    return schedulers[key]
+
+
+def configure_batching(max_batch=None, max_wait=None):
+    ''' Change batch size and wait (seconds) of both schedulers '''
+    for scheduler in load_schedulers():
+        if max_batch is not None:
+            scheduler.max_batch = max_batch
+        if max_wait is not None:
+            scheduler.max_wait = max_wait
+
+
+def batching_metrics():
+    ''' Get metrics of both schedulers (empty if not created yet) and
+        localization path counts
+    '''
+    if (BACKEND, PROFILE) not in schedulers:
+        return {}
+    disc_batch, cdr_batch = schedulers[BACKEND, PROFILE]
+    return {'DiscSeg': disc_batch.metrics.summary(),
+            'M-Net': cdr_batch.metrics.summary(),
+            'localization': dict(localizations)}
+
+
+def warmup(backend=None, profile=None):
+    ''' Run both models once so the first segmentation is not slower '''
+    disc_model, cdr_model = load_models(backend)
+    disc_size, cdr_size = profile_sizes(profile)
+    disc_model.predict(np.zeros((1, disc_size, disc_size, 3)))
+    cdr_model.predict(np.zeros((1, cdr_size, cdr_size, 3)))
+
+
+def check_token(token):
+    # Stop between stages if the job has been cancelled
+    if token is not None:
+        token.check()
+
+
+@traced(image_arg=0)
+def load_image(temp_txt):
+    ''' Load RGB image from test data path (decoded once, shared) '''
+    return open_image(path.join(test_data_path, temp_txt)).rgb
+
+
+@traced()
+def disc_input(org_img, size=Disc_size):
+    ''' Stage: DiscSeg input of an image '''
+    return resize(org_img, (size, size, 3)) * 255
+
+
+def log_localization(path, confidence):
+    ''' Count (and log) localization path of an image '''
+    with localizations_lock:
+        localizations[path] += 1
+    if LOG_LOCALIZATION:
+        print(f'[localize] {path} (classical confidence {confidence:.2f})')
+
+
+@traced()
+def classical_center(org_img, token=None):
+    ''' Stage: disc center (row, column) of an image by the classical
+        detector (None if it is not confident, DiscSeg must be used)
+    '''
+    if CLASSICAL_CONFIDENCE is None:
+        return None
+    # Blank images get a blob with no contrast (confidence 0)
+    (x, y), confidence = locate_disc(org_img, token)
+    if confidence < CLASSICAL_CONFIDENCE:
+        log_localization('unet', confidence)
+        return None
+    log_localization('classical', confidence)
+    return int(y), int(x)
+
+
+@traced()
+def disc_center(org_img, disc_map):
+    ''' Stage: disc center (row, column) of an image from its DiscSeg output '''
+    disc_size = disc_map.shape[0]
+    disc_map = mnet.mnet_utils.BW_img(np.reshape(disc_map,
+                                                 (disc_size, disc_size)),
+                                      0.5)
+
+    regions = regionprops(label(disc_map))
+    C_x = int(regions[0].centroid[0] * org_img.shape[0] / disc_size)
+    C_y = int(regions[0].centroid[1] * org_img.shape[1] / disc_size)
+    return C_x, C_y
+
+
+def polar_input(org_img, disc_map, size=CDRSeg_size):
+    ''' Stage: M-Net polar input of an image from its DiscSeg output '''
+    return polar_crop(org_img, disc_center(org_img, disc_map), size)
+
+
+@traced()
+def polar_crop(org_img, center, size=CDRSeg_size):
+    ''' Stage: M-Net polar input of an image around its disc center '''
+    C_x, C_y = center
+    disc_region, err_xy, crop_xy = mnet.mnet_utils.disc_crop(org_img, DiscROI_size, C_x, C_y)
+    return polar_image(disc_region, size), err_xy, crop_xy
+
+
+@traced()
+def polar_image(disc_region, size=CDRSeg_size):
+    ''' Stage: M-Net polar input of a disc region (DiscROI_size square) '''
+    # Disc and Cup segmentation by M-Net
+    Disc_flat = rotate(cv2.linearPolar(disc_region, (DiscROI_size / 2, DiscROI_size / 2),
+                                       DiscROI_size / 2, cv2.WARP_FILL_OUTLIERS), -90)
+    return mnet.mnet_utils.pro_process(Disc_flat, size)
+
+
+def tta_columns(width, shifts=TTA_SHIFTS, flip=TTA_FLIP):
+    ''' Column indices (augmentations, width) of augmented polar images
+        Columns of M-Net inputs are angles (rows are radii), so an angular
+        shift is a circular roll of the columns and a flip reverses them.
+    '''
+    cols = np.arange(width)
+    columns = [(cols - int(round(shift * width))) % width for shift in shifts]
+    if flip:
+        columns += [c[::-1] for c in columns]
+    return np.array(columns)
+
+
+def tta_batch(temp_img, columns):
+    ''' Stage: augmented M-Net inputs (augmentations, H, W, 3) of an image '''
+    return np.moveaxis(temp_img[:, columns], 1, 0)
+
+
+@traced()
+def tta_average(probs, columns):
+    ''' Stage: undo augmentations of M-Net outputs (images, augmentations,
+        H, W, 2) and average them (images, H, W, 2)
+    '''
+    # Columns are permutations, their argsort maps them back
+    inverse = np.argsort(columns, axis=1)[None, :, None, :, None]
+    return np.take_along_axis(probs, inverse, axis=3).mean(axis=1)
+
+
+@traced()
+def mask_output(org_img, prob_10, err_xy, crop_xy):
+    ''' Stage: Mask (255 background, 128 disc, 1 cup) from M-Net output '''
+    # Extract mask
+    prob_map = np.reshape(prob_10, (prob_10.shape[-3], prob_10.shape[-2], prob_10.shape[-1]))
+    disc_map = np.array(Image.fromarray(prob_map[:, :, 0]).resize((DiscROI_size, DiscROI_size)))
+    cup_map = np.array(Image.fromarray(prob_map[:, :, 1]).resize((DiscROI_size, DiscROI_size)))
+    disc_map[-round(DiscROI_size / 3):, :] = 0
+    cup_map[-round(DiscROI_size / 2):, :] = 0
+    De_disc_map = cv2.linearPolar(rotate(disc_map, 90),
+                                  (DiscROI_size / 2, DiscROI_size / 2),
+                                  DiscROI_size / 2,
+                                  cv2.WARP_FILL_OUTLIERS + cv2.WARP_INVERSE_MAP)
+    De_cup_map = cv2.linearPolar(rotate(cup_map, 90),
+                                 (DiscROI_size / 2, DiscROI_size / 2),
+                                 DiscROI_size / 2,
+                                 cv2.WARP_FILL_OUTLIERS + cv2.WARP_INVERSE_MAP)
+
+    De_disc_map = np.array(mnet.mnet_utils.BW_img(De_disc_map, 0.5),
+                           dtype=int)
+    De_cup_map = np.array(mnet.mnet_utils.BW_img(De_cup_map, 0.5),
+                          dtype=int)
+
+    ROI_result = np.array(mnet.mnet_utils.BW_img(De_disc_map, 0.5), dtype=int) + np.array(mnet.mnet_utils.BW_img(De_cup_map, 0.5), dtype=int)
+    Img_result = np.zeros((org_img.shape[0], org_img.shape[1]), dtype=np.int8)
+    Img_result[crop_xy[0]:crop_xy[1], crop_xy[2]:crop_xy[3], ] = ROI_result[err_xy[0]:err_xy[1], err_xy[2]:err_xy[3], ]
+    return (255 - Img_result * 127).astype(np.uint8)
+
+
+@traced(image_arg=1)
+def save_mask(mask, temp_txt):
+    ''' Save raw mask and return its filename '''
+    output = path.join(data_save_path, 'masks', temp_txt[:-4] + '.png')
+    Image.fromarray(mask).save(output)
+    return output
+
+
+@traced()
+def segment_batch(images, token=None, backend=None, profile=None, tta=None):
+    ''' Segment a list of RGB images using one predict call per model
+        Returns a mask for each image (None if its segmentation failed).
+        With tta, augmented inputs of all images share the M-Net call.
+    '''
+    tta = TTA if tta is None else tta
+    disc_model, cdr_model = load_models(backend)
+    disc_size, cdr_size = profile_sizes(profile)
+    masks = [None] * len(images)
+    # Disc localization by the classical detector, and by U-Net (one
+    # batch) for images it is not confident about
+    check_token(token)
+    centers = [classical_center(img, token) for img in images]
+    unet = [i for i, center in enumerate(centers) if center is None]
+    if unet:
+        inputs = np.stack([disc_input(images[i], disc_size) for i in unet])
+        with span('DiscSeg predict'):
+            disc_maps = disc_model.predict(inputs)
+    # Polar inputs of images with a detected disc
+    polar = {}
+    for i, org_img in enumerate(images):
+        try:
+            if centers[i] is None:
+                centers[i] = disc_center(org_img, disc_maps[unet.index(i)])
+            polar[i] = polar_crop(org_img, centers[i], cdr_size)
+        except Exception as error:
+            print(f'ERROR: Disc detection failed: {error}')
+    if not polar:
+        return masks
+    # Disc and Cup segmentation by M-Net (one batch)
+    check_token(token)
+    idx = list(polar)
+    inputs = np.stack([polar[i][0] for i in idx])
+    if tta:
+        # Augmentations of each image are consecutive in the batch
+        columns = tta_columns(cdr_size)
+        inputs = np.concatenate([tta_batch(x, columns) for x in inputs])
+    with span('M-Net predict'):
+        prob_10 = fused_output(cdr_model.predict(inputs))
+    if tta:
+        prob_10 = tta_average(prob_10.reshape((len(idx), len(columns))
+                                              + prob_10.shape[1:]), columns)
+    check_token(token)
+    for i, prob in zip(idx, prob_10):
+        try:
+            masks[i] = mask_output(images[i], prob, *polar[i][1:])
+        except Exception as error:
+            print(f'ERROR: Mask extraction failed: {error}')
+    return masks
+
 
-CDRSeg_model = mnet.Model_MNet.DeepModel(size_set=CDRSeg_size)
-CDRSeg_model.load_weights(path.join(parent_dir,
-                                    'mnet/deep_model',
-                                    'Model_MNet_REFUGE.h5'))
+@traced()
+def segment_image(org_img, token=None, backend=None, profile=None,
+                  tta=None):
+    ''' Segment one RGB image through the micro-batching schedulers
+        Concurrent callers (threads) share one predict call per model.
+        With tta, augmented inputs are submitted together (one batch if
+        they fit in BATCH_SIZE).
+    '''
+    tta = TTA if tta is None else tta
+    disc_batch, cdr_batch = load_schedulers(backend, profile)
+    disc_size, cdr_size = profile_sizes(profile)
+    # Disc localization by the classical detector, or by U-Net if it is
+    # not confident
+    check_token(token)
+    center = classical_center(org_img, token)
+    if center is None:
+        disc_in = disc_input(org_img, disc_size)
+        # Wait for the batch (predict spans are recorded by the scheduler)
+        with span('DiscSeg wait'):
+            disc_map = disc_batch(disc_in)
+        center = disc_center(org_img, disc_map)
+    temp_img, err_xy, crop_xy = polar_crop(org_img, center, cdr_size)
+    # Disc and Cup segmentation by M-Net
+    check_token(token)
+    if tta:
+        columns = tta_columns(cdr_size)
+        with span('M-Net wait'):
+            futures = [cdr_batch.submit(x)
+                       for x in tta_batch(temp_img, columns)]
+            probs = np.stack([future.result() for future in futures])
+        prob_10 = tta_average(probs[None], columns)[0]
+    else:
+        with span('M-Net wait'):
+            prob_10 = cdr_batch(temp_img)
+    check_token(token)
+    return mask_output(org_img, prob_10, err_xy, crop_xy)
 
 
-def MNetMask(temp_txt):
+@traced(image_arg=0)
+def MNetMask(temp_txt, token=None, backend=None, profile=None, tta=None,
+             server=True):
     try:
-        # load image
-        org_img = np.asarray(image.load_img(path.join(test_data_path,
-                                                      temp_txt)))
-        # Disc region detection by U-Net
-        temp_img = resize(org_img, (Disc_size, Disc_size, 3)) * 255
-        temp_img = np.reshape(temp_img, (1,) + temp_img.shape)
-        disc_map = DiscSeg_model.predict([temp_img])
-        disc_map = mnet.mnet_utils.BW_img(np.reshape(disc_map,
-                                                     (Disc_size, Disc_size)),
-                                          0.5)
-
-        regions = regionprops(label(disc_map))
-        C_x = int(regions[0].centroid[0] * org_img.shape[0] / Disc_size)
-        C_y = int(regions[0].centroid[1] * org_img.shape[1] / Disc_size)
-        disc_region, err_xy, crop_xy = mnet.mnet_utils.disc_crop(org_img, DiscROI_size, C_x, C_y)
-
-        # Disc and Cup segmentation by M-Net
-        Disc_flat = rotate(cv2.linearPolar(disc_region, (DiscROI_size / 2, DiscROI_size / 2),
-                                           DiscROI_size / 2, cv2.WARP_FILL_OUTLIERS), -90)
-        temp_img = mnet.mnet_utils.pro_process(Disc_flat, CDRSeg_size)
-        temp_img = np.reshape(temp_img, (1,) + temp_img.shape)
-        [_, _, _, _, prob_10] = CDRSeg_model.predict(temp_img)
-
-        # Extract mask
-        prob_map = np.reshape(prob_10, (prob_10.shape[1], prob_10.shape[2], prob_10.shape[3]))
-        disc_map = np.array(Image.fromarray(prob_map[:, :, 0]).resize((DiscROI_size, DiscROI_size)))
-        cup_map = np.array(Image.fromarray(prob_map[:, :, 1]).resize((DiscROI_size, DiscROI_size)))
-        disc_map[-round(DiscROI_size / 3):, :] = 0
-        cup_map[-round(DiscROI_size / 2):, :] = 0
-        De_disc_map = cv2.linearPolar(rotate(disc_map, 90),
-                                      (DiscROI_size / 2, DiscROI_size / 2),
-                                      DiscROI_size / 2,
-                                      cv2.WARP_FILL_OUTLIERS + cv2.WARP_INVERSE_MAP)
-        De_cup_map = cv2.linearPolar(rotate(cup_map, 90),
-                                     (DiscROI_size / 2, DiscROI_size / 2),
-                                     DiscROI_size / 2,
-                                     cv2.WARP_FILL_OUTLIERS + cv2.WARP_INVERSE_MAP)
-
-        De_disc_map = np.array(mnet.mnet_utils.BW_img(De_disc_map, 0.5),
-                               dtype=int)
-        De_cup_map = np.array(mnet.mnet_utils.BW_img(De_cup_map, 0.5),
-                              dtype=int)
-
-        # Save raw mask
-        ROI_result = np.array(mnet.mnet_utils.BW_img(De_disc_map, 0.5), dtype=int) + np.array(mnet.mnet_utils.BW_img(De_cup_map, 0.5), dtype=int)
-        Img_result = np.zeros((org_img.shape[0], org_img.shape[1]), dtype=np.int8)
-        Img_result[crop_xy[0]:crop_xy[1], crop_xy[2]:crop_xy[3], ] = ROI_result[err_xy[0]:err_xy[1], err_xy[2]:err_xy[3], ]
-        save_result = Image.fromarray((255 - Img_result * 127).astype(np.uint8))
-        output = path.join(data_save_path, 'masks', temp_txt[:-4] + '.png')
-        save_result.save(output)
-        return output
-    except:
+        # Use the inference server if it is running (and no backend,
+        # profile or tta is requested, the server has its own), unless
+        # the caller has already asked it
+        from inference import request_mask
+        check_token(token)
+        reply = (request_mask(temp_txt)
+                 if server and backend is None and profile is None
+                 and tta is None else None)
+        if reply is not None:
+            return reply['output'] if reply['ok'] else False
+        # Otherwise segment the image in this process
+        mask = segment_image(load_image(temp_txt), token, backend, profile,
+                             tta)
+        return save_mask(mask, temp_txt)
+    except Exception as error:
+        # Let the job see its cancellation (JobCancelled of the token)
+        if token is not None and token.cancelled():
+            raise
+        print(f'ERROR: Segmentation of {temp_txt} failed: {error}')
         return False
 
 
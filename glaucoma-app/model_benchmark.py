@@ -0,0 +1,225 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from time import perf_counter
+from os import path
+import resource
+import argparse
+
+import numpy as np
+import cv2
+
+
+# Predict calls measured for each graph (after one warmup call)
+CALLS = 10
+BATCH = 1
+# Images segmented with each speed profile
+PROFILE_IMAGES = 20
+
+
+def peak_rss():
+    ''' Peak resident memory of this process (MiB, Linux reports KiB) '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def build(name, graph):
+    ''' Build a model ('DiscSeg'/'M-Net') as 'training' or 'inference' graph
+        Returns the model and its input size.
+    '''
+    import mnet.Model_DiscSeg
+    import mnet.Model_MNet
+    import mnet_segmentation as mnet_seg
+
+    module, size = {'DiscSeg': (mnet.Model_DiscSeg, mnet_seg.Disc_size),
+                    'M-Net': (mnet.Model_MNet, mnet_seg.CDRSeg_size)}[name]
+    model = module.DeepModel(size_set=size)
+    model.load_weights(mnet_seg.model_path(name))
+    if graph == 'inference':
+        model = module.InferenceModel(model)
+    return model, size
+
+
+def measure(name, graph, batch, calls):
+    ''' Time predict calls of a graph and its peak memory (own process) '''
+    import mnet_segmentation as mnet_seg
+
+    model, size = build(name, graph)
+    # Same input in every process (outputs of both graphs are compared)
+    x = np.random.RandomState(0).rand(batch, size, size, 3) * 255
+    before = peak_rss()
+    model.predict(x)
+    times = []
+    for _ in range(calls):
+        t0 = perf_counter()
+        output = mnet_seg.fused_output(model.predict(x))
+        times.append(perf_counter() - t0)
+    return np.median(times), peak_rss() - before, output
+
+
+def run(name, graph, batch=BATCH, calls=CALLS):
+    ''' Run measure in a new process, so peak memory is not shared '''
+    with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as pool:
+        return pool.submit(measure, name, graph, batch, calls).result()
+
+
+def main(batch=BATCH, calls=CALLS):
+    print(f'{"Model":<10}{"Graph":<11}{"s/call":>9}{"Peak MiB":>10}'
+          f'{"Max diff":>10}')
+    for name in ('DiscSeg', 'M-Net'):
+        reference = None
+        for graph in ('training', 'inference'):
+            seconds, memory, output = run(name, graph, batch, calls)
+            if reference is None:
+                reference, diff = output, ''
+            else:
+                diff = f'{np.abs(output - reference).max():10.2e}'
+            print(f'{name:<10}{graph:<11}{seconds:9.3f}{memory:10.1f}{diff}')
+
+
+def mean_dice(references, masks):
+    ''' Mean disc and cup Dice of masks with their reference masks (masks
+        that failed are skipped)
+    '''
+    from evaluation import score_masks
+    scores = [score_masks(mask, ref) for ref, mask in zip(references, masks)
+              if ref is not None and mask is not None]
+    if not scores:
+        return np.nan, np.nan
+    return (np.mean([s['disc_dice'] for s in scores]),
+            np.mean([s['cup_dice'] for s in scores]))
+
+
+def reference_mask(file, mask):
+    ''' Get saved mask of an image (mask if it has not been saved) '''
+    import mnet_segmentation as mnet_seg
+    saved = path.join(mnet_seg.data_save_path, 'masks',
+                      path.basename(file)[:-4] + '.png')
+    if not path.exists(saved):
+        return mask
+    return cv2.imread(saved, cv2.IMREAD_GRAYSCALE)
+
+
+def benchmark_profiles(folder, limit=PROFILE_IMAGES, backend=None):
+    ''' Time each speed profile on images of a folder and compare its masks
+        with the reference masks (saved masks, or masks of the accurate
+        profile if an image has none)
+    '''
+    import mnet_segmentation as mnet_seg
+    from evaluation import list_images
+    from fundus import open_image
+
+    files = list_images(folder, limit)
+    images = [open_image(file).rgb for file in files]
+    masks, times = {}, {}
+    for profile in mnet_seg.PROFILES:
+        mnet_seg.warmup(backend, profile)
+        masks[profile], elapsed = [], []
+        for img in images:
+            t0 = perf_counter()
+            masks[profile].extend(mnet_seg.segment_batch([img], None, backend,
+                                                         profile))
+            elapsed.append(perf_counter() - t0)
+        times[profile] = np.median(elapsed)
+    references = [reference_mask(file, mask)
+                  for file, mask in zip(files, masks['accurate'])]
+
+    print(f'{"Profile":<10}{"Sizes":>10}{"s/image":>9}{"Disc Dice":>11}'
+          f'{"Cup Dice":>10}{"Failed":>8}')
+    for profile, sizes in mnet_seg.PROFILES.items():
+        disc, cup = mean_dice(references, masks[profile])
+        failed = sum(mask is None for mask in masks[profile])
+        print(f'{profile:<10}{"%dx%d" % sizes:>10}{times[profile]:9.3f}'
+              f'{disc:11.4f}{cup:10.4f}{failed:8d}')
+
+
+def benchmark_localization(folder, limit=PROFILE_IMAGES, backend=None):
+    ''' Time per image with classical disc localization (U-Net fallback)
+        and with U-Net localization only, and agreement of their masks
+    '''
+    import mnet_segmentation as mnet_seg
+    from evaluation import list_images
+    from fundus import open_image
+
+    files = list_images(folder, limit)
+    images = [open_image(file).rgb for file in files]
+    mnet_seg.warmup(backend)
+    threshold = mnet_seg.CLASSICAL_CONFIDENCE
+    masks, times, classical = {}, {}, {}
+    for mode, confidence in (('unet', None), ('classical', threshold)):
+        mnet_seg.CLASSICAL_CONFIDENCE = confidence
+        before = mnet_seg.localizations['classical']
+        t0 = perf_counter()
+        masks[mode] = [mnet_seg.segment_batch([img], None, backend)[0]
+                       for img in images]
+        times[mode] = (perf_counter() - t0) / len(images)
+        classical[mode] = mnet_seg.localizations['classical'] - before
+    mnet_seg.CLASSICAL_CONFIDENCE = threshold
+
+    print(f'{"Localization":<14}{"s/image":>9}{"Classical":>11}{"U-Net":>7}'
+          f'{"Disc Dice":>11}{"Cup Dice":>10}')
+    for mode in masks:
+        # Agreement with U-Net localization
+        disc, cup = mean_dice(masks['unet'], masks[mode])
+        print(f'{mode:<14}{times[mode]:9.3f}{classical[mode]:11d}'
+              f'{len(files) - classical[mode]:7d}{disc:11.4f}{cup:10.4f}')
+
+
+def benchmark_tta(folder, limit=PROFILE_IMAGES, backend=None):
+    ''' Time per image without and with test-time augmentation, and Dice
+        of their masks with the reference masks
+    '''
+    import mnet_segmentation as mnet_seg
+    from evaluation import list_images
+    from fundus import open_image
+
+    files = list_images(folder, limit)
+    images = [open_image(file).rgb for file in files]
+    mnet_seg.warmup(backend)
+    masks, times = {}, {}
+    for tta in (False, True):
+        t0 = perf_counter()
+        masks[tta] = [mnet_seg.segment_batch([img], None, backend, tta=tta)[0]
+                      for img in images]
+        times[tta] = (perf_counter() - t0) / len(images)
+    references = [reference_mask(file, mask)
+                  for file, mask in zip(files, masks[False])]
+
+    print(f'{"TTA":<6}{"Inputs":>7}{"s/image":>9}{"Disc Dice":>11}'
+          f'{"Cup Dice":>10}')
+    for tta in masks:
+        disc, cup = mean_dice(references, masks[tta])
+        inputs = len(mnet_seg.tta_columns(mnet_seg.CDRSeg_size)) if tta else 1
+        print(f'{"on" if tta else "off":<6}{inputs:7d}{times[tta]:9.3f}'
+              f'{disc:11.4f}{cup:10.4f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark training and inference graphs of DiscSeg and '
+                    'M-Net (time per predict call and peak memory), the '
+                    'speed profiles, disc localization or test-time '
+                    'augmentation (time per image and mask agreement)')
+    parser.add_argument('--batch', type=int, default=BATCH)
+    parser.add_argument('--calls', type=int, default=CALLS)
+    parser.add_argument('--profiles', action='store_true',
+                        help='benchmark speed profiles instead of graphs')
+    parser.add_argument('--localization', action='store_true',
+                        help='benchmark classical disc localization instead '
+                             'of graphs')
+    parser.add_argument('--tta', action='store_true',
+                        help='benchmark test-time augmentation of M-Net '
+                             'instead of graphs')
+    parser.add_argument('--images', default='glaucoma-cases',
+                        help='folder of fundus images (profiles, '
+                             'localization and tta)')
+    parser.add_argument('--limit', type=int, default=PROFILE_IMAGES)
+    parser.add_argument('--backend', default=None,
+                        choices=('keras', 'tflite'))
+    args = parser.parse_args()
+    if args.profiles:
+        benchmark_profiles(args.images, args.limit, args.backend)
+    elif args.localization:
+        benchmark_localization(args.images, args.limit, args.backend)
+    elif args.tta:
+        benchmark_tta(args.images, args.limit, args.backend)
+    else:
+        main(args.batch, args.calls)
@@ -0,0 +1,157 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from collections import deque, namedtuple
+import multiprocessing
+import sys
+
+from PIL import Image
+
+from buffers import BufferPool, POOL_BYTES, view
+
+
+# Result of an image (arrays are valid until the next result is taken)
+PipelineResult = namedtuple('PipelineResult',
+                            ('file', 'region', 'crop', 'mask', 'error'))
+
+
+def crop_stage(file, image, crop):
+    ''' Worker: decode an image into its buffer and crop its ONH
+        Returns the ONH region, the crop is written to the top left of
+        its buffer (regions at the image border can be smaller).
+    '''
+    import cv2
+    from ONH_Detection import cropONH
+    img = view(image)
+    # Decode, then convert to RGB into the shared buffer (no extra copy)
+    cv2.cvtColor(cv2.imread(file), cv2.COLOR_BGR2RGB, dst=img)
+    region = cropONH(file, image=img)
+    x1, y1, x2, y2 = region
+    view(crop)[:y2 - y1, :x2 - x1] = img[y1:y2, x1:x2]
+    return region
+
+
+def segment_stage(image, mask):
+    ''' Worker: segment a decoded image into its mask buffer '''
+    from mnet_segmentation import segment_batch
+    [result] = segment_batch([view(image)])
+    if result is None:
+        raise RuntimeError('Segmentation failed')
+    view(mask)[:] = result
+
+
+class ImagePipeline:
+    ''' Multi-process crop -> segment pipeline over shared memory
+        Images are decoded and cropped by crop workers, then segmented by
+        segmentation workers (each loading its own models). Stages only
+        exchange buffer handles; decoded images, crops and masks stay in
+        a BufferPool whose ceiling bounds the number of images in flight.
+    '''
+
+    def __init__(self, crop_workers=2, segment_workers=1,
+                 max_bytes=POOL_BYTES, crop_size=None):
+        from ONH_Detection import output_dim
+        self.crop_size = crop_size or output_dim
+        self.pool = BufferPool(max_bytes)
+        # Spawn workers (forked TensorFlow is not safe), they import
+        # the app modules from the same path as this process
+        context = multiprocessing.get_context('spawn')
+        self.cropper = ProcessPoolExecutor(crop_workers, context)
+        self.segmenter = ProcessPoolExecutor(segment_workers, context)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        ''' Stop workers and free all buffers '''
+        self.cropper.shutdown(cancel_futures=True)
+        self.segmenter.shutdown(cancel_futures=True)
+        self.pool.close()
+
+    def _allocate(self, file):
+        ''' Get buffers of an image (None if the pool is full) '''
+        with Image.open(file) as img:
+            w, h = img.size
+        shapes = ((h, w, 3), (self.crop_size, self.crop_size, 3), (h, w))
+        handles = []
+        for shape in shapes:
+            handle = self.pool.try_allocate(shape)
+            if handle is None:
+                for handle in handles:
+                    self.pool.release(handle)
+                return None
+            handles.append(handle)
+        return handles
+
+    def _submit(self, file, image, crop, mask):
+        ''' Run both stages of an image (Future of its region) '''
+        done = Future()
+
+        def cropped(future):
+            if future.exception() is not None:
+                done.set_exception(future.exception())
+                return
+            segmented = self.segmenter.submit(segment_stage, image, mask)
+            segmented.add_done_callback(
+                lambda f: done.set_exception(f.exception())
+                if f.exception() is not None
+                else done.set_result(future.result()))
+
+        self.cropper.submit(crop_stage, file, image, crop) \
+            .add_done_callback(cropped)
+        return done
+
+    def run(self, files):
+        ''' Crop and segment images, yielding a PipelineResult per image
+            (same order as files). Crop and mask arrays are views of pool
+            buffers, copy them to keep them after the next result.
+        '''
+        files, running = deque(files), deque()
+        while files or running:
+            # Start images while their buffers fit in the pool
+            while files:
+                handles = self._allocate(files[0])
+                if handles is None:
+                    if not running:
+                        raise MemoryError('Pool is too small for '
+                                          f'{files[0]}')
+                    break
+                file = files.popleft()
+                running.append((file, handles,
+                                self._submit(file, *handles)))
+            # Take oldest image, then recycle its buffers
+            file, (image, crop, mask), done = running.popleft()
+            try:
+                region, error = done.result(), None
+            except Exception as exc:
+                region, error = None, exc
+                print(f'ERROR: Pipeline failed for {file}: {exc}')
+            self.pool.release(image)
+            try:
+                if error is None:
+                    x1, y1, x2, y2 = region
+                    yield PipelineResult(
+                        file, region,
+                        self.pool.view(crop)[:y2 - y1, :x2 - x1],
+                        self.pool.view(mask), None)
+                else:
+                    yield PipelineResult(file, None, None, None, error)
+            finally:
+                self.pool.release(crop)
+                self.pool.release(mask)
+
+
+if __name__ == '__main__':
+    # Batch mode: python pipeline.py <images...>
+    from mnet_segmentation import save_mask
+    from ONH_Detection import get_crop_path
+    import cv2
+    import os
+    with ImagePipeline() as pipeline:
+        for result in pipeline.run(sys.argv[1:]):
+            if result.error is None:
+                cv2.imwrite(get_crop_path(result.file),
+                            cv2.cvtColor(result.crop, cv2.COLOR_RGB2BGR))
+                print(result.file, result.region,
+                      save_mask(result.mask, os.path.basename(result.file)))
@@ -0,0 +1,163 @@
+from concurrent.futures import ProcessPoolExecutor
+from os import path, makedirs
+import argparse
+import json
+
+import numpy as np
+import cv2
+from skimage.measure import label, regionprops
+
+import mnet_segmentation as mnet_seg
+from fundus import open_image
+from evaluation import list_images, mask_planes
+
+
+# Index file of a cache folder (shards are raw uint8 arrays next to it)
+INDEX_FILE = 'index.json'
+VERSION = 1
+# Samples per shard file
+SHARD_SIZE = 256
+# Side outputs of the M-Net training graph (all trained on the target)
+SIDE_OUTPUTS = 5
+
+
+def mask_file(mask_dir, file):
+    ''' Get mask of an image (same name, .png, as saved by the app) '''
+    return path.join(mask_dir, path.splitext(path.basename(file))[0] + '.png')
+
+
+def polar_sample(file, mask_dir, size=mnet_seg.CDRSeg_size):
+    ''' Get M-Net polar input (size, size, 3) and disc/cup target
+        (size, size, 2) of an image, both uint8 (target 0 or 1)
+        The polar transform is centered on the disc of the mask, as in
+        training. Returns None if the image has no mask or no disc.
+    '''
+    mask = cv2.imread(mask_file(mask_dir, file), cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        return None
+    # App masks (1 cup) and REFUGE masks (0 cup), disc includes cup
+    disc, cup = mask_planes(mask)
+    regions = regionprops(label(disc))
+    if not regions:
+        return None
+    region = max(regions, key=lambda r: r.area)
+    center = tuple(int(c) for c in region.centroid)
+
+    img, _, _ = mnet_seg.polar_crop(open_image(file).rgb, center, size)
+    # Targets take the same path (disc_crop needs 3 channels)
+    target = np.zeros(mask.shape + (3,), dtype=np.uint8)
+    target[..., 0], target[..., 1] = disc * 255, cup * 255
+    target, _, _ = mnet_seg.polar_crop(target, center, size)
+    return (img.astype(np.uint8),
+            (target[..., :2] > 127).astype(np.uint8))
+
+
+def write_shard(filename, arrays):
+    ''' Write arrays of the same shape into one raw uint8 file '''
+    shard = np.memmap(filename, np.uint8, 'w+',
+                      shape=(len(arrays),) + arrays[0].shape)
+    for i, array in enumerate(arrays):
+        shard[i] = array
+    shard.flush()
+
+
+def build_cache(image_dir, mask_dir, output, size=mnet_seg.CDRSeg_size,
+                shard_size=SHARD_SIZE, workers=None):
+    ''' Precompute polar samples of images (in parallel) into a sharded
+        cache folder: raw uint8 shards and an index (sample names, shard
+        and position of each sample)
+    '''
+    makedirs(output, exist_ok=True)
+    files = list_images(image_dir)
+    index = {'version': VERSION, 'size': size, 'samples': [], 'shards': []}
+    with ProcessPoolExecutor(workers) as pool:
+        for start in range(0, len(files), shard_size):
+            chunk = files[start:start + shard_size]
+            samples = [(file, sample) for file, sample in
+                       zip(chunk, pool.map(polar_sample, chunk,
+                                           [mask_dir] * len(chunk),
+                                           [size] * len(chunk)))
+                       if sample is not None]
+            if not samples:
+                continue
+            shard = len(index['shards'])
+            names = {'images': f'images_{shard:03d}.u8',
+                     'targets': f'targets_{shard:03d}.u8'}
+            for k, name in enumerate(names.values()):
+                write_shard(path.join(output, name),
+                            [sample[k] for _, sample in samples])
+            index['shards'].append(dict(names, count=len(samples)))
+            index['samples'] += [[path.basename(file), shard, i]
+                                 for i, (file, _) in enumerate(samples)]
+            print(f'Shard {shard}: {len(samples)} of {len(chunk)} images')
+    with open(path.join(output, INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+class PolarCache:
+    ''' Read-only view of a polar cache folder (see build_cache)
+        Shards are memory-mapped, samples are views into them (no copy, no
+        decoding). Batches are float32 copies in the format of the M-Net
+        training graph.
+    '''
+
+    def __init__(self, folder):
+        with open(path.join(folder, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        if self.index['version'] > VERSION:
+            raise ValueError(f'{folder} needs a newer version of the app')
+        size = self.index['size']
+        self.images, self.targets = [], []
+        for shard in self.index['shards']:
+            count = shard['count']
+            self.images.append(np.memmap(path.join(folder, shard['images']),
+                                         np.uint8, 'r',
+                                         shape=(count, size, size, 3)))
+            self.targets.append(np.memmap(path.join(folder, shard['targets']),
+                                          np.uint8, 'r',
+                                          shape=(count, size, size, 2)))
+        self.samples = self.index['samples']
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, i):
+        ''' Get (name, image, target) of a sample (memory-mapped views) '''
+        name, shard, pos = self.samples[i]
+        return name, self.images[shard][pos], self.targets[shard][pos]
+
+    def batch(self, idx, side_outputs=SIDE_OUTPUTS):
+        ''' Get a training batch (images, targets of each output) '''
+        images = np.stack([self[i][1] for i in idx]).astype(np.float32)
+        targets = np.stack([self[i][2] for i in idx]).astype(np.float32)
+        return images, [targets] * side_outputs
+
+    def batches(self, batch_size=1, shuffle=True, seed=None,
+                side_outputs=SIDE_OUTPUTS):
+        ''' Endless batches (reshuffled each epoch) for Keras fit '''
+        rng = np.random.RandomState(seed)
+        while True:
+            order = (rng.permutation(len(self)) if shuffle
+                     else np.arange(len(self)))
+            for start in range(0, len(order) - batch_size + 1, batch_size):
+                yield self.batch(order[start:start + batch_size],
+                                 side_outputs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Precompute M-Net polar training samples (images and '
+                    'disc/cup targets) into a sharded memory-mapped cache')
+    parser.add_argument('images', help='folder of fundus images')
+    parser.add_argument('masks', help='folder of masks (name.png, 255 '
+                                      'background, 128 disc, 0 or 1 cup)')
+    parser.add_argument('output', help='cache folder')
+    parser.add_argument('--size', type=int, default=mnet_seg.CDRSeg_size)
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    index = build_cache(args.images, args.masks, args.output, args.size,
+                        args.shard_size, args.workers)
+    print(f'Cached {len(index["samples"])} samples in '
+          f'{len(index["shards"])} shards ({args.output})')
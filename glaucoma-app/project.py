@@ -0,0 +1,100 @@
+from os import path
+import struct
+import json
+
+import numpy as np
+
+from image_index import image_hash
+from shapes import ShapeStore
+
+
+# Project file extension (used by file dialogs)
+PROJECT_EXT = '.gproj'
+# File header (magic, format version and JSON header size)
+MAGIC, VERSION = b'GLPROJ', 1
+HEADER = struct.Struct('<6sHI')
+# Alignment of binary arrays in the file
+ALIGN = 8
+
+# Binary shape arrays (name -> stored dtype)
+ARRAYS = {'kinds': '<i1', 'handles': '<f4', 'used': '|u1'}
+
+
+class ProjectError(Exception):
+    ''' Raised when a project file cannot be read '''
+
+
+def save_project(filename, info, store):
+    ''' Save project info (JSON) and shapes of all layers (binary arrays)
+        info holds the image, crop region, layers (names and types),
+        automatic mask reference and view settings. Image and mask paths
+        are saved relative to the project file.
+    '''
+    folder = path.dirname(path.abspath(filename))
+    info = dict(info, version=VERSION)
+    image = info.get('image')
+    if image:
+        info['image_hash'] = image_hash(image)
+        info['image_abs'] = path.abspath(image)
+        info['image'] = path.relpath(path.abspath(image), folder)
+    if info.get('mask'):
+        info['mask'] = path.relpath(path.abspath(info['mask']), folder)
+
+    # Binary section: aligned arrays in ARRAYS order
+    arrays, offset = {}, 0
+    values = dict(zip(ARRAYS, store.to_arrays()))
+    for name, dtype in ARRAYS.items():
+        arrays[name] = np.ascontiguousarray(values[name], dtype=dtype)
+        info.setdefault('arrays', {})[name] = (offset,
+                                               list(arrays[name].shape))
+        offset += -(-arrays[name].nbytes // ALIGN) * ALIGN
+    header = json.dumps(info).encode()
+    header += b' ' * (-(HEADER.size + len(header)) % ALIGN)
+
+    with open(filename, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        for array in arrays.values():
+            f.write(array.tobytes())
+            f.write(b'\0' * (-array.nbytes % ALIGN))
+
+
+def load_project(filename):
+    ''' Load project info and its ShapeStore
+        Image and mask paths of info are resolved (absolute); the image
+        falls back to its absolute path if the project has been moved
+        without it.
+    '''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        raise ProjectError(f'{filename} is not a project file')
+    magic, version, size = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ProjectError(f'{filename} is not a project file')
+    if version > VERSION:
+        raise ProjectError(f'{filename} needs a newer version of the app')
+    info = json.loads(data[HEADER.size:HEADER.size + size])
+
+    # Arrays are read straight from the file buffer
+    start, values = HEADER.size + size, []
+    for name, dtype in ARRAYS.items():
+        offset, shape = info['arrays'][name]
+        count = int(np.prod(shape))
+        values.append(np.frombuffer(data, dtype, count,
+                                    start + offset).reshape(shape))
+    store = ShapeStore.from_arrays(*values)
+
+    folder = path.dirname(path.abspath(filename))
+    image = info.get('image')
+    if image:
+        image = path.normpath(path.join(folder, image))
+        if not path.exists(image) and path.exists(info['image_abs']):
+            image = info['image_abs']
+        info['image'] = image
+        if path.exists(image) and image_hash(image) != info['image_hash']:
+            print(f'WARNING: {image} has changed since the project was '
+                  'saved')
+    if info.get('mask'):
+        info['mask'] = path.normpath(path.join(folder, info['mask']))
+    return info, store
@@ -0,0 +1,187 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from threading import Lock
+from os import path
+from time import time
+import argparse
+
+import numpy as np
+
+import mnet_segmentation as mnet_seg
+from evaluation import list_images, score_masks
+from fundus import open_image
+
+
+# Images used to calibrate int8 ranges (and to compare backends)
+CALIBRATION_DIR = mnet_seg.test_data_path
+CALIBRATION_IMAGES = 50
+REPORT_IMAGES = 20
+# Interpreter threads of TFLite models (None: TFLite default)
+TFLITE_THREADS = None
+
+
+class TFLiteModel:
+    ''' TFLite model with the predict interface of Keras models
+        predict takes a float32 batch and returns the output array (or a
+        list of arrays if the model has several outputs). The interpreter
+        is resized when the batch shape changes (batch size or profile input
+        size), and calls are serialized (interpreters are not thread-safe).
+    '''
+
+    def __init__(self, filename, threads=TFLITE_THREADS):
+        import tensorflow as tf
+        self.filename = filename
+        self.interpreter = tf.lite.Interpreter(model_path=filename,
+                                               num_threads=threads)
+        self.input = self.interpreter.get_input_details()[0]['index']
+        self.outputs = [o['index']
+                        for o in self.interpreter.get_output_details()]
+        self.shape = None
+        self.lock = Lock()
+
+    def predict(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        with self.lock:
+            if batch.shape != self.shape:
+                self.interpreter.resize_tensor_input(self.input, batch.shape)
+                self.interpreter.allocate_tensors()
+                self.shape = batch.shape
+            self.interpreter.set_tensor(self.input, batch)
+            self.interpreter.invoke()
+            outputs = [self.interpreter.get_tensor(o) for o in self.outputs]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+
+def calibration_inputs(files):
+    ''' Get DiscSeg and M-Net inputs of images (using float32 models) '''
+    disc_model, _ = mnet_seg.load_models('keras')
+    disc_inputs, polar_inputs = [], []
+    for file in files:
+        org_img = open_image(file).rgb
+        disc_in = mnet_seg.disc_input(org_img)
+        disc_inputs.append(disc_in)
+        try:
+            disc_map = disc_model.predict(disc_in[None])[0]
+            polar_inputs.append(mnet_seg.polar_input(org_img, disc_map)[0])
+        except Exception as error:
+            print(f'ERROR: Disc detection failed for {file}: {error}')
+    return disc_inputs, polar_inputs
+
+
+def export_tflite(model, filename, inputs):
+    ''' Convert a Keras model to int8 TFLite (float32 input/output)
+        Activation ranges are calibrated on inputs (model input arrays).
+    '''
+    import tensorflow as tf
+
+    def representative_dataset():
+        for x in inputs:
+            yield [np.asarray(x, dtype=np.float32)[None]]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    with open(filename, 'wb') as f:
+        f.write(converter.convert())
+    return filename
+
+
+def export_models(folder=CALIBRATION_DIR, limit=CALIBRATION_IMAGES):
+    ''' Export int8 DiscSeg and M-Net models (tflite backend)
+        Models are converted at the input sizes they were trained at, the
+        interpreter is resized for other profiles.
+    '''
+    disc_model, cdr_model = mnet_seg.build_models(mnet_seg.Disc_size,
+                                                  mnet_seg.CDRSeg_size)
+    files = list_images(folder, limit)
+    print(f'Calibrating on {len(files)} images of {folder}')
+    disc_inputs, polar_inputs = calibration_inputs(files)
+    export_tflite(disc_model, mnet_seg.model_path('DiscSeg', 'tflite'),
+                  disc_inputs)
+    export_tflite(cdr_model, mnet_seg.model_path('M-Net', 'tflite'),
+                  polar_inputs)
+    for name in mnet_seg.WEIGHTS:
+        print(f'Saved {mnet_seg.model_path(name, "tflite")}')
+
+
+def model_bytes(backend):
+    ''' Get size of the model files of a backend '''
+    return sum(path.getsize(mnet_seg.model_path(name, backend))
+               for name in mnet_seg.WEIGHTS)
+
+
+def measure_memory(backend, file):
+    ''' Peak memory (MiB) of a backend loading its models and segmenting
+        an image, TensorFlow itself excluded (see backend_memory)
+    '''
+    from model_benchmark import peak_rss
+    # Import TensorFlow first, both backends need it
+    import tensorflow
+    before = peak_rss()
+    mnet_seg.warmup(backend)
+    mnet_seg.segment_batch([open_image(file).rgb], backend=backend)
+    return peak_rss() - before
+
+
+def backend_memory(backend, file):
+    ''' Run measure_memory in a new process, so peak memory is not shared '''
+    with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as pool:
+        return pool.submit(measure_memory, backend, file).result()
+
+
+def report(folder=CALIBRATION_DIR, limit=REPORT_IMAGES):
+    ''' Compare int8 (tflite) masks, speed, memory and size with float32
+        (keras)
+    '''
+    files = list_images(folder, limit)
+    images = [open_image(file).rgb for file in files]
+    masks, times = {}, {}
+    for backend in mnet_seg.BACKENDS:
+        mnet_seg.warmup(backend)
+        t0 = time()
+        masks[backend] = [mnet_seg.segment_batch([img], backend=backend)[0]
+                          for img in images]
+        times[backend] = (time() - t0) / len(images)
+
+    print(f'{"Image":<16}{"Disc Dice":>10}{"Cup Dice":>10}')
+    scores = []
+    for file, ref, mask in zip(files, masks['keras'], masks['tflite']):
+        if ref is None or mask is None:
+            print(f'{path.basename(file):<16}{"failed":>10}')
+            continue
+        score = score_masks(mask, ref)
+        scores.append((score['disc_dice'], score['cup_dice']))
+        print(f'{path.basename(file):<16}{scores[-1][0]:10.4f}'
+              f'{scores[-1][1]:10.4f}')
+    if scores:
+        disc, cup = np.mean(scores, axis=0)
+        print(f'{"Mean":<16}{disc:10.4f}{cup:10.4f}')
+
+    memory = {backend: backend_memory(backend, files[0])
+              for backend in mnet_seg.BACKENDS}
+    sizes = {backend: model_bytes(backend) for backend in mnet_seg.BACKENDS}
+    print(f'\n{"Backend":<10}{"s/image":>10}{"Peak MiB":>10}{"File MiB":>10}')
+    for backend in mnet_seg.BACKENDS:
+        print(f'{backend:<10}{times[backend]:10.3f}{memory[backend]:10.1f}'
+              f'{sizes[backend] / 2**20:10.1f}')
+    print(f'Speedup {times["keras"] / times["tflite"]:.2f}x, model memory '
+          f'saved {memory["keras"] - memory["tflite"]:.1f} MiB (model files '
+          f'{(sizes["keras"] - sizes["tflite"]) / 2**20:.1f} MiB smaller)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export int8 segmentation models and compare them with '
+                    'the float32 models')
+    parser.add_argument('command', choices=('export', 'report'))
+    parser.add_argument('--images', default=CALIBRATION_DIR,
+                        help='folder of fundus images (calibration/report)')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='maximum number of images')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_models(args.images, args.limit or CALIBRATION_IMAGES)
+    else:
+        report(args.images, args.limit or REPORT_IMAGES)
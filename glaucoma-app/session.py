@@ -0,0 +1,104 @@
+from collections import OrderedDict
+
+
+# Memory budget of image pyramids and masks of a session (bytes)
+CACHE_BYTES = 512 << 20
+
+
+def nbytes(value):
+    ''' Estimate memory of a cached value (arrays, pyramids and tuples) '''
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(v) for v in value)
+    if hasattr(value, 'nbytes'):
+        return value.nbytes
+    return 0
+
+
+class LRUCache:
+    ''' Least recently used cache bounded by a memory budget
+        Values are only dropped from memory when evicted; they can always
+        be rebuilt from the on-disk caches (crop index, mask files).
+    '''
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes, self.total = max_bytes, 0
+        # key -> (value, size), least recently used first
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        ''' Get a value (and mark it as recently used) '''
+        item = self.items.get(key)
+        if item is None:
+            return default
+        self.items.move_to_end(key)
+        return item[0]
+
+    def put(self, key, value):
+        ''' Add a value, evicting least recently used values over budget
+            (the newest value is always kept)
+        '''
+        self.pop(key)
+        size = nbytes(value)
+        self.items[key] = (value, size)
+        self.total += size
+        while self.total > self.max_bytes and len(self.items) > 1:
+            _, (_, size) = self.items.popitem(last=False)
+            self.total -= size
+
+    def pop(self, key):
+        ''' Remove a value (None if not cached) '''
+        item = self.items.pop(key, None)
+        if item is None:
+            return None
+        self.total -= item[1]
+        return item[0]
+
+    def clear(self):
+        self.items.clear()
+        self.total = 0
+
+
+class Session:
+    ''' Images reviewed together (e.g. both eyes over several visits)
+        Each image keeps its state (project info and ShapeStore, see
+        project.py) while another image is shown, so switching restores
+        its layers, view settings and zoom. Image pyramids and masks are
+        cached by (filename, kind) in a shared LRUCache.
+    '''
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        # Images in order of addition and their states (or None)
+        self.files, self.states = [], {}
+        self.cache = LRUCache(max_bytes)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, filename):
+        return filename in self.states
+
+    def add(self, filename):
+        ''' Add an image (if new) and get its state '''
+        if filename not in self.states:
+            self.files.append(filename)
+            self.states[filename] = None
+        return self.states[filename]
+
+    def remove(self, filename):
+        ''' Remove an image with its state and cached values '''
+        self.files.remove(filename)
+        del self.states[filename]
+        for key in [key for key in self.cache.items if key[0] == filename]:
+            self.cache.pop(key)
+
+    def save_state(self, filename, info, store):
+        ''' Keep state of an image while another image is shown '''
+        self.states[filename] = (info, store)
+
+    def neighbor(self, filename, step):
+        ''' Get image step positions after an image (wraps around) '''
+        idx = self.files.index(filename) if filename in self.states else 0
+        return self.files[(idx + step) % len(self.files)]
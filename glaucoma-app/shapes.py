@@ -1,15 +1,49 @@
-from math import sqrt
+from math import sqrt, pi
+import numpy as np
+
+
+# Shape kinds (stored in ShapeStore.kinds)
+KIND_NONE, KIND_CIRCLE, KIND_ELLIPSE = 0, 1, 2
+# Number of handles (points) used by each shape kind
+KIND_HANDLES = np.array([0, 2, 3])
+# Maximum handles of any shape (center + two axis points)
+MAX_HANDLES = 3
+# Shapes of each layer (disc, cup)
+LAYER_SHAPES = 2
 
 
 class Point:
-    ''' Geometric point '''
+    ''' Geometric point
+        The point is a view over a row of a float buffer, so editing it
+        edits the buffer (a ShapeStore layer or its own buffer).
+    '''
+    __slots__ = ('_buf',)
+
+    def __init__(self, x=0, y=0, buf=None):
+        # Create own buffer if the point is not a view
+        if buf is None:
+            buf = np.array([x, y], dtype=np.float64)
+        self._buf = buf
+
+    @property
+    def x(self):
+        return self._buf[0].item()
+
+    @x.setter
+    def x(self, value):
+        self._buf[0] = value
 
-    def __init__(self, x=0, y=0):
-        self.x, self.y = x, y
+    @property
+    def y(self):
+        return self._buf[1].item()
+
+    @y.setter
+    def y(self, value):
+        self._buf[1] = value
 
     def set(self, point):
         ''' Set the point by another point '''
-        self.x, self.y = point.x, point.y
+        self._buf[:] = point._buf
 
     def value(self):
         ''' Get value of the point '''
@@ -21,13 +55,11 @@ class Point:
 
     def scale(self, factor):
         ''' Tranforms the point (scale) '''
-        self.x = round(self.x * factor)
-        self.y = round(self.y * factor)
+        self._buf[:] = np.rint(self._buf * factor)
 
     def move(self, xdiff, ydiff):
         ''' Tranforms the point (move) '''
-        self.x += xdiff
-        self.y += ydiff
+        self._buf += (xdiff, ydiff)
 
     def isIn(self, x, y, length):
         ''' Make sure you are inside the point square area
@@ -42,17 +74,33 @@ class Point:
 
 
 class Circle:
-    ''' Geometric circle '''
+    ''' Geometric circle (center and radius points) '''
+    __slots__ = ('_buf', 'c', 'r', 'used')
+    KIND = KIND_CIRCLE
 
     def __init__(self, cx=0, cy=0, rx=0, ry=0, condition=False):
-        self.c, self.r = Point(cx, cy), Point(rx, ry)
+        self._bind(np.array([[cx, cy], [rx, ry]], dtype=np.float64))
         self.used = condition
 
+    def _bind(self, buf):
+        ''' Use buffer (handles x 2) as the storage of the circle '''
+        self._buf = buf
+        self.c, self.r = Point(buf=buf[0]), Point(buf=buf[1])
+
     def __str__(self):
         ''' Print internal variables (used for debugging) '''
-        cx, cy, rx, ry = self.c.value(), self.r.value()
+        (cx, cy), (rx, ry) = self.c.value(), self.r.value()
         return f'Circle({cx}, {cy}, {rx}, {ry})'
 
+    def handles(self):
+        ''' Get editable points of the circle (same order as buffer) '''
+        return (self.c, self.r)
+
+    def to_ellipse(self):
+        ''' Get ellipse handles (center, radius, perpendicular radius) '''
+        c, r = self._buf
+        return np.array([c, r, c + (c[1] - r[1], r[0] - c[0])])
+
     def copy(self):
         ''' Create a copy of the circle '''
         circle = Circle()
@@ -81,25 +129,372 @@ class Circle:
         radius = sqrt(self.c.length2(self.r))
         return round(2 * radius)
 
+    def area(self):
+        ''' Calculate circle area '''
+        return pi * self.c.length2(self.r)
+
+    def bounds(self):
+        ''' Get center, horizontal and vertical diameters (x, y, w, h) '''
+        dia = self.dia()
+        return (*self.center(), dia, dia)
+
+    def mask(self, shape):
+        ''' Rasterize the circle into a boolean mask of shape (h, w) '''
+        return ellipse_mask(self.to_ellipse(), shape)
+
     def scale(self, factor):
         ''' Tranforms the circle (scale) '''
-        self.c.scale(factor)
-        self.r.scale(factor)
+        self._buf[:] = np.rint(self._buf * factor)
 
     def move(self, xdiff, ydiff):
         ''' Tranforms the circle (move) '''
-        self.c.move(xdiff, ydiff)
-        self.r.move(xdiff, ydiff)
+        self._buf += (xdiff, ydiff)
 
 
 class Ellipse:
-    ''' Geometric Ellipse
-        TODO: Not implemented yet.
+    ''' Geometric Ellipse (center and two axis end points)
+        The first axis point (i) sets the orientation and first semi-axis,
+        the second axis point (j) sets the second semi-axis.
     '''
-    def __init__(self, cx=0, cy=0, px=0, py=0, qx=0, qy=0):
-        self.c, self.i, self.j = Point(cx, cy), Point(px, py), Point(qx, qy)
+    __slots__ = ('_buf', 'c', 'i', 'j', 'used')
+    KIND = KIND_ELLIPSE
+
+    def __init__(self, cx=0, cy=0, px=0, py=0, qx=0, qy=0, condition=False):
+        self._bind(np.array([[cx, cy], [px, py], [qx, qy]], dtype=np.float64))
+        self.used = condition
+
+    def _bind(self, buf):
+        ''' Use buffer (handles x 2) as the storage of the ellipse '''
+        self._buf = buf
+        self.c, self.i, self.j = (Point(buf=buf[0]), Point(buf=buf[1]),
+                                  Point(buf=buf[2]))
 
     def __str__(self):
         ''' Print internal variables (used for debugging) '''
-        cx, cy, ix, iy, jx, jy = self.c.value(), self.i.value(), self.j.value()
+        (cx, cy), (ix, iy), (jx, jy) = (self.c.value(), self.i.value(),
+                                        self.j.value())
         return f'Ellipse({cx}, {cy}, {ix}, {iy}, {jx}, {jy})'
+
+    @classmethod
+    def from_mask(cls, mask):
+        ''' Fit an ellipse to a binary mask (None if mask is empty) '''
+        handles = fit_ellipse(mask)
+        return None if handles is None else cls(*handles.ravel())
+
+    def handles(self):
+        ''' Get editable points of the ellipse (same order as buffer) '''
+        return (self.c, self.i, self.j)
+
+    def to_ellipse(self):
+        ''' Get ellipse handles (center, first axis, second axis) '''
+        return self._buf
+
+    def copy(self):
+        ''' Create a copy of the ellipse '''
+        return Ellipse(*self._buf.ravel(), condition=self.used)
+
+    def center(self):
+        ''' Get the center point of the ellipse '''
+        return self.c.value()
+
+    def area(self):
+        ''' Calculate ellipse area '''
+        return float(ellipse_area(self._buf))
+
+    def bounds(self):
+        ''' Get center, horizontal and vertical diameters (x, y, w, h) '''
+        w, h = ellipse_diameters(self._buf)
+        return (*self.center(), float(w), float(h))
+
+    def orthogonalize(self, point=None):
+        ''' Keep axes perpendicular after a handle has been moved
+            The moved axis point keeps its position and the other axis
+            point is rotated around the center (keeping its length).
+        '''
+        c, i, j = self._buf
+        fixed, other = (j, i) if point is self.j else (i, j)
+        direction = fixed - c
+        length = np.hypot(*direction)
+        if length > 0:
+            # Rotate the direction by 90 degrees and use other axis length
+            normal = np.array([-direction[1], direction[0]]) / length
+            if other is i:
+                normal = -normal
+            other[:] = c + normal * np.hypot(*(other - c))
+
+    def mask(self, shape):
+        ''' Rasterize the ellipse into a boolean mask of shape (h, w) '''
+        return ellipse_mask(self._buf, shape)
+
+    def scale(self, factor):
+        ''' Tranforms the ellipse (scale) '''
+        self._buf[:] = np.rint(self._buf * factor)
+
+    def move(self, xdiff, ydiff):
+        ''' Tranforms the ellipse (move) '''
+        self._buf += (xdiff, ydiff)
+
+
+def ellipse_axes(handles):
+    ''' Get center, semi-axes and orientation of ellipses
+        handles is an array of (..., 3, 2) ellipse handles, so all layers
+        of a ShapeStore can be measured at once.
+    '''
+    handles = np.asarray(handles, dtype=np.float64)
+    c, i, j = handles[..., 0, :], handles[..., 1, :], handles[..., 2, :]
+    a = np.hypot(*np.moveaxis(i - c, -1, 0))
+    b = np.hypot(*np.moveaxis(j - c, -1, 0))
+    theta = np.arctan2(i[..., 1] - c[..., 1], i[..., 0] - c[..., 0])
+    return c, a, b, theta
+
+
+def ellipse_area(handles):
+    ''' Calculate area of ellipses '''
+    _, a, b, _ = ellipse_axes(handles)
+    return np.pi * a * b
+
+
+def ellipse_diameters(handles):
+    ''' Calculate horizontal and vertical diameters (bounding box size) '''
+    _, a, b, theta = ellipse_axes(handles)
+    cos2, sin2 = np.cos(theta) ** 2, np.sin(theta) ** 2
+    w = 2 * np.sqrt(a * a * cos2 + b * b * sin2)
+    h = 2 * np.sqrt(a * a * sin2 + b * b * cos2)
+    return w, h
+
+
+def isnt_widths(disc, cup):
+    ''' Calculate rim widths (i, s, n, t) between disc and cup ellipses
+        Widths are measured between bounding boxes using the same
+        convention as the info panel: i is the upper rim, s is the lower
+        rim, n is the right rim and t is the left rim (image coordinates).
+    '''
+    (dc, cc) = ellipse_axes(disc)[0], ellipse_axes(cup)[0]
+    (dw, dh), (cw, ch) = ellipse_diameters(disc), ellipse_diameters(cup)
+    dx, dy, cx, cy = dc[..., 0], dc[..., 1], cc[..., 0], cc[..., 1]
+    i = (cy - ch / 2) - (dy - dh / 2)
+    s = (dy + dh / 2) - (cy + ch / 2)
+    n = (dx + dw / 2) - (cx + cw / 2)
+    t = (cx - cw / 2) - (dx - dw / 2)
+    return i, s, n, t
+
+
+def ellipse_mask(handles, shape):
+    ''' Rasterize one ellipse into a boolean mask of shape (h, w)
+        Only the bounding box of the ellipse is evaluated.
+    '''
+    mask = np.zeros(shape[:2], dtype=bool)
+    (cx, cy), a, b, theta = ellipse_axes(handles)
+    if a == 0 or b == 0:
+        return mask
+    # Get bounding box (clipped to the mask)
+    w, h = ellipse_diameters(handles)
+    x0, x1 = max(int(np.floor(cx - w / 2)), 0), int(np.ceil(cx + w / 2)) + 1
+    y0, y1 = max(int(np.floor(cy - h / 2)), 0), int(np.ceil(cy + h / 2)) + 1
+    x1, y1 = min(x1, mask.shape[1]), min(y1, mask.shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return mask
+    # Evaluate the ellipse equation in the rotated frame
+    xs, ys = np.arange(x0, x1) - cx, np.arange(y0, y1)[:, None] - cy
+    cos, sin = np.cos(theta), np.sin(theta)
+    u = (xs * cos + ys * sin) / a
+    v = (ys * cos - xs * sin) / b
+    mask[y0:y1, x0:x1] = u * u + v * v <= 1
+    return mask
+
+
+def layer_mask(disc, cup, shape):
+    ''' Rasterize disc/cup ellipses using MNet mask values
+        (255 background, 128 disc and 1 cup).
+    '''
+    mask = ellipse_mask(disc, shape).astype(np.uint8)
+    mask += ellipse_mask(cup, shape)
+    return (255 - mask * 127).astype(np.uint8)
+
+
+def fit_ellipse(mask):
+    ''' Fit ellipse handles (3 x 2) to a binary mask using image moments
+        Returns None if the mask is empty.
+    '''
+    ys, xs = np.nonzero(mask)
+    if len(xs) < 3:
+        return None
+    cx, cy = xs.mean(), ys.mean()
+    # Second order central moments (normalized)
+    dx, dy = xs - cx, ys - cy
+    return moments_ellipse(cx, cy, np.mean(dx * dx), np.mean(dx * dy),
+                           np.mean(dy * dy))
+
+
+def moments_ellipse(cx, cy, mu20, mu11, mu02):
+    ''' Get ellipse handles (3 x 2) of normalized central moments
+        For a filled ellipse, the variance along each axis is a^2 / 4,
+        so the semi-axes are twice the square root of the eigenvalues of
+        the covariance matrix.
+    '''
+    cov = np.array([[mu20, mu11], [mu11, mu02]])
+    # Eigenvalues in ascending order (minor axis first)
+    evals, evecs = np.linalg.eigh(cov)
+    a, b = 2 * np.sqrt(np.maximum(evals[::-1], 0))
+    major, minor = evecs[:, 1], evecs[:, 0]
+    return np.array([[cx, cy],
+                     [cx + a * major[0], cy + a * major[1]],
+                     [cx + b * minor[0], cy + b * minor[1]]])
+
+
+# Shape class of each kind
+SHAPE_KINDS = {KIND_CIRCLE: Circle, KIND_ELLIPSE: Ellipse}
+
+
+class Layer:
+    ''' Disc/cup shapes of one layer (view over a ShapeStore slot) '''
+    __slots__ = ('store', 'slot')
+
+    def __init__(self, store, slot):
+        self.store, self.slot = store, slot
+
+    def __len__(self):
+        return LAYER_SHAPES
+
+    def __getitem__(self, i):
+        return self.store.get_shape(self.slot, i)
+
+    def __setitem__(self, i, shape):
+        self.store.set_shape(self.slot, i, shape)
+
+    def __iter__(self):
+        return (self[i] for i in range(LAYER_SHAPES))
+
+    def set_fitted(self, i, shape):
+        ''' Set a shape fitted to the mask (image coordinates until it is
+            placed on the cropped image)
+        '''
+        self.store.set_shape(self.slot, i, shape)
+        self.store.fitted[self.slot, i] = True
+
+    def pop_fitted(self, i):
+        ''' Check if a shape is fitted and not placed yet (clears it) '''
+        fitted = bool(self.store.fitted[self.slot, i])
+        self.store.fitted[self.slot, i] = False
+        return fitted
+
+
+class ShapeStore:
+    ''' Array-backed storage of all layers shapes
+        Handles of every layer live in one float array of shape
+        (slots, disc/cup, handles, x/y), so projecting all layers onto the
+        screen is one vectorized operation instead of per-shape copies.
+        It behaves like the old list of [disc, cup] lists (insert, del,
+        index and len), and the stored shapes are views over the array.
+    '''
+
+    def __init__(self, capacity=8):
+        # Handles array and shape kind of each disc/cup
+        self.data = np.zeros((capacity, LAYER_SHAPES, MAX_HANDLES, 2))
+        self.kinds = np.zeros((capacity, LAYER_SHAPES), dtype=np.int8)
+        # Shapes set by Layer.set_fitted and not placed yet
+        self.fitted = np.zeros((capacity, LAYER_SHAPES), dtype=bool)
+        # Layer order (position to slot), free slots and shape objects
+        self.order, self.free = [], list(range(capacity - 1, -1, -1))
+        self.objects = {}
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, idx):
+        return Layer(self, self.order[idx])
+
+    def __delitem__(self, idx):
+        # Release the slot of the layer
+        slot = self.order.pop(idx)
+        self.kinds[slot] = KIND_NONE
+        self.fitted[slot] = False
+        del self.objects[slot]
+        self.free.append(slot)
+
+    def __iter__(self):
+        return (Layer(self, slot) for slot in self.order)
+
+    def insert(self, idx, shapes):
+        ''' Insert a layer (list of disc/cup shapes) at index '''
+        # Grow the arrays if there are no free slots
+        if not self.free:
+            self._grow()
+        slot = self.free.pop()
+        self.order.insert(idx, slot)
+        self.objects[slot] = [None] * LAYER_SHAPES
+        for i, shape in enumerate(shapes):
+            self.set_shape(slot, i, shape)
+
+    def _grow(self):
+        ''' Double the capacity and rebind the stored shapes '''
+        capacity = len(self.data)
+        self.data = np.concatenate((self.data, np.zeros_like(self.data)))
+        self.kinds = np.concatenate((self.kinds, np.zeros_like(self.kinds)))
+        self.fitted = np.concatenate((self.fitted,
+                                      np.zeros_like(self.fitted)))
+        self.free = list(range(2 * capacity - 1, capacity - 1, -1))
+        for slot, shapes in self.objects.items():
+            for i, shape in enumerate(shapes):
+                if shape is not None:
+                    shape._bind(self.data[slot, i, :KIND_HANDLES[shape.KIND]])
+
+    def get_shape(self, slot, i):
+        ''' Get disc/cup shape of a slot '''
+        return self.objects[slot][i]
+
+    def set_shape(self, slot, i, shape):
+        ''' Set disc/cup shape of a slot (shape becomes a view) '''
+        self.data[slot, i] = 0
+        self.fitted[slot, i] = False
+        if shape is None:
+            self.kinds[slot, i] = KIND_NONE
+        else:
+            # Copy handles into the store and rebind shape to them
+            view = self.data[slot, i, :KIND_HANDLES[shape.KIND]]
+            view[:] = shape._buf
+            shape._bind(view)
+            self.kinds[slot, i] = shape.KIND
+        self.objects[slot][i] = shape
+
+    def layer_kinds(self, idx):
+        ''' Get disc/cup shape kinds of a layer '''
+        return self.kinds[self.order[idx]]
+
+    def to_arrays(self):
+        ''' Get (kinds, handles, used) arrays of all layers (in order) '''
+        used = np.zeros((len(self.order), LAYER_SHAPES), dtype=bool)
+        for i, slot in enumerate(self.order):
+            for j, shape in enumerate(self.objects[slot]):
+                used[i, j] = shape is not None and shape.used
+        return self.kinds[self.order], self.data[self.order], used
+
+    @classmethod
+    def from_arrays(cls, kinds, handles, used):
+        ''' Create a store from (kinds, handles, used) arrays
+            Handles are copied once, then shapes are bound to the store
+            without creating their own buffers.
+        '''
+        count = len(kinds)
+        store = cls(max(8, count))
+        store.data[:count] = handles
+        store.kinds[:count] = kinds
+        store.order = list(range(count))
+        store.free = list(range(len(store.data) - 1, count - 1, -1))
+        for slot in range(count):
+            shapes = store.objects[slot] = [None] * LAYER_SHAPES
+            for i, kind in enumerate(kinds[slot]):
+                if kind != KIND_NONE:
+                    shape = SHAPE_KINDS[kind].__new__(SHAPE_KINDS[kind])
+                    shape._bind(store.data[slot, i, :KIND_HANDLES[kind]])
+                    shape.used = bool(used[slot, i])
+                    shapes[i] = shape
+        return store
+
+    def transform(self, factor, xdiff, ydiff):
+        ''' Project handles of all layers (layers x 2 x 3 x 2) onto screen
+            using one affine transformation (scale then move).
+        '''
+        pts = np.rint(self.data[self.order] * factor)
+        pts += (xdiff, ydiff)
+        return pts.astype(int)
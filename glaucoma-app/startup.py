@@ -0,0 +1,83 @@
+from time import perf_counter
+import threading
+import builtins
+import runpy
+import sys
+
+
+# Application started by the startup profile mode
+APP_FILE = '[app] Glaucoma.py'
+# Number of slowest imports to report
+REPORT_IMPORTS = 25
+
+
+class StartupProfiler:
+    ''' Measure import time of each module and startup milestones
+        Import times are inclusive (a module includes its own imports)
+        and only the first (uncached) import of a module is measured.
+    '''
+
+    def __init__(self):
+        self.t0 = perf_counter()
+        # module -> (seconds, nesting depth, thread name)
+        self.imports = {}
+        self._import = builtins.__import__
+        self._local = threading.local()
+
+    def start(self):
+        ''' Start measuring imports '''
+        builtins.__import__ = self._timed_import
+
+    def stop(self):
+        ''' Stop measuring imports '''
+        builtins.__import__ = self._import
+
+    def _timed_import(self, name, globals=None, locals=None,
+                      fromlist=(), level=0):
+        # Skip relative and cached imports
+        if level or name in sys.modules:
+            return self._import(name, globals, locals, fromlist, level)
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        t = perf_counter()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            self._local.depth = depth
+            thread = threading.current_thread().name
+            self.imports.setdefault(name, (perf_counter() - t, depth, thread))
+
+    def mark(self, milestone):
+        ''' Report time since start of a milestone and the slowest imports '''
+        print(f'[startup] {milestone}: {perf_counter() - self.t0:.3f} s')
+        self.report()
+
+    def report(self):
+        ''' Print slowest imports (time, depth and thread of the import) '''
+        slowest = sorted(self.imports.items(), key=lambda item: -item[1][0])
+        for name, (seconds, depth, thread) in slowest[:REPORT_IMPORTS]:
+            indent = '  ' * min(depth, 4)
+            print(f'[startup] {seconds * 1000:9.1f} ms  {indent}{name}'
+                  f'  ({thread})')
+        # Do not report the same imports again
+        self.imports.clear()
+
+
+# Profiler of startup profile mode (None if not profiling)
+profiler = None
+
+
+def mark(milestone):
+    ''' Mark a startup milestone (does nothing if not profiling) '''
+    if profiler is not None:
+        profiler.mark(milestone)
+
+
+if __name__ == '__main__':
+    # Startup profile mode: python startup.py
+    # Make the app use this module (not a second copy of it)
+    sys.modules['startup'] = sys.modules['__main__']
+    profiler = StartupProfiler()
+    profiler.start()
+    sys.argv = [APP_FILE] + sys.argv[1:]
+    runpy.run_path(APP_FILE, run_name='__main__')
@@ -0,0 +1,155 @@
+from contextlib import nullcontext
+from collections import deque
+from functools import wraps
+from threading import Lock, local, get_ident, current_thread
+from time import perf_counter_ns
+from os import environ, getpid
+import atexit
+import json
+
+import numpy as np
+
+
+# Record spans (set by environment, or from the app Trace menu)
+ENABLED = bool(environ.get('GLAUCOMA_TRACE'))
+# Chrome trace file written at exit (when spans were recorded)
+TRACE_FILE = environ.get('GLAUCOMA_TRACE_FILE')
+# Spans kept for export (oldest are dropped)
+TRACE_EVENTS = 100000
+# Recent durations of each span name kept for stats
+STATS_WINDOW = 200
+
+# Spans: (name, image, thread id, start ns, duration ns)
+events = deque(maxlen=TRACE_EVENTS)
+# Span name -> recent durations (ns)
+durations = {}
+# Thread names by thread id (Chrome trace metadata)
+threads = {}
+# Lock of durations and threads (written by all threads)
+durations_lock = Lock()
+# Image ID of the current thread (set by outer spans)
+context = local()
+t0 = perf_counter_ns()
+
+
+def set_enabled(enabled):
+    ''' Start or stop recording spans '''
+    global ENABLED
+    ENABLED = bool(enabled)
+
+
+def clear():
+    ''' Forget recorded spans and stats '''
+    events.clear()
+    with durations_lock:
+        durations.clear()
+
+
+def record(name, image, start, duration):
+    ''' Record a span (times in ns of perf_counter_ns) '''
+    tid = get_ident()
+    events.append((name, image, tid, start, duration))
+    with durations_lock:
+        if tid not in threads:
+            threads[tid] = current_thread().name
+        if name not in durations:
+            durations[name] = deque(maxlen=STATS_WINDOW)
+        durations[name].append(duration)
+
+
+class Span:
+    ''' Recording span (see span) '''
+    __slots__ = ('name', 'image', 'outer', 'start')
+
+    def __init__(self, name, image):
+        self.name, self.image = name, image
+
+    def __enter__(self):
+        self.outer = getattr(context, 'image', None)
+        if self.image is None:
+            self.image = self.outer
+        context.image = self.image
+        self.start = perf_counter_ns()
+
+    def __exit__(self, *exc):
+        record(self.name, self.image, self.start,
+               perf_counter_ns() - self.start)
+        context.image = self.outer
+
+
+# Shared context of spans while tracing is off
+NO_SPAN = nullcontext()
+
+
+def span(name, image=None):
+    ''' Context manager timing a span of code
+        Spans inside it (same thread) get its image ID unless they set
+        their own. Nothing is recorded when tracing is off.
+    '''
+    if not ENABLED:
+        return NO_SPAN
+    return Span(name, image)
+
+
+def traced(name=None, image_arg=None):
+    ''' Decorator timing each call of a function as a span
+        image_arg is the index of the argument to use as image ID.
+    '''
+    def decorator(fn):
+        label = name or fn.__name__
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            image = None
+            if image_arg is not None and len(args) > image_arg:
+                image = args[image_arg]
+                # Arguments set to None (e.g. no file) get the outer ID
+                if image is not None:
+                    image = str(image)
+            with Span(label, image):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def stats():
+    ''' Get rolling stats of each span name (count of recent spans and
+        mean, median, p95 and last duration in ms)
+    '''
+    with durations_lock:
+        recent = {name: np.array(d) / 1e6 for name, d in durations.items()}
+    return {name: {'count': len(d),
+                   'mean_ms': float(d.mean()),
+                   'p50_ms': float(np.percentile(d, 50)),
+                   'p95_ms': float(np.percentile(d, 95)),
+                   'last_ms': float(d[-1])}
+            for name, d in recent.items() if len(d)}
+
+
+def export_chrome(filename):
+    ''' Write recorded spans as Chrome trace JSON (chrome://tracing or
+        Perfetto), returns the number of spans
+    '''
+    pid = getpid()
+    spans = list(events)
+    with durations_lock:
+        names = list(threads.items())
+    trace = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+              'args': {'name': thread}} for tid, thread in names]
+    trace += [{'name': name, 'cat': 'glaucoma', 'ph': 'X', 'pid': pid,
+               'tid': tid, 'ts': (start - t0) / 1000,
+               'dur': duration / 1000,
+               'args': {} if image is None else {'image': image}}
+              for name, image, tid, start, duration in spans]
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+    return len(spans)
+
+
+@atexit.register
+def export_at_exit():
+    if TRACE_FILE and events:
+        count = export_chrome(TRACE_FILE)
+        print(f'Saved {count} spans to {TRACE_FILE}')